@@ -1,24 +1,20 @@
-import psutil as p
 import datetime
-from email.message import EmailMessage
-from email.mime.image import MIMEImage
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
 import os
 import time
-import smtplib
-import numpy as np
-import pymongo
 import logging
-import traceback
 
 import config as cfg
+from mail_spool import queue_alert
+from stacks_index import collector_files, list_dir, save_index
+from stacks_ingest import measure_ingest, rate_is_low, log_ingest, latest_rates
+from thresholds import OK, check_thresholds
 
 logging.basicConfig(filename=cfg.script_log_file,filemode='a+',level=logging.INFO)
 
 stacks_flags = {}
 stacks_flags["stacks_dir"] = 0
 stacks_flags["projects"] = {}
+stacks_flags["ingest"] = {}
 ambiguous_collector_names = {}
 for project in cfg.stacks_params["projects"]:
     project_collectors = project["collector_names"]
@@ -42,10 +38,10 @@ def check_stacks_details(stacks_params=cfg.stacks_params):
     """
     STACKS_problems = False
     STACKS_collector_problems = []
-    STACKS_problems_to_email = {"main": None, "projects": [], "collectors": []}
+    STACKS_problems_to_email = {"main": None, "projects": [], "collectors": [], "slow": []}
     STACKS_problem_email_required = False
     STACKS_data_dir = os.path.join(stacks_params["stacks_dir"], "data")
-    STACKS_project_data_dirs = os.listdir(STACKS_data_dir)
+    STACKS_project_data_dirs = list_dir(STACKS_data_dir)
     now = datetime.datetime.now()
     current_hour = now.hour
     if now.minute == 0:
@@ -88,12 +84,17 @@ def check_stacks_details(stacks_params=cfg.stacks_params):
                 STACKS_problems = True
             project_name_and_id = project_name_and_id[0]
             project_data_dir = os.path.join(STACKS_data_dir, project_name_and_id, "twitter", "raw")
-            collection_files = [f for f in os.listdir(project_data_dir) if f.endswith('.json')]
+            latest_files = collector_files(project_data_dir, project["collector_names"])
             for collector in project["collector_names"]:
-                collector_files = [f.split('-')[1] for f in collection_files if collector in f]
-                if current_hour in collector_files:
+                collector_hours = latest_files.get(collector, {})
+                if current_hour in collector_hours:
                     stacks_flags["projects"][project_name][collector] = 0
-                elif current_hour not in collector_files:
+                    data_file = os.path.join(project_data_dir, collector_hours[current_hour])
+                    if check_ingest_rate(project_name, collector, data_file, STACKS_problems_to_email, stacks_params):
+                        STACKS_problems = True
+                        if STACKS_problems_to_email['slow']:
+                            STACKS_problem_email_required = True
+                elif current_hour not in collector_hours:
                     STACKS_problems = True
                     STACKS_collector_problems.append(project_name + '-' + collector)
                     logging.critical("No data file for {} for hour {}!".format(collector, current_hour))
@@ -102,19 +103,46 @@ def check_stacks_details(stacks_params=cfg.stacks_params):
                         STACKS_problem_email_required = True
                         stacks_flags["projects"][project_name][collector] = 1
             end_project_check = True
+    save_index()
     if STACKS_problem_email_required:
         trigger_STACKS_email(STACKS_problems_to_email)
     if not STACKS_problems:
         logging.info("No problems with STACKS")
     return stacks_flags
 
+def check_ingest_rate(project_name, collector, data_file, STACKS_problems_to_email, stacks_params=cfg.stacks_params):
+    """
+    This function measures how fast a collector is writing to its data file (see stacks_ingest.py) and logs it.
+    The rate is checked against the collector's entity_thresholds rule, if it has one (see thresholds.py), as well as
+     the floor and trailing average in stacks_params.
+    It returns True if the rate is too low. The collector is added to the email the first time its rate is too low,
+     and again only after it has recovered.
+    """
+    key = project_name + '-' + collector
+    rate, last_write = measure_ingest(key, data_file, time.time())
+    latest_rates[(project_name, collector)] = rate
+    log_ingest(project_name, collector, data_file, rate, last_write)
+    if rate is None:
+        return False
+    _, new_warnings, level = check_thresholds('collector', {(key, 'bytes_per_minute'): round(rate, 1)})
+    STACKS_problems_to_email['slow'].extend(new_warnings)
+    low, average = rate_is_low(key, rate, stacks_params)
+    if not low:
+        stacks_flags["ingest"][key] = 0
+        return level != OK
+    logging.critical("{0} is only writing {1} bytes per minute (average {2})".format(key, round(rate, 1), round(average, 1) if average else 'unknown'))
+    if stacks_flags["ingest"].get(key, 0) == 0:
+        average_text = ', usually {} bytes per minute'.format(int(average)) if average else ''
+        STACKS_problems_to_email['slow'].append('{0}: {1} bytes per minute{2}'.format(key, int(rate), average_text))
+        stacks_flags["ingest"][key] = 1
+    return True
+
 def trigger_STACKS_email(STACKS_problems_to_email, email_recipients=cfg.warning_email_recipients):
     """
-    This function immediately sends a warning email if there is a problem with STACKS
+    This function queues a warning email if there is a problem with STACKS
     """
     if not type(email_recipients) is list:
         raise Exception("Email recipients must be in a list")
-    email = EmailMessage()
     email_text = 'STACK PROBLEMS \n\n'
     if STACKS_problems_to_email['main']:
         email_text += "Can't find the STACKS data directory. \n\n"
@@ -122,17 +150,8 @@ def trigger_STACKS_email(STACKS_problems_to_email, email_recipients=cfg.warning_
         email_text += "These STACKS project names are problematic (either ambiguous or not found): \n\t" + '\n\t'.join(STACKS_problems_to_email['projects']) + '\n\n'
     if STACKS_problems_to_email['collectors']:
         email_text += "Couldn't find an expected data file for the following project-collector combinations. The collectors might not be working correctly: \n\t" + "\n\t".join(STACKS_problems_to_email['collectors']) + "\n\n"
+    if STACKS_problems_to_email['slow']:
+        email_text += "These collectors are writing data more slowly than expected. They might be stuck: \n\t" + "\n\t".join(STACKS_problems_to_email['slow']) + "\n\n"
 
-    email.set_content(email_text)
-
-    time = str(datetime.datetime.now().replace(microsecond=0).isoformat().split('T')[1])
-    email['Subject'] = "{0}: Critical - problem with STACKS".format(cfg.server_name, time)
-    email['From'] = cfg.account_to_send_emails + '@gmail.com'
-    email['To'] = ", ".join(email_recipients)
-
-    server = smtplib.SMTP(cfg.email_server[0], cfg.email_server[1])
-    server.starttls()
-    server.login(cfg.account_to_send_emails, cfg.password_to_send_emails)
-    server.sendmail(email['From'], email_recipients, email.as_string())
-    server.quit()
+    queue_alert("{0}: Critical - problem with STACKS".format(cfg.server_name), email_text, email_recipients)
 
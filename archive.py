@@ -0,0 +1,410 @@
+"""
+This module keeps the stats archive in day partitions, so reading a few days of stats never means opening (or keeping)
+ the whole history.
+
+    <stats_archive_dir>/stats_log.csv, stats_log.bin                 today's system stats (the live partition)
+    <stats_archive_dir>/system/<date>.csv, <date>.bin                 the system stats of each earlier day
+    <stats_archive_dir>/processes/<process>/<date>.csv, <date>.bin    the stats of each process for each day
+    <stats_archive_dir>/mounts/<mount>/<date>.csv                     the stats of each mounted filesystem for each day
+    <stats_archive_dir>/<log>.csv, <log>/<date>.csv                   the STACKS, Mongo and monitor logs (DAY_LOGS),
+                                                                      split the same way as the system stats
+    <stats_archive_dir>/archive_manifest.json                         the time range of every finished partition
+
+On the first stats check of a new day, rotate_archive moves the live system stats into system/<date>.* (and each of
+ the DAY_LOGS into <log>/<date>.csv) and records every finished partition in the manifest. It then gzips the
+ partitions older than cfg.archive_compress_after_days (<date>.csv.gz, <date>.bin.gz), and deletes those older than
+ cfg.archive_retention_days, if that is set.
+Stats that arrive after their day was rotated (records a fleet agent buffered while the aggregator was down) are
+ moved into their day partition as soon as they are written, by file_late_stats.
+Readers ask system_partitions, process_partitions or log_partitions for the files that overlap the range they need.
+ Compressed files are read transparently (see open_text and read_bytes).
+Like the stats checks, this module only uses the standard library.
+"""
+
+import datetime
+import gzip
+import json
+import logging
+import os
+import shutil
+
+import config as cfg
+from stats_store import HEADER_SIZE, SYSTEM_FORMAT, from_seconds, upgrade_file
+
+# The directories holding one sub-directory of day partitions per process or mounted filesystem
+ENTITY_KINDS = ('processes', 'mounts')
+# The other CSV logs, which are split into day partitions (<name>/<date>.csv) like stats_log.csv
+DAY_LOGS = ('stacks_log', 'mongo_log', 'monitor_log', 'monitor_stages')
+
+archive_state = {'live_dates': {}}      # log_dir: the date of its live partition
+manifest_cache = {}
+
+
+def _manifest_file(log_dir):
+    return os.path.join(log_dir, 'archive_manifest.json')
+
+
+def load_manifest(log_dir):
+    """
+    This function returns the manifest, structured as {'live_date': date, 'system': {date: range},
+     'processes': {process: {date: range}}, 'mounts': {mount: {date: range}}, 'logs': {log: {date: range}}}, where
+     each range is {'start': time, 'end': time}. It is only read from disk again when the file changes. It returns None
+     if the archive has never been rotated.
+    """
+    manifest_file = _manifest_file(log_dir)
+    try:
+        mtime = os.stat(manifest_file).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    cached = manifest_cache.get(manifest_file)
+    if cached is None or cached[0] != mtime:
+        with open(manifest_file, 'r') as f:
+            cached = (mtime, json.load(f))
+        manifest_cache[manifest_file] = cached
+    return cached[1]
+
+
+def save_manifest(log_dir, manifest):
+    manifest_file = _manifest_file(log_dir)
+    temp_file = manifest_file + '.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(temp_file, manifest_file)
+    manifest_cache.pop(manifest_file, None)
+
+
+def open_text(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt')
+    return open(path, 'r')
+
+
+def read_bytes(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        return f.read()
+
+
+def _existing(path):
+    """
+    This function returns path, or path + '.gz' if the file has been compressed, or None if neither exists.
+    """
+    for candidate in (path, path + '.gz'):
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def _overlaps(time_range, start, end):
+    return (start is None or time_range['end'] >= start) and (end is None or time_range['start'] <= end)
+
+
+def _bound(when):
+    if when is None or when is False:
+        return None
+    if isinstance(when, datetime.datetime):
+        return when.replace(microsecond=0).isoformat()
+    return datetime.datetime.combine(when, datetime.time()).isoformat()
+
+
+def system_partitions(log_dir, start=None, end=None):
+    """
+    This function returns the system stats partitions that overlap start to end (datetimes or dates, both optional),
+     oldest first. Each is a dictionary with the paths of its 'csv' and 'bin' files, or None for a file that doesn't
+     exist. The live partition is always included if it exists.
+    """
+    manifest = load_manifest(log_dir) or {}
+    start, end = _bound(start), _bound(end)
+    partitions = []
+    for date, time_range in sorted(manifest.get('system', {}).items()):
+        if _overlaps(time_range, start, end):
+            base = os.path.join(log_dir, 'system', date)
+            partitions.append({'date': date, 'csv': _existing(base + '.csv'), 'bin': _existing(base + '.bin')})
+    live = {'date': manifest.get('live_date'), 'csv': _existing(os.path.join(log_dir, 'stats_log.csv')),
+            'bin': _existing(os.path.join(log_dir, 'stats_log.bin'))}
+    partitions.append(live)
+    return [f for f in partitions if f['csv'] or f['bin']]
+
+
+def log_partitions(log_dir, name, start=None, end=None):
+    """
+    This function returns the partitions of one of the DAY_LOGS that overlap start to end, oldest first, in the same
+     form as system_partitions (without 'bin'). The live log is always included if it exists.
+    """
+    manifest = load_manifest(log_dir) or {}
+    start, end = _bound(start), _bound(end)
+    partitions = []
+    for date, time_range in sorted(manifest.get('logs', {}).get(name, {}).items()):
+        if _overlaps(time_range, start, end):
+            partitions.append({'date': date, 'csv': _existing(os.path.join(log_dir, name, date + '.csv'))})
+    partitions.append({'date': manifest.get('live_date'), 'csv': _existing(os.path.join(log_dir, name + '.csv'))})
+    return [f for f in partitions if f['csv']]
+
+
+def _process_dates(process_dir):
+    dates = set()
+    for name in os.listdir(process_dir):
+        date = name.split('.')[0]
+        if len(date) == 10 and date[4] == '-' and name[10:].lstrip('.').split('.')[0] in ('csv', 'bin'):
+            dates.add(date)
+    return dates
+
+
+def process_partitions(log_dir, process, start=None, end=None):
+    """
+    This function returns the daily partitions of a process that overlap start to end (datetimes or dates, both
+     optional), oldest first, in the same form as system_partitions. If the archive has no manifest yet, the process
+     directory is listed instead.
+    """
+    process_dir = os.path.join(log_dir, 'processes', process)
+    manifest = load_manifest(log_dir)
+    start, end = _bound(start), _bound(end)
+    if manifest is None:
+        dates = _process_dates(process_dir) if os.path.isdir(process_dir) else set()
+        ranges = dict((date, _day_range(date)) for date in dates)
+    else:
+        ranges = dict(manifest.get('processes', {}).get(process, {}))
+        live_date = manifest.get('live_date')
+        ranges[live_date] = _day_range(live_date)
+    partitions = []
+    for date, time_range in sorted(ranges.items()):
+        if _overlaps(time_range, start, end):
+            base = os.path.join(process_dir, date)
+            partition = {'date': date, 'csv': _existing(base + '.csv'), 'bin': _existing(base + '.bin')}
+            if partition['csv'] or partition['bin']:
+                partitions.append(partition)
+    return partitions
+
+
+def partition_file(log_dir, process, date, extension):
+    """
+    This function returns the path of one day's process log ('csv' or 'bin'), compressed or not, or None.
+    """
+    return _existing(os.path.join(log_dir, 'processes', process, '{0}.{1}'.format(date, extension)))
+
+
+def _day_range(date):
+    return {'start': date + 'T00:00:00', 'end': date + 'T23:59:59'}
+
+
+def _append_partition(path, header, data):
+    """
+    This function adds data (bytes) to a partition file, creating it with header if it doesn't exist yet. Data added
+     to a compressed partition is written as a new gzip member, so the partition isn't rewritten.
+    """
+    if path.endswith('.gz'):
+        with gzip.open(path, 'ab') as f:
+            f.write(data)
+    else:
+        with open(path, 'ab') as f:
+            if f.tell() == 0:
+                f.write(header)
+            f.write(data)
+
+
+def _recover_split(live_file):
+    """
+    This function undoes a split of live_file (see _split_live_file) that was interrupted before the live file was
+     replaced, by cutting every partition it appended to back to its size before the split.
+    """
+    journal = live_file + '.rotating'
+    if not os.path.isfile(journal):
+        return
+    temp_file = live_file + '.tmp'
+    if os.path.isfile(temp_file):
+        with open(journal, 'r') as f:
+            sizes = json.load(f)
+        for path, size in sizes.items():
+            if size is None:
+                if os.path.isfile(path):
+                    os.remove(path)
+            elif os.path.isfile(path):
+                os.truncate(path, size)
+        os.remove(temp_file)
+        logging.warning('Undid an interrupted split of {}'.format(live_file))
+    os.remove(journal)
+
+
+def _split_live_file(live_file, remaining, partitions):
+    """
+    This function appends data to the partitions, structured as path: (header, data), and then replaces live_file with
+     remaining (bytes).
+    The size of each partition is written to <live_file>.rotating first, so if ServerReport stops half way, the next
+     rotation undoes the appends (see _recover_split) instead of moving the same rows twice.
+    """
+    targets = dict((path, _existing(path) or path) for path in partitions)
+    journal = live_file + '.rotating'
+    with open(journal, 'w') as f:
+        json.dump(dict((f, os.path.getsize(f) if os.path.isfile(f) else None) for f in targets.values()), f)
+    temp_file = live_file + '.tmp'
+    with open(temp_file, 'wb') as f:
+        f.write(remaining)
+    for path, (header, data) in partitions.items():
+        _append_partition(targets[path], header, data)
+    os.replace(temp_file, live_file)
+    os.remove(journal)
+
+
+def _split_csv(log_file, partition_dir, live_date, ranges):
+    """
+    This function moves every row of a CSV log older than live_date into the partition for its day
+     (<partition_dir>/<date>.csv), and records the time range of each partition it writes to in ranges. The rows from
+     live_date stay in the log. The first column of the log must be an ISO time.
+    """
+    _recover_split(log_file)
+    if not os.path.isfile(log_file):
+        return
+    with open(log_file, 'r') as f:
+        lines = f.read().split('\n')
+    header, lines = lines[0], [line for line in lines[1:] if line]
+    days = {}
+    for line in lines:
+        days.setdefault(line[:10], []).append(line)
+    partitions = {}
+    for date, rows in sorted(days.items()):
+        if date >= live_date:
+            continue
+        partitions[os.path.join(partition_dir, date + '.csv')] = (header.encode(), ('\n' + '\n'.join(rows)).encode())
+        time_range = ranges.setdefault(date, {'start': rows[0][:19], 'end': rows[-1][:19]})
+        time_range['start'] = min(time_range['start'], rows[0][:19])
+        time_range['end'] = max(time_range['end'], rows[-1][:19])
+    if not partitions:
+        return
+    os.makedirs(partition_dir, exist_ok=True)
+    remaining = [line for line in lines if line[:10] >= live_date]
+    _split_live_file(log_file, (header + ''.join('\n' + line for line in remaining)).encode(), partitions)
+
+
+def _split_system_bin(log_dir, live_date):
+    """
+    This function does the same as _split_csv for stats_log.bin.
+    """
+    log_file = os.path.join(log_dir, 'stats_log.bin')
+    _recover_split(log_file)
+    if not os.path.isfile(log_file):
+        return
+    upgrade_file(log_file)
+    with open(log_file, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+        data = f.read()
+    data = data[:len(data) - len(data) % SYSTEM_FORMAT.size]
+    days = {}
+    for offset in range(0, len(data), SYSTEM_FORMAT.size):
+        date = str(from_seconds(SYSTEM_FORMAT.unpack_from(data, offset)[0]).date())
+        days.setdefault(date, []).append(data[offset:offset + SYSTEM_FORMAT.size])
+    partitions = dict((os.path.join(log_dir, 'system', date + '.bin'), (header, b''.join(records)))
+                      for date, records in days.items() if date < live_date)
+    if partitions:
+        remaining = header + b''.join(b''.join(records) for date, records in sorted(days.items()) if date >= live_date)
+        _split_live_file(log_file, remaining, partitions)
+
+
+def _compress(path):
+    with open(path, 'rb') as source, gzip.open(path + '.gz', 'wb') as target:
+        shutil.copyfileobj(source, target)
+    os.remove(path)
+
+
+def _remove(path):
+    if path:
+        os.remove(path)
+
+
+def maintain_partitions(log_dir, manifest, today):
+    """
+    This function compresses the finished partitions older than cfg.archive_compress_after_days, and deletes those
+     older than cfg.archive_retention_days (if it is set), along with their manifest entries.
+    """
+    compress_before = str(today - datetime.timedelta(days=cfg.archive_compress_after_days))
+    drop_before = None
+    if cfg.archive_retention_days is not None:
+        drop_before = str(today - datetime.timedelta(days=cfg.archive_retention_days))
+    partition_sets = [(os.path.join(log_dir, 'system'), manifest['system'])]
+    partition_sets += [(os.path.join(log_dir, name), dates) for name, dates in manifest.get('logs', {}).items()]
+    for kind in ENTITY_KINDS:
+        partition_sets += [(os.path.join(log_dir, kind, name), dates) for name, dates in manifest.get(kind, {}).items()]
+    for partition_dir, dates in partition_sets:
+        for date in sorted(dates):
+            base = os.path.join(partition_dir, date)
+            files = [_existing(base + '.csv'), _existing(base + '.bin')]
+            if drop_before and date < drop_before:
+                for path in files:
+                    _remove(path)
+                del dates[date]
+            elif date < compress_before:
+                for path in files:
+                    if path and not path.endswith('.gz'):
+                        _compress(path)
+
+
+def rotate_archive(log_dir, now):
+    """
+    This function starts a new live partition when now (a datetime) is on a different day than the current one. It
+     moves the older system stats and DAY_LOGS into their day partitions, adds every finished day (system, logs,
+     processes and mounts) to the manifest, and then compresses and deletes old partitions. On other calls, including
+     those for an earlier day than the live partition's (see file_late_stats), it does nothing.
+    """
+    today = str(now.date())
+    live_date = archive_state['live_dates'].get(log_dir)
+    if live_date is not None and live_date >= today:
+        return
+    manifest = load_manifest(log_dir)
+    if manifest is not None and manifest.get('live_date', today) > today:
+        return
+    if manifest is None or manifest.get('live_date') != today:
+        manifest = json.loads(json.dumps(manifest or {'system': {}, 'processes': {}}))
+        os.makedirs(os.path.join(log_dir, 'system'), exist_ok=True)
+        _split_csv(os.path.join(log_dir, 'stats_log.csv'), os.path.join(log_dir, 'system'), today, manifest['system'])
+        _split_system_bin(log_dir, today)
+        for name in DAY_LOGS:
+            _split_csv(os.path.join(log_dir, name + '.csv'), os.path.join(log_dir, name), today,
+                       manifest.setdefault('logs', {}).setdefault(name, {}))
+        # Days split off by a rotation that stopped before the manifest was saved
+        day_dirs = [(os.path.join(log_dir, 'system'), manifest['system'])]
+        day_dirs += [(os.path.join(log_dir, name), manifest['logs'][name]) for name in DAY_LOGS]
+        for day_dir, dates in day_dirs:
+            if os.path.isdir(day_dir):
+                for date in _process_dates(day_dir):
+                    if date < today and date not in dates:
+                        dates[date] = _day_range(date)
+        for kind in ENTITY_KINDS:
+            kind_dir = os.path.join(log_dir, kind)
+            if not os.path.isdir(kind_dir):
+                continue
+            for name in os.listdir(kind_dir):
+                entity_dir = os.path.join(kind_dir, name)
+                if not os.path.isdir(entity_dir):
+                    continue
+                dates = manifest.setdefault(kind, {}).setdefault(name, {})
+                for date in _process_dates(entity_dir):
+                    if date < today and date not in dates:
+                        dates[date] = _day_range(date)
+        maintain_partitions(log_dir, manifest, now.date())
+        manifest['live_date'] = today
+        save_manifest(log_dir, manifest)
+        logging.info('Started the stats archive partition for {}'.format(today))
+    archive_state['live_dates'][log_dir] = today
+
+
+def file_late_stats(log_dir, processes):
+    """
+    This function moves system stats from a day before the live partition's (e.g. sent late from a fleet agent's
+     buffer) out of the live files and into their day partitions, and adds the days the processes (a list of names)
+     now have logs for to the manifest. It does nothing if the archive has never been rotated.
+    """
+    manifest = load_manifest(log_dir)
+    if manifest is None or not manifest.get('live_date'):
+        return
+    manifest = json.loads(json.dumps(manifest))
+    live_date = manifest['live_date']
+    os.makedirs(os.path.join(log_dir, 'system'), exist_ok=True)
+    _split_csv(os.path.join(log_dir, 'stats_log.csv'), os.path.join(log_dir, 'system'), live_date, manifest['system'])
+    _split_system_bin(log_dir, live_date)
+    for process in processes:
+        process_dir = os.path.join(log_dir, 'processes', process)
+        if os.path.isdir(process_dir):
+            dates = manifest.setdefault('processes', {}).setdefault(process, {})
+            for date in _process_dates(process_dir):
+                if date < live_date:
+                    dates.setdefault(date, _day_range(date))
+    save_manifest(log_dir, manifest)
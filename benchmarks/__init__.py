@@ -0,0 +1,3 @@
+"""
+Benchmarks for ServerReport's slow paths, run against synthetic data. See run.py.
+"""
@@ -0,0 +1,222 @@
+"""
+This script times ServerReport's slow paths against synthetic data (see synthetic.py) and prints the results as JSON.
+
+Run it from the repository root:
+    python -m benchmarks.run [--scales small,medium,large] [--repeat 3] [--out results.json] [--compare old.json]
+
+Each scale runs in its own Python process, with a config built from config_template.py that points every path at a
+ temporary directory, so your config.py and logs are never touched. For each benchmark it records:
+    first_seconds: the first call (cold caches, new process handles, rebuilt indexes)
+    seconds: each of the following --repeat calls, and their median
+    peak_memory_mb: the peak memory allocated by Python during one more call, measured with tracemalloc
+Benchmarks whose dependencies (e.g. matplotlib) aren't installed are reported as skipped.
+With --compare, the median of each benchmark is also printed next to the one in an earlier results file.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+from benchmarks import synthetic
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCALES = {
+    'small': {'stats_days': 365, 'processes': 50, 'process_days': 14, 'process_table': 2000,
+              'stacks_projects': 2, 'stacks_collectors': 10, 'stacks_days': 7},
+    'medium': {'stats_days': 3 * 365, 'processes': 200, 'process_days': 30, 'process_table': 5000,
+               'stacks_projects': 4, 'stacks_collectors': 20, 'stacks_days': 30},
+    'large': {'stats_days': 5 * 365, 'processes': 500, 'process_days': 30, 'process_table': 10000,
+              'stacks_projects': 8, 'stacks_collectors': 20, 'stacks_days': 30}
+}
+
+
+def build_data(work_dir, scale):
+    """
+    This function writes the synthetic archive and STACKS tree for a scale into work_dir, and returns the sizes of what
+     it wrote along with what the config needs.
+    """
+    log_dir = os.path.join(work_dir, 'log')
+    processes = synthetic.process_names(scale['processes'])
+    sizes = {'stats_log_rows': synthetic.make_stats_log(log_dir, scale['stats_days']),
+             'process_log_files': synthetic.make_process_logs(log_dir, processes, scale['process_days']),
+             'processes': len(processes)}
+    stacks_params, sizes['stacks_files'] = synthetic.make_stacks_tree(os.path.join(work_dir, 'stacks'), scale['stacks_projects'],
+                                                                     scale['stacks_collectors'], scale['stacks_days'])
+    sizes['process_table'] = scale['process_table']
+    return log_dir, processes, stacks_params, sizes
+
+
+def install_config(work_dir, log_dir, processes, stacks_params):
+    """
+    This function builds the config module from config_template.py, with every path inside work_dir, and installs it
+     as "config" so the ServerReport modules imported after it use it.
+    """
+    template = os.path.join(REPO_DIR, 'config_template.py')
+    cfg = types.ModuleType('config')
+    cfg.__file__ = template
+    with open(template, 'r') as f:
+        exec(compile(f.read(), template, 'exec'), cfg.__dict__)
+    cfg.stats_archive_dir = log_dir + '/'
+    cfg.script_log_file = os.path.join(work_dir, 'script.log')
+    cfg.mail_spool_dir = os.path.join(work_dir, 'mail_spool') + '/'
+    cfg.processes_to_monitor = processes
+    cfg.check_stacks = True
+    cfg.stacks_params = stacks_params
+    cfg.check_mongo = False
+    cfg.entity_thresholds = {}
+    cfg.fleet_mode = None
+    cfg.monitor_profile_over_budget = False
+    sys.modules['config'] = cfg
+    return cfg
+
+
+def measure(name, func, repeat):
+    """
+    This function times func (see the module docstring for what is recorded).
+    """
+    result = {'name': name}
+    try:
+        start = time.perf_counter()
+        func()
+        result['first_seconds'] = round(time.perf_counter() - start, 4)
+        seconds = []
+        for f in range(repeat):
+            start = time.perf_counter()
+            func()
+            seconds.append(round(time.perf_counter() - start, 4))
+        result['seconds'] = seconds
+        result['median_seconds'] = round(statistics.median(seconds), 4) if seconds else result['first_seconds']
+        tracemalloc.start()
+        try:
+            func()
+            result['peak_memory_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 2)
+        finally:
+            tracemalloc.stop()
+    except ImportError as e:
+        result['skipped'] = str(e)
+    except Exception as e:
+        result['error'] = repr(e)
+    return result
+
+
+def run_scale(scale_name, repeat):
+    """
+    This function builds the data for one scale, runs every benchmark against it and returns the results.
+    """
+    work_dir = tempfile.mkdtemp(prefix='serverreport-bench-')
+    try:
+        build_start = time.perf_counter()
+        log_dir, processes, stacks_params, sizes = build_data(work_dir, SCALES[scale_name])
+        build_seconds = round(time.perf_counter() - build_start, 2)
+        install_config(work_dir, log_dir, processes, stacks_params)
+        synthetic.make_process_table(sizes['process_table'], processes)
+
+        import server_checks
+        import STACKS_checks
+        from archive import rotate_archive
+        from rollups import rebuild_rollups
+        from tiers import rebuild_tiers
+        rotate_archive(log_dir, datetime.datetime.now())
+        rebuild_rollups(log_dir)
+        rebuild_tiers(log_dir)
+
+        def check_processes():
+            with synthetic.fake_psutil():
+                return server_checks.check_process_status()
+
+        process_stats = check_processes()[0]
+        cpu = {'average': '12.5', 'max': '40.0', 'per_core': ''}
+        hard_drive = {'free_space': '500.0G', 'percent_used': '45.0'}
+
+        def daily_email_contents():
+            import daily_report
+            return daily_report.daily_email_contents()
+
+        def prepare_process_summary():
+            import daily_report
+            return daily_report.prepare_process_summary()
+
+        def plot_stats(what, plot, days=30):
+            def run():
+                import get_plot
+                get_plot.processes_or_computer = what
+                get_plot.start_date = datetime.datetime.now() - datetime.timedelta(days=days) if days else None
+                os.chdir(work_dir)              # make_plots saves temp.png in the working directory
+                try:
+                    return get_plot.make_plots() if plot else get_plot.build_stats_dfs()
+                finally:
+                    os.chdir(REPO_DIR)
+            return run
+
+        benchmarks = [
+            ('check_process_status', check_processes),
+            ('check_stacks_details', STACKS_checks.check_stacks_details),
+            ('log_stats', lambda: server_checks.log_stats(cpu, '35.0', hard_drive, '20.0', process_stats)),
+            ('daily_email_contents', daily_email_contents),
+            ('prepare_process_summary', prepare_process_summary),
+            ('get_plot.build_stats_dfs (computer)', plot_stats('computer', False)),
+            ('get_plot.build_stats_dfs (all processes)', plot_stats(processes, False)),
+            ('get_plot.build_stats_dfs (computer, all data)', plot_stats('computer', False, None)),
+            ('get_plot.build_stats_dfs (all processes, all data)', plot_stats(processes, False, None)),
+            ('get_plot.make_plots (all processes)', plot_stats(processes, True))
+        ]
+        results = [measure(name, func, repeat) for name, func in benchmarks]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {'scale': scale_name, 'sizes': sizes, 'build_seconds': build_seconds, 'repeat': repeat, 'results': results}
+
+
+def compare(runs, old_file):
+    with open(old_file, 'r') as f:
+        old_runs = dict((run['scale'], run) for run in json.load(f)['runs'])
+    for run in runs:
+        old = dict((f['name'], f) for f in old_runs.get(run['scale'], {}).get('results', []))
+        for result in run['results']:
+            before = old.get(result['name'], {}).get('median_seconds')
+            after = result.get('median_seconds')
+            change = '{:+.0%}'.format(after / before - 1) if before and after is not None else ''
+            print('{0:8} {1:42} {2:>10} {3:>10} {4:>8}'.format(run['scale'], result['name'], str(before), str(after), change), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time ServerReport against synthetic data.')
+    parser.add_argument('--scales', default='small', help='comma separated: ' + ', '.join(SCALES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--out', help='write the results to this file as well as printing them')
+    parser.add_argument('--compare', help='an earlier results file to compare with')
+    parser.add_argument('--one-scale', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.one_scale:
+        print(json.dumps(run_scale(args.one_scale, args.repeat)))
+        return
+
+    runs = []
+    for scale_name in [f.strip() for f in args.scales.split(',') if f.strip()]:
+        if scale_name not in SCALES:
+            parser.error('Unknown scale: {}'.format(scale_name))
+        output = subprocess.check_output([sys.executable, '-m', 'benchmarks.run', '--one-scale', scale_name, '--repeat', str(args.repeat)], cwd=REPO_DIR)
+        runs.append(json.loads(output.decode().strip().split('\n')[-1]))
+    results = {'python': platform.python_version(), 'platform': platform.platform(),
+               'time': datetime.datetime.now().replace(microsecond=0).isoformat(), 'runs': runs}
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        compare(runs, args.compare)
+
+
+if __name__ == '__main__':
+    main()
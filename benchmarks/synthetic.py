@@ -0,0 +1,176 @@
+"""
+This module builds the synthetic data the benchmarks run against:
+    a stats_log.csv covering any number of days
+    processes/<name>/<date>.csv logs for any number of processes
+    a STACKS data tree with an hourly file per collector
+    a fake process table, standing in for psutil while check_process_status runs
+
+Everything is generated with a fixed random seed, so two runs at the same size read the same data.
+"""
+
+import contextlib
+import datetime
+import os
+import random
+
+STATS_HEADER = "time,% CPU use,% RAM used,% hard drive used,free hard drive space,% boot drive used"
+PROCESS_HEADER = 'report_time,status,create_time,memory_info,memory_percent,username,cpu_percent'
+
+
+def make_stats_log(log_dir, days, minutes_between_checks=15, end=None):
+    """
+    This function writes a stats_log.csv with one row every minutes_between_checks minutes for the days before end
+     (default: now). It returns the number of rows.
+    """
+    rand = random.Random(1)
+    end = end or datetime.datetime.now().replace(second=0, microsecond=0)
+    step = datetime.timedelta(minutes=minutes_between_checks)
+    when = end - datetime.timedelta(days=days)
+    os.makedirs(log_dir, exist_ok=True)
+    rows = 0
+    with open(os.path.join(log_dir, 'stats_log.csv'), 'w') as f:
+        f.write(STATS_HEADER)
+        while when < end:
+            hard_drive_used = 40 + 20 * rows / (days * 96.0)
+            f.write('\n{0},{1},{2},{3},{4}G,{5}'.format(when.isoformat(), round(rand.uniform(1, 60), 2), round(rand.uniform(20, 60), 2),
+                                                       round(hard_drive_used, 2), round(900 - 9 * hard_drive_used, 2), round(rand.uniform(10, 30), 1)))
+            when += step
+            rows += 1
+    return rows
+
+
+def process_names(count):
+    return ['synthetic_process_{:04d}'.format(f) for f in range(count)]
+
+
+def make_process_logs(log_dir, processes, days, minutes_between_checks=15, end_date=None):
+    """
+    This function writes a daily log for each process for the days before end_date (default: today), and returns the
+     number of files written.
+    """
+    rand = random.Random(2)
+    end_date = end_date or datetime.date.today()
+    rows_per_day = int(24 * 60 / minutes_between_checks)
+    files = 0
+    for process in processes:
+        process_dir = os.path.join(log_dir, 'processes', process)
+        os.makedirs(process_dir, exist_ok=True)
+        create_time = (datetime.datetime.combine(end_date, datetime.time()) - datetime.timedelta(days=days + 1)).isoformat()
+        for day in range(days, 0, -1):
+            date = end_date - datetime.timedelta(days=day)
+            lines = [PROCESS_HEADER]
+            for row in range(rows_per_day):
+                report_time = (datetime.datetime.min + datetime.timedelta(minutes=row * minutes_between_checks)).time().isoformat()
+                lines.append('{0},OK,{1},{2}G,{3},bench,{4}'.format(report_time, create_time, round(rand.uniform(.01, 2), 2),
+                                                                  round(rand.uniform(.1, 5), 2), round(rand.uniform(0, 100), 2)))
+            with open(os.path.join(process_dir, date.isoformat() + '.csv'), 'w') as f:
+                f.write('\n'.join(lines))
+            files += 1
+    return files
+
+
+def make_stacks_tree(stacks_dir, projects, collectors, days, end=None):
+    """
+    This function builds a STACKS data tree with one file per collector per hour for the days before end (default: now),
+     including the current hour. It returns the stacks_params to check it with, and the number of files.
+    """
+    end = end or datetime.datetime.now()
+    stacks_params = {"stacks_dir": stacks_dir, "projects": [], "min_bytes_per_minute": 0,
+                     "min_fraction_of_average": 0, "rate_average_checks": 24}
+    files = 0
+    for p in range(projects):
+        project_name = 'benchproject{:02d}'.format(p)
+        collector_names = ['collector{:03d}'.format(f) for f in range(collectors)]
+        raw_dir = os.path.join(stacks_dir, 'data', '{0}-{1:08x}'.format(project_name, p), 'twitter', 'raw')
+        os.makedirs(raw_dir, exist_ok=True)
+        for hour in range(days * 24, -1, -1):
+            when = end - datetime.timedelta(hours=hour)
+            for collector in collector_names:
+                name = '{0}-{1}-{2}-{3:04d}.json'.format(when.strftime('%Y%m%d'), when.strftime('%H'), collector, p)
+                with open(os.path.join(raw_dir, name), 'w') as f:
+                    f.write('{}\n' * 10)
+                files += 1
+        stacks_params["projects"].append({"project_name": project_name, "collector_names": collector_names})
+    return stacks_params, files
+
+
+class FakeProcess(object):
+    """
+    Stands in for psutil.Process, both as an entry from process_iter and as a handle for sampling.
+    """
+
+    def __init__(self, pid, cmdline=None, create_time=None):
+        self.pid = pid
+        self.info = {'pid': pid, 'name': 'proc{}'.format(pid), 'cmdline': cmdline, 'create_time': create_time}
+
+    @contextlib.contextmanager
+    def oneshot(self):
+        yield
+
+    def cpu_percent(self, interval=None):
+        return float(self.pid % 100)
+
+    def create_time(self):
+        return fake_process_table.get(self.pid, self).info['create_time'] or 0.0
+
+    def memory_info(self):
+        return type('mem', (), {'rss': 1024 * 1024 * (self.pid % 500 + 1)})
+
+    def memory_percent(self):
+        return (self.pid % 500) / 100.0
+
+    def username(self):
+        return 'bench'
+
+
+class NoSuchProcess(Exception):
+    pass
+
+
+fake_process_table = {}
+
+
+class FakePsutil(object):
+    """
+    The parts of the psutil module that process_discovery.py and process_sampler.py use, backed by fake_process_table.
+    """
+    NoSuchProcess = NoSuchProcess
+
+    @staticmethod
+    def process_iter(attrs=None):
+        return iter(list(fake_process_table.values()))
+
+    @staticmethod
+    def Process(pid):
+        if pid not in fake_process_table:
+            raise NoSuchProcess(pid)
+        return FakeProcess(pid)
+
+
+def make_process_table(size, processes_to_monitor):
+    """
+    This function fills the fake process table with size processes. Each monitored process matches exactly one entry;
+     the rest are filler command lines.
+    """
+    fake_process_table.clear()
+    for pid in range(1000, 1000 + size):
+        cmdline = ['/usr/bin/python3', '/opt/worker/run.py', '--worker-id', str(pid)]
+        if pid - 1000 < len(processes_to_monitor):
+            cmdline = ['/usr/bin/python3', processes_to_monitor[pid - 1000]]
+        fake_process_table[pid] = FakeProcess(pid, cmdline, 1700000000.0 + pid)
+    return len(fake_process_table)
+
+
+@contextlib.contextmanager
+def fake_psutil():
+    """
+    This context manager points process discovery and sampling at the fake process table.
+    """
+    import process_discovery
+    import process_sampler
+    real_discovery, real_sampler = process_discovery.p, process_sampler.p
+    process_discovery.p = process_sampler.p = FakePsutil
+    try:
+        yield
+    finally:
+        process_discovery.p, process_sampler.p = real_discovery, real_sampler
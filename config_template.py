@@ -9,16 +9,43 @@ charts_in_status_email = True
 daily_report_hour = 2
 script_log_file = './script.log'
 print_output_to_terminal = False
+cpu_sample_seconds = 5       # CPU usage is sampled in the background this often, and averaged between stats checks
 
-# The next var is a list containing the processes you want to monitor. The script will use each item in the list as a
-#  grep phrase to identify running processes
+# Seconds between runs of each check. Checks run at times aligned to the clock (every 300 seconds means :00, :05, ...).
+#  Stats are logged every minutes_between_stats_check minutes, using the latest result of each check.
+check_intervals = {
+    "ram": 60,
+    "disks": 900,
+    "processes": 900,
+    "stacks": 900,
+    "mongo": 300
+}
+concurrent_checks = True                # Run checks that are due at the same time in parallel
+check_timeouts = {                      # Seconds before a check is given up on and its results logged as unknown
+    "ram": 10,
+    "disks": 60,
+    "processes": 60,
+    "stacks": 120,
+    "mongo": 30
+}
+missed_check_policy = 'skip'            # 'skip' runs that were missed, or 'catch_up' by running them late
+daily_report_catch_up = True            # Send the daily report on startup if today's report was missed
+daily_report_timeout_seconds = 900      # The daily report is built in a worker process, which is stopped after this long
+
+# The next var is a list containing the processes you want to monitor. The script will look for each item in the list
+#  as a phrase in the command lines of running processes
 processes_to_monitor = ["PROCESS1", "Process 2"]
 check_mongo = True
+mongo_uri = "mongodb://localhost:27017/"
+mongo_timeout_ms = 2000           # How long to wait for mongo to answer before calling it down
 delete_daily_process_stats_after_summary = False
 
 check_stacks = True
 stacks_params = {
     "stacks_dir": "/home/bits/stack",
+    "min_bytes_per_minute": 1000,       # Warn if a collector writes less than this between STACKS checks
+    "min_fraction_of_average": .25,     # ... or less than this fraction of its own recent average
+    "rate_average_checks": 24,          # The number of STACKS checks in that average
     "projects": [{
         "project_name": "Project1",
         "collector_names": ["Collector1", "collector2", "collector-3"]
@@ -33,21 +60,77 @@ daily_status_email_recipients = ["SAMPLE@EMAIL"]
 account_to_send_emails = 'SAMPLE'         # must be a gmail account. Don't include "@gmail.com"
 password_to_send_emails = 'PASSWRD'
 email_server = ("smtp.gmail.com", 587)     # This should always work for gmail
+email_use_starttls = True                  # Set to False (with an empty password) to use a local mail server
+mail_spool_dir = './mail_spool/'            # Emails wait here until they are sent
+mail_timeout_seconds = 30
+mail_retry_base_seconds = 30                # The wait before retrying a failed email doubles each time, up to the max
+mail_retry_max_seconds = 1800
+mail_keepalive_seconds = 300                # The connection to the mail server is closed after this long without use
 
 critical_parameters = {
     "CPU": "90",
     "RAM": "80",
     "hard_drive_space": "100GB",
-    "boot_partition": "90"
+    "boot_partition": "90",
+    "mongo_latency_ms": "1000"
 }
 warning_parameters = {
     "CPU": "80",
     "RAM": "70",
     "hard_drive_space": "180GB",
-    "boot_partition": "85"
+    "boot_partition": "85",
+    "mongo_latency_ms": "200"
+}
+threshold_hysteresis = {    # A warning clears once the stat is back past the warning threshold by this much
+    "CPU": 5,
+    "RAM": 5,
+    "hard_drive_space": 10,
+    "boot_partition": 2
+}
+# Thresholds for one process (as named in processes_to_monitor), mount point or STACKS collector (project-collector).
+#  Metrics: process: cpu_percent, memory_percent; mount: percent_used, free_space (GB), inode_percent;
+#  collector: bytes_per_minute
+entity_thresholds = {
+    "process:PROCESS1": {"memory_percent": {"warning": "20", "critical": "40", "hysteresis": 2}},
+    "mount:/data": {"percent_used": {"warning": "85", "critical": "95"}},
+    "collector:Project1-Collector1": {"bytes_per_minute": {"warning": "5000", "critical": "500"}}
+}
+# The space used on root_dir and boot_drive is left to the hard_drive_space and boot_partition rules above
+mount_thresholds = {        # Used for every mounted filesystem that is checked, unless entity_thresholds has a rule for it
+    "percent_used": {"warning": "85", "critical": "95", "hysteresis": 2},
+    "inode_percent": {"warning": "85", "critical": "95", "hysteresis": 2}
 }
 
 stats_archive_dir = './log/'
+binary_stats_store = True    # Also keep stats in compact binary files (see stats_store.py); the daily email reads these
+archive_compress_after_days = 7     # Day partitions of the stats archive older than this are gzipped (see archive.py)
+archive_retention_days = None       # Day partitions older than this are deleted; None keeps them all
+rollup_tier_seconds = [3600, 86400]   # Downsampled tiers kept as stats are logged (see tiers.py); long plots read these
+plot_loader_workers = 4      # get_plot.py reads this many daily log files at once
+plot_max_points_per_series = 2000   # Longer series are thinned out before plotting
+plot_downsample_method = 'minmax'   # 'minmax' keeps every spike; 'lttb' follows the shape of the line more closely
+plot_cache_max_files = 200          # get_plot.py keeps this many cached query results and plots
+
+# Fleet reporting (see fleet.py). Set fleet_mode to 'agent' to send stats to an aggregator, which sends one daily report
+#  for every server instead of each server sending its own. Start the aggregator with: python fleet.py aggregate
+fleet_mode = None
+fleet_aggregator = ("localhost", 8765)      # Where the aggregator listens
+fleet_store_dir = './fleet/'                # Where the aggregator keeps the stats from every server
+fleet_batch_size = 100                      # Records per batch
+fleet_timeout_seconds = 5
+fleet_buffer_max_records = 100000           # Records kept while the aggregator can't be reached
+fleet_secret = ''                           # Signs every batch. Set the same long random string on the aggregator and its agents
+fleet_agent_local_warnings = False          # Agents also email threshold warnings themselves (the aggregator always does)
+
+metrics_server_port = None          # Set to a port (e.g. 9464) to serve the latest stats at /metrics and /metrics.json
+metrics_server_host = '127.0.0.1'
+
+monitor_timing_window = 96          # The p50/p95 of each stage is taken over its last this many runs
+monitor_profile_over_budget = False # Profile scheduled checks and save the profile of any run over the budget
+monitor_budget_seconds = 30
 
 root_dir = '/'
 boot_drive = '/boot'
+check_all_mounts = True             # Also check and log every mounted filesystem (see mounts.py), not just the two above
+ignored_filesystem_types = []       # Filesystem types to skip, besides the pseudo filesystems (proc, tmpfs, ...)
+ignored_mount_points = ['/snap']    # Mount points to skip, along with everything mounted under them
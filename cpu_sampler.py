@@ -0,0 +1,73 @@
+"""
+This module samples CPU usage in a background thread, so check_cpu doesn't have to sleep to get a reading.
+The sampler reads per-core CPU usage every cfg.cpu_sample_seconds into a bounded ring buffer. Each stats check takes
+ everything collected since the previous check, so the reported figures cover the whole interval between checks.
+"""
+
+import collections
+import threading
+import psutil as p
+
+
+class CPUSampler(object):
+    """
+    Background CPU sampler. Each entry in the buffer is a list of per-core usage percentages.
+    """
+
+    def __init__(self, sample_seconds, max_samples):
+        self.sample_seconds = sample_seconds
+        self.samples = collections.deque(maxlen=max_samples)
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+        This function starts the sampling thread. Calling it again while the thread is running does nothing.
+        """
+        if self.thread and self.thread.is_alive():
+            return
+        p.cpu_percent(interval=None, percpu=True)       # The first reading only sets the baseline for the next one
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._sample_loop, name='cpu-sampler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+
+    def _sample_loop(self):
+        while not self.stop_event.wait(self.sample_seconds):
+            per_core = p.cpu_percent(interval=None, percpu=True)
+            with self.lock:
+                self.samples.append(per_core)
+
+    def take_window(self):
+        """
+        This function empties the buffer and returns the samples collected since the last call.
+        """
+        with self.lock:
+            window = list(self.samples)
+            self.samples.clear()
+        return window
+
+
+def summarize_window(window):
+    """
+    This function turns a list of per-core samples into a dictionary with:
+        average: mean usage across all cores and all samples
+        max: highest all-core usage seen in a single sample
+        per_core: mean usage of each core across all samples
+    Percentages are rounded to two decimal points.
+    """
+    n_cores = len(window[0])
+    totals = [sum(sample) / n_cores for sample in window]
+    per_core = [round(sum(sample[core] for sample in window) / len(window), 2) for core in range(n_cores)]
+    summary = {
+        'average': round(sum(totals) / len(totals), 2),
+        'max': round(max(totals), 2),
+        'per_core': per_core,
+        'samples': len(window)
+    }
+    return summary
@@ -0,0 +1,336 @@
+"""
+This module builds and sends the daily status email. ServerReport.py only imports it when the daily report is due, so
+ matplotlib, pandas and NumPy aren't loaded the rest of the time.
+"""
+
+import matplotlib
+matplotlib.use('Agg')
+import datetime
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+import os
+import pandas as pd
+import numpy as np
+import logging
+from dateutil.tz import tzlocal
+import matplotlib.pyplot as plt
+
+import config as cfg
+from mail_spool import spool_message
+from stats_reader import read_system_stats
+from stats_loader import load_log, load_system_stats
+from archive import partition_file, system_partitions
+from downsample import downsample
+from rollups import ROLLUP_METRICS, read_rollups, combine_rollups
+from process_summaries import get_accumulator, accumulate_csv_log, process_accumulators, summarize_day
+from monitor_stats import stage_timer, stage_timings
+
+
+def prepare_process_summary(processes=cfg.processes_to_monitor, today=None):
+    """
+    For each process, this function generates a single summary line from the previous day's stats, using the running
+     accumulators kept by log_stats (see process_summaries.py). If there is no accumulator for the previous day, it
+     falls back to that day's log file. It writes the summary line to a summary log file and, if
+     cfg.delete_daily_process_stats_after_summary is set, deletes the previous day's log.
+    It doesn't drop the previous day's accumulator; the monitor does that once the report is built (see report_worker.py).
+    today (a date) is the day of the report, today's date by default.
+
+    The summary reported in the daily email includes the peak memory use and peak CPU use as well as the averages.
+    """
+    today = today or datetime.date.today()
+    yesterday = (today - datetime.timedelta(days=1)).isoformat()
+    process_dir = cfg.stats_archive_dir + 'processes/'
+    process_report_info = {}
+    for process in processes:
+        folder = process_dir + process
+        log_from_yesterday = partition_file(cfg.stats_archive_dir, process, yesterday, 'csv')
+        day = get_accumulator(process, yesterday)
+        if day is None and log_from_yesterday:
+            day = accumulate_csv_log(log_from_yesterday)
+        if day is None:
+            stats_to_report = '**No log file for {}**'.format(yesterday)
+            logging.warning(process + ': ' + stats_to_report)
+        else:
+            stats_to_report = summarize_day(day)
+            summary_log = folder + '/summary.csv'
+            summary_header = 'report_date,status,create_time,memory_info,memory_percent,username,cpu_percent'
+            create_time = day['create_time'] or 'None found'
+            write_info = [yesterday, day['status'], create_time, stats_to_report['memory_info'], stats_to_report['memory_percent'], stats_to_report['cpu_percent']]
+            write_info = ','.join(write_info)
+            if os.path.isfile(summary_log):
+                with open(summary_log, 'a') as f:
+                    f.write('\n' + write_info)
+            elif not os.path.isfile(summary_log):
+                os.makedirs(folder, exist_ok=True)
+                with open(summary_log, 'w') as f:
+                    f.write(summary_header + '\n' + write_info)
+            if cfg.delete_daily_process_stats_after_summary and log_from_yesterday:
+                os.remove(log_from_yesterday)
+
+        process_report_info[process] = stats_to_report
+    return process_report_info
+
+
+def system_stats_frame(records):
+    """
+    This function turns system stats read from the binary store into a dataframe shaped like stats_log.csv.
+    The UTC timestamps become local times, as in the CSV logs.
+    """
+    times = pd.to_datetime(records['time'], unit='s', utc=True).tz_convert(tzlocal()).tz_localize(None)
+    log_contents = pd.DataFrame({
+        'time': times,
+        '% CPU use': records['cpu_percent'],
+        '% RAM used': records['memory_percent'],
+        '% hard drive used': records['hard_drive_percent'],
+        'free hard drive space': pd.Series(np.round(records['hard_drive_free_gb'], 2)).astype(str) + 'G',
+        '% boot drive used': records['boot_drive_percent']
+    })
+    return log_contents
+
+
+def daily_email_contents(log_dir=cfg.stats_archive_dir, today=None):
+    """
+    This function compiles the information to be included in the daily email for today (a date, today's date by
+     default).
+    The stats come from the daily rollups (see rollups.py). Only the chart reads individual stats checks, and only from
+     the day partitions of the last seven days (see archive.py).
+    """
+    today = today or datetime.date.today()
+    yesterday = today - datetime.timedelta(days=1)
+    seven_days_ago = today - datetime.timedelta(days=7)
+    window_start = datetime.datetime.combine(seven_days_ago, datetime.time())
+    partitions = system_partitions(log_dir, start=window_start)
+    plots_dir = log_dir + 'plots/'
+    os.makedirs(plots_dir,exist_ok=True)
+    stats_to_report = {}
+    if not system_partitions(log_dir):
+        stats_to_report = '**No stats log file!**'
+        logging.warning(stats_to_report)
+        return stats_to_report
+    rollups = read_rollups(log_dir, seven_days_ago)
+    if not rollups:
+        stats_to_report = '**No stats information since {}**'.format(seven_days_ago)
+        logging.warning(stats_to_report)
+        return stats_to_report, 'Warning'
+
+    averaged_metrics = ['% CPU use','% RAM used']
+    for m in ROLLUP_METRICS:
+        summary = combine_rollups(rollups, m)
+        if summary is None:
+            continue
+        if m in averaged_metrics:
+            data_to_report = str(round(summary['sum'] / summary['count'], 2))
+        elif m not in averaged_metrics:
+            data_to_report = str(round(summary['last'], 2))
+        if '%' in m:
+            data_to_report = data_to_report + '%'
+        if m == 'free hard drive space':
+            data_to_report = data_to_report + 'G'
+        stats_to_report[m] = data_to_report
+
+    if cfg.binary_stats_store and any(f['bin'] for f in partitions):
+        log_to_plot = system_stats_frame(read_system_stats(log_dir, start=window_start))
+    else:
+        log_to_plot = load_system_stats(window_start, log_dir)
+    plot_metrics = ['% CPU use','% RAM used']
+    plot = plt.figure(figsize=(10, 4))
+    plot1 = plot.add_subplot(111)
+    plot_colors = ['c','m','y','k']
+    plot_line_types = ['solid', 'dashed']
+    plot_num = 0
+    for m in plot_metrics:
+        line_color = plot_colors[plot_num]
+        line_type = plot_line_types[plot_num]
+        plot_num += 1
+        times, values = downsample(log_to_plot['time'].values, log_to_plot[m].values, cfg.plot_max_points_per_series, cfg.plot_downsample_method)
+        plot1.plot_date(times, values, fmt='-', color=line_color, ls=line_type, label=m)
+        plot.autofmt_xdate()
+        if '%' in m:
+            plot1.set_ylim(0, 105)
+        plot1.set_xlabel('Time of day')
+        plot1.set_title(today.isoformat())
+
+    plot.legend()
+    fig_name = os.path.join(plots_dir, yesterday.isoformat())
+    plot.savefig(fig_name)
+    plt.close(plot)
+    return stats_to_report
+
+
+def warning_stats(computer_stats):
+    """
+    This function returns the averages from daily_email_contents that are checked against the warning thresholds, as
+     the cpu, ram, hard_drive and boot_drive arguments of trigger_warning_email, or None if there are none.
+    """
+    if type(computer_stats) is not dict:
+        return None
+    return (computer_stats['% CPU use'][:-1], computer_stats['% RAM used'][:-1],
+            computer_stats['free hard drive space'][:-1], computer_stats['% boot drive used'][:-1])
+
+
+def stacks_ingest_summary(log_dir=cfg.stats_archive_dir, today=None):
+    """
+    This function summarizes the STACKS ingest rates (see stacks_ingest.py) of the day before today (a date, today's
+     date by default) for each collector: the average and lowest bytes per minute, and how long its data file went
+     without being written to.
+    """
+    today = today or datetime.date.today()
+    yesterday = datetime.datetime.combine(today - datetime.timedelta(days=1), datetime.time())
+    log_contents = load_log('stacks_log', yesterday, log_dir)
+    if log_contents is None:
+        return '**No STACKS log file!**'
+    log_contents = log_contents[log_contents['time'] < datetime.datetime.combine(today, datetime.time())]
+    if log_contents.empty:
+        return '**No STACKS ingest information for {}**'.format(yesterday.date())
+    stacks_report_info = {}
+    for (project, collector), rows in log_contents.groupby(['project', 'collector']):
+        rates = rows['bytes_per_minute'].dropna()
+        last_write = pd.to_datetime(rows['last_write'])
+        longest_gap = (rows['time'] - last_write).max()
+        if rates.empty:
+            stacks_report_info[project + '-' + collector] = 'no rate measured'
+            continue
+        stacks_report_info[project + '-' + collector] = 'average {0} bytes/minute, lowest {1} bytes/minute, longest without new data {2}'.format(
+            int(rates.mean()), int(rates.min()), str(longest_gap).split('.')[0] if pd.notnull(longest_gap) else 'unknown')
+    return stacks_report_info
+
+
+def monitor_overhead_summary(log_dir=cfg.stats_archive_dir, today=None):
+    """
+    This function summarizes what ServerReport itself cost the day before today (a date, today's date by default; see
+     monitor_stats.py): its CPU time, its average and peak RSS, and the latest p50/p95 of each stage.
+    """
+    today = datetime.datetime.combine(today or datetime.date.today(), datetime.time())
+    yesterday = today - datetime.timedelta(days=1)
+    usage = load_log('monitor_log', yesterday, log_dir)
+    if usage is None:
+        return '**No monitor log file!**'
+    usage = usage[usage['time'] < today]
+    if usage.empty:
+        return '**No monitor information for {}**'.format(yesterday.date())
+    monitor_report_info = {
+        'CPU time': '{0} seconds ({1}% of one core)'.format(round(usage['cpu_seconds'].sum(), 1), round(usage['cpu_percent'].mean(), 3)),
+        'RSS': 'average {0}MB, peak {1}MB'.format(round(usage['rss_mb'].mean(), 1), round(usage['rss_mb'].max(), 1))
+    }
+    stages = load_log('monitor_stages', yesterday, log_dir)
+    if stages is not None:
+        stages = stages[stages['time'] < today]
+        for stage, rows in stages.groupby('stage'):
+            latest = rows.iloc[-1]
+            monitor_report_info[stage] = 'p50 {0}s, p95 {1}s'.format(latest['p50_seconds'], latest['p95_seconds'])
+    return monitor_report_info
+
+
+def send_daily_email(computer_stats, process_stats, stacks_stats=None, monitor_stats=None, email_recipients=cfg.daily_status_email_recipients):
+    """
+    This function builds the daily email (see build_daily_email) and puts it in the mail spool.
+    """
+    msg = build_daily_email(computer_stats, process_stats, stacks_stats, monitor_stats, email_recipients)
+    spool_message(msg)
+
+
+def build_daily_email(computer_stats, process_stats, stacks_stats=None, monitor_stats=None, email_recipients=cfg.daily_status_email_recipients, today=None):
+    """
+    email_recipients should be a list.
+    This assumes that the email will be sent using a gmail account
+    It returns the finished message for the report of today (a date, today's date by default). The chart is read into
+     the message, and its file deleted.
+    """
+    if not type(email_recipients) is list:
+        raise Exception("Email recipients must be in a list")
+    status = 'OK'
+    today = today or datetime.date.today()
+    yesterday = (today - datetime.timedelta(days=1)).isoformat()
+
+    email_text = cfg.server_name + ' status report for ' + yesterday + '\n '
+    if type(computer_stats) is tuple:
+        status = computer_stats[1]
+        computer_stats = computer_stats[0]
+
+    if type(computer_stats) is str:
+        email_text += '\n' + computer_stats
+    elif type(computer_stats) is dict:
+        for f in computer_stats:
+            email_text += '\n '
+            email_text += f + ': ' + computer_stats[f]
+
+    if process_stats:
+        email_text += '\n'
+        if type(process_stats) is dict:
+            for f in process_stats:
+                email_text += '\n '
+                email_text += f + ': \n\t\t\t' + str(process_stats[f])
+        else:
+            email_text += process_stats
+
+    if stacks_stats:
+        email_text += '\n\n STACKS ingest rates:'
+        if type(stacks_stats) is dict:
+            for f in stacks_stats:
+                email_text += '\n ' + f + ': ' + stacks_stats[f]
+        else:
+            email_text += '\n ' + stacks_stats
+
+    if monitor_stats:
+        email_text += '\n\n Monitor overhead:'
+        if type(monitor_stats) is dict:
+            for f in monitor_stats:
+                email_text += '\n ' + f + ': ' + monitor_stats[f]
+        else:
+            email_text += '\n ' + monitor_stats
+
+    plot = None
+    if cfg.charts_in_status_email and os.path.isfile(cfg.stats_archive_dir + 'plots/' + yesterday + '.png'):
+        plot = cfg.stats_archive_dir + 'plots/' + yesterday + '.png'
+
+    # Long and arduous process to embed images in the email.
+    msg = MIMEMultipart('related')
+    msg['Subject'] = '{0}: Status {1}'.format(cfg.server_name, status)
+    msg['From'] = cfg.account_to_send_emails + '@gmail.com'
+    msg['To'] = ", ".join(email_recipients)
+    msg.attach(MIMEText(email_text))
+
+    email_alternative = MIMEMultipart('alternative')
+    msg.attach(email_alternative)
+    msgText = MIMEText('\n\n\nThis message is meant to contain an image.\n')
+    email_alternative.attach(msgText)
+
+    if plot:
+        with open(plot, 'rb') as fp:
+            img = MIMEImage(fp.read())
+        img.add_header('Content-ID', '<image{}>'.format(1))
+        img.add_header('Content-Disposition', 'attachment', filename=cfg.server_name)
+        email_alternative.attach(img)
+
+    if plot:
+        os.remove(plot)
+    logging.info(today.isoformat() + ':  {0}: Status {1}'.format(cfg.server_name, status))
+    return msg
+
+
+def build_daily_report(snapshot):
+    """
+    This function builds the whole daily report. It runs in the report worker process (see report_worker.py), with
+     snapshot holding what it needs from the monitor's memory: the processes to summarize and their accumulators for
+     the previous day, and the date of the report, so a report that runs past midnight still covers the same day.
+    It returns the finished email, the averages to check against the warning thresholds (see warning_stats) and the
+     time each stage took, structured as stage: [seconds].
+    """
+    today = datetime.date.fromisoformat(snapshot['date'])
+    yesterday = (today - datetime.timedelta(days=1)).isoformat()
+    for process, day in snapshot['accumulators'].items():
+        if day is not None:
+            process_accumulators.setdefault(process, {})[yesterday] = day
+    stacks_stats = stacks_ingest_summary(today=today) if cfg.check_stacks else None
+    with stage_timer('daily_email_contents'):
+        computer_stats = daily_email_contents(today=today)
+    process_stats = False
+    if snapshot['processes']:
+        with stage_timer('prepare_process_summary'):
+            process_stats = prepare_process_summary(snapshot['processes'], today)
+    with stage_timer('build_daily_email'):
+        msg = build_daily_email(computer_stats=computer_stats, process_stats=process_stats, stacks_stats=stacks_stats,
+                                monitor_stats=monitor_overhead_summary(today=today), today=today)
+    timings = dict((stage, list(seconds)) for stage, seconds in stage_timings.items())
+    return {'message': msg, 'warning_stats': warning_stats(computer_stats), 'timings': timings}
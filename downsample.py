@@ -0,0 +1,88 @@
+"""
+This module thins out long time series before they are plotted, so plots take the same time to draw (and make files of
+ the same size) however much history they cover.
+
+Two shape-preserving methods are available:
+    minmax: keeps the lowest and highest point in each of max_points/2 equal-sized buckets, so spikes are never lost
+    lttb: Largest-Triangle-Three-Buckets, keeps the point in each bucket that best preserves the visual shape of the line
+"""
+
+import warnings
+
+import numpy as np
+
+
+def _as_numbers(times):
+    times = np.asarray(times)
+    if np.issubdtype(times.dtype, np.datetime64):
+        return times.astype('datetime64[ns]').astype(np.int64).astype(np.float64)
+    return times.astype(np.float64)
+
+
+def minmax_indices(values, max_points):
+    """
+    This function returns the (sorted) positions of the lowest and highest value in each bucket.
+    Missing values (NaN) are never picked over real ones.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    n_buckets = max(max_points // 2, 1)
+    bucket_size = -(-n // n_buckets)
+    padded = np.full(n_buckets * bucket_size, np.nan)
+    padded[:n] = values
+    buckets = padded.reshape(n_buckets, bucket_size)
+    missing = np.isnan(buckets)
+    lows = np.where(missing, np.inf, buckets).argmin(axis=1)
+    highs = np.where(missing, -np.inf, buckets).argmax(axis=1)
+    offsets = np.arange(n_buckets) * bucket_size
+    indices = np.unique(np.concatenate([offsets + lows, offsets + highs]))
+    return indices[indices < n]
+
+
+def lttb_indices(times, values, max_points):
+    """
+    This function returns the (sorted) positions picked by Largest-Triangle-Three-Buckets.
+    The first and last points are always kept.
+    """
+    x = _as_numbers(times)
+    y = np.asarray(values, dtype=np.float64)
+    n = len(y)
+    edges = np.linspace(1, n - 1, max_points - 1).astype(np.int64)
+    indices = np.empty(max_points, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    previous = 0
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)      # nanmean of a bucket with no values is NaN, and that's fine
+        for i in range(max_points - 2):
+            start, end = edges[i], edges[i + 1]
+            if i + 2 < len(edges):
+                next_x = np.nanmean(x[edges[i + 1]:edges[i + 2]])
+                next_y = np.nanmean(y[edges[i + 1]:edges[i + 2]])
+            else:
+                next_x, next_y = x[n - 1], y[n - 1]
+            areas = np.abs((x[previous] - next_x) * (y[start:end] - y[previous]) - (x[previous] - x[start:end]) * (next_y - y[previous]))
+            if end <= start or np.all(np.isnan(areas)):
+                previous = start
+            else:
+                previous = start + np.nanargmax(areas)
+            indices[i + 1] = previous
+    return np.unique(indices)
+
+
+def downsample(times, values, max_points, method='minmax'):
+    """
+    This function returns times and values thinned out to about max_points points, using the method given.
+    Series that are already short enough are returned as they are.
+    """
+    times = np.asarray(times)
+    values = np.asarray(values, dtype=np.float64)
+    if not max_points or len(values) <= max_points or max_points < 4:
+        return times, values
+    if method == 'lttb':
+        indices = lttb_indices(times, values, max_points)
+    elif method == 'minmax':
+        indices = minmax_indices(values, max_points)
+    else:
+        raise Exception("Unknown downsampling method: {}".format(method))
+    return times[indices], values[indices]
@@ -0,0 +1,421 @@
+"""
+This module lets a group of servers report to one place.
+
+Agent (ServerReport.py with cfg.fleet_mode = 'agent'):
+    After each stats check, the record (system stats, process stats and STACKS flags) is appended to
+     <stats_archive_dir>/fleet_buffer.jsonl. The buffer is then sent to the aggregator in batches of
+     cfg.fleet_batch_size records. A batch is removed from the buffer only once the aggregator acknowledges it, so
+     records pile up locally while the aggregator is down (up to cfg.fleet_buffer_max_records; the oldest are dropped
+     after that) and are sent when it comes back. Each record is numbered when it is buffered, so the aggregator can
+     skip records it already stored when an acknowledgement was lost and the batch was sent again. The agent keeps logging locally as usual, but leaves the threshold
+     warnings to the aggregator (unless cfg.fleet_agent_local_warnings is set) and doesn't send its own daily report.
+
+Aggregator (python fleet.py aggregate):
+    Listens on cfg.fleet_aggregator. Each server's records are written to <fleet_store_dir>/<server name>/, in the same
+     layout as a local stats archive (stats_log.csv and processes/, kept in day partitions, see archive.py), and
+     checked against the thresholds in the config file, with warnings emailed as "<server name>: ..." The fleet report
+     is emailed once a day, at cfg.daily_report_hour, and covers every server, including those that stopped reporting.
+
+Each batch is sent as a 4-byte big-endian length, the HMAC-SHA256 of the rest of the batch keyed with
+ cfg.fleet_secret, and zlib-compressed JSON:
+    {"server": <server name>, "agent": <agent id>, "records": [{"seq": <record number>, ...}, ...]}
+and the aggregator answers with a 4-byte big-endian count of the records it stored. The aggregator drops the
+ connection on a batch that isn't signed with its secret, or whose server or process names couldn't be used as
+ directory names (see safe_name).
+
+Several agents can be tried out on one machine by giving each its own config.py (different server_name and
+ stats_archive_dir) and pointing them at an aggregator on localhost.
+"""
+
+import datetime
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+import uuid
+import zlib
+
+import config as cfg
+
+MAX_BATCH_BYTES = 64 * 1024 * 1024
+MAX_BATCH_JSON_BYTES = 512 * 1024 * 1024     # A batch that decompresses to more than this is refused
+LENGTH = struct.Struct('>I')
+DIGEST_SIZE = hashlib.sha256().digest_size
+# Server and process names become directory names in the store, so they can't contain path separators or control
+#  characters, or be . or ..
+SAFE_NAME = re.compile(r'[^/\\\x00-\x1f]{1,255}')
+
+agent_state = {'failures': 0, 'next_attempt': 0, 'sequence': None}
+
+
+def _buffer_file(log_dir):
+    return os.path.join(log_dir, 'fleet_buffer.jsonl')
+
+
+def _read_json(json_file, default):
+    if not os.path.isfile(json_file):
+        return default
+    with open(json_file, 'r') as f:
+        return json.load(f)
+
+
+def _write_json(json_file, contents):
+    temp_file = json_file + '.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(contents, f)
+    os.replace(temp_file, json_file)
+
+
+def _secret():
+    if not cfg.fleet_secret:
+        raise Exception('fleet_secret must be set in config.py to use fleet mode')
+    return cfg.fleet_secret.encode()
+
+
+def _sign(data):
+    return hmac.new(_secret(), data, hashlib.sha256).digest()
+
+
+def safe_name(name):
+    """
+    This function checks that a server or process name sent by an agent can be used as a directory name in the store.
+    """
+    return type(name) is str and name not in ('.', '..') and SAFE_NAME.fullmatch(name) is not None
+
+
+def encode_batch(server_name, records, agent_id=None):
+    data = zlib.compress(json.dumps({'server': server_name, 'agent': agent_id, 'records': records}).encode())
+    payload = _sign(data) + data
+    return LENGTH.pack(len(payload)) + payload
+
+
+def _read_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed')
+        data += chunk
+    return data
+
+
+def read_batch(sock):
+    """
+    This function reads one batch from a socket and returns it as a dictionary, or None if the other end hung up.
+    The batch is only decompressed once its signature has been checked.
+    """
+    try:
+        size = LENGTH.unpack(_read_exactly(sock, LENGTH.size))[0]
+    except ConnectionError:
+        return None
+    if size > MAX_BATCH_BYTES:
+        raise Exception('Batch of {} bytes is too big'.format(size))
+    if size < DIGEST_SIZE:
+        raise Exception('Batch of {} bytes is too small to be signed'.format(size))
+    payload = _read_exactly(sock, size)
+    if not hmac.compare_digest(payload[:DIGEST_SIZE], _sign(payload[DIGEST_SIZE:])):
+        raise Exception('Batch is not signed with fleet_secret')
+    decompressor = zlib.decompressobj()
+    data = decompressor.decompress(payload[DIGEST_SIZE:], MAX_BATCH_JSON_BYTES)
+    if decompressor.unconsumed_tail:
+        raise Exception('Batch decompresses to more than {} bytes'.format(MAX_BATCH_JSON_BYTES))
+    return json.loads(data.decode())
+
+
+# Agent
+
+def _agent_sequence(log_dir):
+    """
+    This function returns this agent's id and the number of the last record it buffered, kept in fleet_sequence.json so
+     the numbers keep going up across restarts. A new id is made if the file is lost, which tells the aggregator to
+     start counting again.
+    """
+    if agent_state['sequence'] is None:
+        agent_state['sequence'] = _read_json(os.path.join(log_dir, 'fleet_sequence.json'),
+                                             {'agent': uuid.uuid4().hex, 'seq': 0})
+    return agent_state['sequence']
+
+
+def queue_record(record, log_dir=cfg.stats_archive_dir):
+    """
+    This function numbers one stats record and appends it to the local buffer.
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    sequence = _agent_sequence(log_dir)
+    sequence['seq'] += 1
+    _write_json(os.path.join(log_dir, 'fleet_sequence.json'), sequence)
+    record['seq'] = sequence['seq']
+    with open(_buffer_file(log_dir), 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def send_buffered(log_dir=cfg.stats_archive_dir):
+    """
+    This function sends the buffered records to the aggregator and removes the ones it acknowledged.
+    If the aggregator can't be reached, the next attempt waits twice as long as the last one (up to
+     cfg.mail_retry_max_seconds), so a dead aggregator doesn't slow every stats check down.
+    It returns the number of records sent.
+    """
+    buffer_file = _buffer_file(log_dir)
+    if not os.path.isfile(buffer_file) or time.time() < agent_state['next_attempt']:
+        return 0
+    with open(buffer_file, 'r') as f:
+        records = [json.loads(line) for line in f.read().splitlines() if line]
+    if len(records) > cfg.fleet_buffer_max_records:
+        logging.warning('Fleet buffer is full, dropping the oldest {} records'.format(len(records) - cfg.fleet_buffer_max_records))
+        records = records[-cfg.fleet_buffer_max_records:]
+    sent = 0
+    try:
+        with socket.create_connection(cfg.fleet_aggregator, timeout=cfg.fleet_timeout_seconds) as sock:
+            while sent < len(records):
+                batch = records[sent:sent + cfg.fleet_batch_size]
+                sock.sendall(encode_batch(cfg.server_name, batch, _agent_sequence(log_dir)['agent']))
+                stored = LENGTH.unpack(_read_exactly(sock, LENGTH.size))[0]
+                if stored != len(batch):
+                    raise ConnectionError('Aggregator stored {0} of {1} records'.format(stored, len(batch)))
+                sent += len(batch)
+        agent_state['failures'] = 0
+    except (OSError, ConnectionError) as e:
+        agent_state['failures'] += 1
+        delay = min(cfg.mail_retry_base_seconds * 2 ** (agent_state['failures'] - 1), cfg.mail_retry_max_seconds)
+        agent_state['next_attempt'] = time.time() + delay
+        logging.warning('Could not reach the fleet aggregator ({0}), {1} records buffered. Retrying in {2}s'.format(e, len(records) - sent, delay))
+
+    temp_file = buffer_file + '.tmp'
+    with open(temp_file, 'w') as f:
+        f.writelines(json.dumps(record) + '\n' for record in records[sent:])
+    os.replace(temp_file, buffer_file)
+    return sent
+
+
+def send_record(record, log_dir=cfg.stats_archive_dir):
+    queue_record(record, log_dir)
+    return send_buffered(log_dir)
+
+
+# Aggregator
+
+class FleetStore(object):
+    """
+    Writes the records from every server to the shared store, checks them against the thresholds and keeps the running
+     totals for the fleet report.
+    """
+
+    def __init__(self, store_dir=cfg.fleet_store_dir):
+        from thresholds import compile_rules
+        self.compile_rules = compile_rules
+        self.store_dir = store_dir
+        self.lock = threading.Lock()
+        self.servers = {}
+        self.summary_file = os.path.join(store_dir, 'fleet_day.json')
+        self.day = {'date': datetime.date.today().isoformat(), 'servers': {}}
+        if os.path.isfile(self.summary_file):
+            with open(self.summary_file, 'r') as f:
+                self.day = json.load(f)
+
+    def _server(self, server_name):
+        if server_name not in self.servers:
+            flags = {}
+            sequence_file = os.path.join(self.store_dir, server_name, 'fleet_sequence.json')
+            self.servers[server_name] = {'flags': flags, 'rules': self.compile_rules(flags), 'sequence_file': sequence_file,
+                                         'sequence': _read_json(sequence_file, {'agent': None, 'seq': 0})}
+        return self.servers[server_name]
+
+    def store(self, server_name, records, agent_id=None):
+        """
+        This function stores one batch of records from a server and returns the number acknowledged. A batch with a
+         server or process name that isn't a safe directory name (see safe_name) is refused as a whole.
+        Records numbered no higher than the last one stored from the same agent (see queue_record) were already stored,
+         from a batch whose acknowledgement was lost; they are acknowledged again but not stored twice.
+        Records for a day before the server's live partition (sent late from the agent's buffer) are moved into their day
+         partition once the batch is written (see archive.file_late_stats).
+        """
+        from archive import file_late_stats, load_manifest, rotate_archive
+        from server_checks import write_stats_logs
+        from stats_store import to_float
+        if not safe_name(server_name) or not all(safe_name(f) for record in records for f in record['processes']):
+            raise Exception('Refusing a batch with an unsafe server or process name from {!r}'.format(server_name))
+        server_dir = os.path.join(self.store_dir, server_name)
+        with self.lock:
+            sequence = self._server(server_name)['sequence']
+            if sequence['agent'] != agent_id:
+                sequence.update({'agent': agent_id, 'seq': 0})
+            late_processes = None          # The processes in records for a day that was already rotated
+            try:
+                for record in records:
+                    if record.get('seq') is not None and record['seq'] <= sequence['seq']:
+                        continue
+                    now = datetime.datetime.strptime(record['time'], '%Y-%m-%dT%H:%M:%S').replace(fold=record.get('fold', 0))
+                    rotate_archive(server_dir, now)
+                    if record['time'][:10] < (load_manifest(server_dir) or {}).get('live_date', ''):
+                        late_processes = (late_processes or set()) | set(record['processes'])
+                    write_stats_logs(server_dir, now, record['cpu'], record['ram'], record['hard_drive'], record['boot_drive'], record['processes'])
+                    if record.get('stacks') is not None:
+                        with open(os.path.join(server_dir, 'stacks_flags.json'), 'w') as f:
+                            json.dump(record['stacks'], f)
+                    self._check(server_name, record)
+                    self._add_to_day(server_name, record, to_float)
+                    if record.get('seq') is not None:
+                        sequence['seq'] = record['seq']
+                if late_processes is not None:
+                    file_late_stats(server_dir, sorted(late_processes))
+            finally:
+                self._save_day()
+                if agent_id is not None:
+                    os.makedirs(server_dir, exist_ok=True)
+                    _write_json(self._server(server_name)['sequence_file'], sequence)
+        return len(records)
+
+    def _check(self, server_name, record):
+        from thresholds import CRITICAL, check_stats
+        from mail_spool import queue_alert, flush_alerts
+        server = self._server(server_name)
+        mounts = dict(((f[0], f[1]), f[2]) for f in record.get('mounts', []))
+        warnings, new_warnings, level = check_stats(record['cpu'], record['ram'], record['hard_drive']['free_space'],
+                                                    record['boot_drive'], record['processes'], mounts, server['rules'])
+        if new_warnings:
+            warning_level = "Critical" if level == CRITICAL else "Warning"
+            logging.warning('{0}: {1}: {2}'.format(server_name, warning_level, '; '.join(warnings)))
+            queue_alert("{0}: {1} computer resources".format(server_name, warning_level), '\n'.join(new_warnings), cfg.warning_email_recipients)
+            flush_alerts()
+
+    def _add_to_day(self, server_name, record, to_float):
+        date = record['time'][:10]
+        if date > self.day['date']:
+            self.finish_day()
+            self.day = {'date': date, 'servers': {}}
+        elif date < self.day['date']:
+            return                  # Sent late, after its day was already finished
+        day = self.day['servers'].setdefault(server_name, {'count': 0, 'cpu_sum': 0, 'cpu_max': 0, 'ram_sum': 0,
+                                                           'ram_max': 0, 'min_free_space': None, 'boot_drive': None,
+                                                           'process_problems': {}, 'stacks_problems': 0})
+        day['last_seen'] = record['time']
+        cpu, ram, free_space = to_float(record['cpu']), to_float(record['ram']), to_float(record['hard_drive']['free_space'])
+        if cpu == cpu and ram == ram:
+            day['count'] += 1
+            day['cpu_sum'] += cpu
+            day['cpu_max'] = max(day['cpu_max'], cpu)
+            day['ram_sum'] += ram
+            day['ram_max'] = max(day['ram_max'], ram)
+        if free_space == free_space:
+            day['min_free_space'] = free_space if day['min_free_space'] is None else min(day['min_free_space'], free_space)
+        day['boot_drive'] = record['boot_drive']
+        for process, process_info in record['processes'].items():
+            if type(process_info) is list:
+                day['process_problems'][process] = day['process_problems'].get(process, 0) + 1
+        stacks = record.get('stacks') or {}
+        if stacks.get('stacks_dir') or [f for p in stacks.get('projects', {}).values() for f in p.values() if f]:
+            day['stacks_problems'] += 1
+
+    def _save_day(self):
+        os.makedirs(self.store_dir, exist_ok=True)
+        _write_json(self.summary_file, self.day)
+
+    def finish_day(self):
+        """
+        This function appends the day's totals to fleet_days.jsonl, where send_fleet_report reads them.
+        """
+        with open(os.path.join(self.store_dir, 'fleet_days.jsonl'), 'a') as f:
+            f.write(json.dumps(self.day) + '\n')
+
+    def read_day(self, date):
+        if self.day['date'] == date:
+            return self.day
+        days_file = os.path.join(self.store_dir, 'fleet_days.jsonl')
+        if os.path.isfile(days_file):
+            with open(days_file, 'r') as f:
+                for line in f:
+                    day = json.loads(line)
+                    if day['date'] == date:
+                        return day
+        return None
+
+
+def fleet_report_text(day, known_servers):
+    """
+    This function writes the fleet report for one day: a line per server, and the servers that didn't report at all.
+    """
+    email_text = 'Fleet status report for {}\n'.format(day['date'] if day else 'yesterday')
+    servers = day['servers'] if day else {}
+    for server_name in sorted(servers):
+        s = servers[server_name]
+        email_text += '\n {0} (last seen {1})'.format(server_name, s['last_seen'])
+        if s['count']:
+            email_text += '\n\tCPU average {0}%, max {1}%. RAM average {2}%, max {3}%'.format(
+                round(s['cpu_sum'] / s['count'], 2), round(s['cpu_max'], 2), round(s['ram_sum'] / s['count'], 2), round(s['ram_max'], 2))
+        email_text += '\n\tLowest free hard drive space {0}G, boot drive {1}% used'.format(s['min_free_space'], s['boot_drive'])
+        for process, problems in s['process_problems'].items():
+            email_text += '\n\t{0}: not running (or ambiguous) in {1} checks'.format(process, problems)
+        if s['stacks_problems']:
+            email_text += '\n\tSTACKS problems in {} checks'.format(s['stacks_problems'])
+    missing = sorted(set(known_servers) - set(servers))
+    if missing:
+        email_text += '\n\n No stats from: ' + ', '.join(missing)
+    return email_text
+
+
+def send_fleet_report(fleet_store, email_recipients=cfg.daily_status_email_recipients):
+    from mail_spool import build_message, spool_message
+    yesterday = (datetime.date.today() - datetime.timedelta(days=1)).isoformat()
+    with fleet_store.lock:
+        day = fleet_store.read_day(yesterday)
+        known_servers = [f for f in os.listdir(fleet_store.store_dir) if os.path.isdir(os.path.join(fleet_store.store_dir, f))]
+    status = 'OK'
+    if day is None or set(known_servers) - set(day['servers']):
+        status = 'Warning'
+    spool_message(build_message('Fleet: Status {}'.format(status), fleet_report_text(day, known_servers), email_recipients))
+
+
+class BatchHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                batch = read_batch(self.request)
+                if batch is None:
+                    return
+                stored = self.server.fleet_store.store(batch['server'], batch['records'], batch.get('agent'))
+            except Exception as e:
+                logging.warning('Dropping the connection from {0}: {1}'.format(self.client_address[0], e))
+                return
+            self.request.sendall(LENGTH.pack(stored))
+
+
+class AggregatorServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, fleet_store):
+        self.fleet_store = fleet_store
+        socketserver.ThreadingTCPServer.__init__(self, address, BatchHandler)
+
+
+def run_aggregator():
+    from mail_spool import start_mail_worker
+    from scheduler import Scheduler
+    _secret()
+    fleet_store = FleetStore()
+    os.makedirs(fleet_store.store_dir, exist_ok=True)
+    start_mail_worker()
+    scheduler = Scheduler()
+    scheduler.add_daily_job('fleet report', lambda: send_fleet_report(fleet_store), cfg.daily_report_hour,
+                            os.path.join(fleet_store.store_dir, 'last_fleet_report'), catch_up=cfg.daily_report_catch_up)
+    threading.Thread(target=scheduler.run_forever, name='fleet-report', daemon=True).start()
+    server = AggregatorServer(cfg.fleet_aggregator, fleet_store)
+    logging.info('Fleet aggregator listening on {0}:{1}'.format(*cfg.fleet_aggregator))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['aggregate']:
+        run_aggregator()
+    else:
+        print('usage: python fleet.py aggregate')
+        sys.exit(1)
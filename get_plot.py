@@ -1,22 +1,46 @@
 """
 This script is used to pull plots based on information generated by ServerReport. It is written to be highly interactive, so even folks who don't know enough python to use ServerReport can use this code to generate plots.
+
+Run without arguments, it asks what to plot and who to email it to. It can also be scripted:
+    python get_plot.py [--processes all|NAME,NAME] [--metrics cpu_percent,memory_percent] [--start DATE | --days N]
+                       [--end DATE] [--resolution SECONDS] [--png FILE] [--csv FILE] [--email ADDRESS,ADDRESS] [--no-cache]
+or used from Python, with query (a dataframe) and render (a PNG).
+Query results and rendered plots are cached under <stats_archive_dir>/cache/queries/, keyed by the query and the
+ modification times of the files it reads, so asking for the same plot again before the next stats check only reads
+ the cached result.
 """
 
 import matplotlib
 matplotlib.use('Agg')
 import smtplib
-from email.message import EmailMessage
 from email.mime.image import MIMEImage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import matplotlib.pyplot as plt
+import argparse
+import hashlib
+import io
+import json
 import os
+import pickle
+import sys
 import numpy as np
+import pandas as pd
 import datetime
 from dateutil.parser import parse
-import pandas as pd
 
 import config as cfg
+from archive import process_partitions, system_partitions
+from stats_loader import load_process_stats, load_system_stats
+from tiers import first_tier_time, pick_tier, series_file
+from downsample import downsample
+
+SYSTEM_METRIC_COLUMNS = {'% CPU use': 'cpu_percent', '% RAM used': 'memory_percent', '% hard drive used': 'hard_drive_percent',
+                         '% boot drive used': 'boot_drive_percent', 'time': 'report_time'}
+PROCESS_METRICS = ['cpu_percent', 'memory_percent']
+SYSTEM_METRICS = PROCESS_METRICS + ['hard_drive_percent', 'boot_drive_percent']
+METRIC_NAMES = {'cpu_percent': 'CPU', 'memory_percent': 'RAM', 'hard_drive_percent': 'hard drive use', 'boot_drive_percent': 'boot drive use'}
+LINE_TYPES = ['solid', 'dashed', 'dotted', 'dashdot']
 
 
 def build_process_list():
@@ -91,75 +115,195 @@ def ask_for_info():
     return to_email_addresses, processes_or_computer, start_date
 
 
-to_email_addresses, processes_or_computer, start_date = ask_for_info()
-
 '''
 Modify the printed process list to give numbers to each process. Then the prompt for which processes you want can be a comma separated list of process numbers rather than process names 
 '''
 
-def build_stats_dfs():
-    stats_dict = {}
-    if processes_or_computer == "computer":
-        stats = pd.read_csv(cfg.stats_archive_dir + '/stats_log.csv', parse_dates=['time'])
-        stats.rename(columns={'% CPU use': 'cpu_percent','% RAM used': 'memory_percent', 'time': 'report_time'}, inplace=True)
-        if start_date:
-            stats = stats[stats['report_time'] >= start_date]
-        stats_dict[processes_or_computer] = stats
-    elif type(processes_or_computer) is str:
-        daily_stats_files = os.listdir(os.path.join(cfg.stats_archive_dir, 'processes', processes_or_computer))
-        daily_stats_files = [os.path.join(cfg.stats_archive_dir, 'processes', processes_or_computer,f) for f in daily_stats_files if '-' in f]
-        stats = pd.DataFrame()
-        for file in daily_stats_files:
-            daily_stats = pd.read_csv(file)
-            daily_stats['report_time'] = pd.to_datetime(os.path.basename(file).replace('.csv','T') + daily_stats['report_time'])
-            stats = pd.concat([stats, daily_stats],ignore_index=True)
-        if start_date:
-            stats = stats[stats['report_time'] >= start_date]
-        stats_dict[processes_or_computer] = stats
-    elif type(processes_or_computer) is list:
-        for process in processes_or_computer:
-            stats = pd.DataFrame()
-            daily_stats_files = os.listdir(os.path.join(cfg.stats_archive_dir, 'processes', process))
-            daily_stats_files = [os.path.join(cfg.stats_archive_dir, 'processes', process, f) for f in daily_stats_files if '-' in f]
-            for file in daily_stats_files:
-                daily_stats = pd.read_csv(file)
-                daily_stats['report_time'] = pd.to_datetime(os.path.basename(file).replace('.csv', 'T') + daily_stats['report_time'])
-                stats = pd.concat([stats, daily_stats], ignore_index=True)
-            if start_date:
-                stats = stats[stats['report_time'] >= start_date]
-            stats_dict[process] = stats
+def _series_names(processes):
+    """
+    This function returns the series ('system' or 'processes/<process>') for 'computer', a process name or a list of
+     process names, structured as label: series.
+    """
+    if processes == "computer":
+        return {'computer': 'system'}
+    if type(processes) is str:
+        processes = [processes]
+    return dict((process, 'processes/' + process) for process in processes)
+
+
+def plot_resolution(series, start=None, end=None):
+    """
+    This function returns the time (in seconds) between points that the plot can show, given that each series is
+     thinned out to cfg.plot_max_points_per_series points, or None if there is nothing to go on.
+    """
+    first = start or first_tier_time(cfg.stats_archive_dir, series)
+    if not first:
+        return None
+    if type(first) is str:
+        first = datetime.datetime.strptime(first, '%Y-%m-%dT%H:%M:%S')
+    return ((end or datetime.datetime.now()) - first).total_seconds() / cfg.plot_max_points_per_series
 
+
+def load_series(processes, metrics, start=None, end=None, resolution=None):
+    """
+    This function loads the stats to plot (see stats_loader.py), structured as label: dataframe with a report_time
+     column and one column per metric. Days outside start to end are never read, and long ranges are read from the
+     downsampled tiers. resolution is the time (in seconds) wanted between points: None picks it from the length of
+     the range, 0 always reads every stats check.
+    """
+    stats_dict = {}
+    for label, series in _series_names(processes).items():
+        series_resolution = plot_resolution(series, start, end) if resolution is None else resolution
+        if series == 'system':
+            stats = load_system_stats(start, resolution=series_resolution, end_date=end)
+            stats = stats.rename(columns=SYSTEM_METRIC_COLUMNS)
+        else:
+            stats = load_process_stats(label, start, resolution=series_resolution, end_date=end)
+        for m in metrics:
+            stats[m] = pd.to_numeric(stats[m], errors='coerce')
+        stats_dict[label] = stats[['report_time'] + list(metrics)].sort_values('report_time')
     return stats_dict
 
 
+def _check_metrics(processes, metrics):
+    allowed = SYSTEM_METRICS if processes == "computer" else PROCESS_METRICS
+    for m in metrics:
+        if m not in allowed:
+            raise ValueError("Unknown metric {0}; choose from {1}".format(m, ', '.join(allowed)))
+
+
+def _source_files(processes, start, end, resolution):
+    """
+    This function returns the files a query reads, with their modification times and sizes, for the cache key.
+    """
+    log_dir = cfg.stats_archive_dir
+    files = []
+    for label, series in _series_names(processes).items():
+        series_resolution = plot_resolution(series, start, end) if resolution is None else resolution
+        width = pick_tier(series_resolution)
+        if width and os.path.isfile(series_file(log_dir, width, series)):
+            files += [series_file(log_dir, width, series), os.path.join(log_dir, 'tiers', 'current.json')]
+        else:
+            if series == 'system':
+                partitions = system_partitions(log_dir, start, end)
+            else:
+                partitions = process_partitions(log_dir, label, start, end)
+            files += [f['csv'] for f in partitions if f['csv']]
+    sources = []
+    for path in files:
+        try:
+            file_stat = os.stat(path)
+            sources.append((path, file_stat.st_mtime_ns, file_stat.st_size))
+        except FileNotFoundError:
+            sources.append((path, None, None))
+    return sources
+
+
+def _cached(kind, key, build):
+    """
+    This function returns the cached result of a query if its key (which includes its source files) hasn't changed,
+     or builds it with build() and caches it. kind is 'frame' (pickled) or 'png' (bytes).
+    """
+    cache_dir = os.path.join(cfg.stats_archive_dir, 'cache', 'queries')
+    name = hashlib.sha1(json.dumps([kind, key], default=str).encode()).hexdigest()
+    cache_file = os.path.join(cache_dir, name + ('.png' if kind == 'png' else '.pkl'))
+    if os.path.isfile(cache_file):
+        with open(cache_file, 'rb') as f:
+            return f.read() if kind == 'png' else pickle.load(f)
+    result = build()
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_file = cache_file + '.tmp'
+    with open(temp_file, 'wb') as f:
+        if kind == 'png':
+            f.write(result)
+        else:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_file, cache_file)
+    cached_files = sorted((os.path.join(cache_dir, f) for f in os.listdir(cache_dir)), key=os.path.getmtime)
+    for old_file in cached_files[:-cfg.plot_cache_max_files]:
+        os.remove(old_file)
+    return result
+
+
+def query(processes="computer", metrics=('cpu_percent', 'memory_percent'), start=None, end=None, resolution=None, use_cache=True):
+    """
+    This function returns stats as one dataframe, with a series column (the process, or "computer"), a report_time
+     column and one column per metric. processes is "computer", a process name or a list of process names; start and
+     end are datetimes (or None for no limit); see load_series for resolution.
+    """
+    metrics = list(metrics)
+    _check_metrics(processes, metrics)
+
+    def build():
+        stats_dict = load_series(processes, metrics, start, end, resolution)
+        frames = [stats.assign(series=label) for label, stats in stats_dict.items()]
+        if not frames:
+            return pd.DataFrame(columns=['series', 'report_time'] + metrics)
+        return pd.concat(frames, ignore_index=True)[['series', 'report_time'] + metrics]
+
+    if not use_cache:
+        return build()
+    key = [processes, metrics, start, end, resolution, _source_files(processes, start, end, resolution)]
+    return _cached('frame', key, build)
+
+
+def render(processes="computer", metrics=('cpu_percent', 'memory_percent'), start=None, end=None, resolution=None, use_cache=True):
+    """
+    This function plots the stats returned by query and returns the plot as PNG bytes.
+    Each series is given a color, and each metric a line type (CPU is solid and RAM dashed by default).
+    """
+    metrics = list(metrics)
+    _check_metrics(processes, metrics)
+
+    def build():
+        stats = query(processes, metrics, start, end, resolution, use_cache)
+        plot = plt.figure(figsize=(15,6))
+        plot1 = plot.add_subplot(121)
+        plot_colors = ["#208eb7", "#9e4f84", "#51825d", "#ce6552", "#7363e7", "#b825af", "#90705e", "#e91451", "#1c9820", "#8138fc", "#ab7b05"]
+        labels = list(_series_names(processes))
+        while len(plot_colors) < len(labels):
+            plot_colors.extend(plot_colors)
+
+        for f, label in enumerate(labels):
+            series_stats = stats[stats['series'] == label]
+            for n, m in enumerate(metrics):
+                times, values = downsample(series_stats['report_time'].values, series_stats[m].values, cfg.plot_max_points_per_series, cfg.plot_downsample_method)
+                plot1.plot_date(times, values, color=plot_colors[f], ls=LINE_TYPES[n % len(LINE_TYPES)], label=label if n == 0 else '_nolegend_', marker=None)
+
+        plot.autofmt_xdate()
+        plot.legend(loc='right')
+        y_label = '\n\n'.join('{0} line is {1}'.format(LINE_TYPES[n % len(LINE_TYPES)], METRIC_NAMES[m]) for n, m in enumerate(metrics))
+        plot1.set_ylabel(y_label, labelpad=50).set_rotation(0)
+        png = io.BytesIO()
+        plot.savefig(png, format='png')
+        plt.close(plot)
+        return png.getvalue()
+
+    if not use_cache:
+        return build()
+    key = [processes, metrics, start, end, resolution, cfg.plot_max_points_per_series, cfg.plot_downsample_method,
+           _source_files(processes, start, end, resolution)]
+    return _cached('png', key, build)
+
+
+def build_stats_dfs():
+    """
+    This function loads the stats for the plot asked for at the prompts.
+    """
+    return load_series(processes_or_computer, PROCESS_METRICS, start_date or None)
+
+
 def make_plots():
-    stats_dict = build_stats_dfs()
-    plot = plt.figure(figsize=(15,6))
-    plot1 = plot.add_subplot(121)
-    plot_line_types = ['solid', 'dashed']
-    plot_colors = ["#208eb7", "#9e4f84", "#51825d", "#ce6552", "#7363e7", "#b825af", "#90705e", "#e91451", "#1c9820", "#8138fc", "#ab7b05"]
-    while len(plot_colors) < len(stats_dict):
-        plot_colors.extend(plot_colors)
-
-    processes = list(stats_dict.keys())
-    for f in range(len(stats_dict)):
-        stats = stats_dict[processes[f]]
-        stats.sort_values('report_time', inplace=True)
-        plot1.plot_date(stats['report_time'], stats['cpu_percent'], color=plot_colors[f], ls=plot_line_types[0], label=processes[f] ,marker=None)
-        plot1.plot_date(stats['report_time'], stats['memory_percent'], color=plot_colors[f], ls=plot_line_types[1], label='_nolegend_', marker=None)
-
-    plot.autofmt_xdate()
-    plot.legend(loc='right')
-    plot1.set_ylabel("solid line is CPU\n\ndashed line is RAM", labelpad=50).set_rotation(0)
+    """
+    This function renders the plot asked for at the prompts to temp.png.
+    """
     fig_name = 'temp.png'
-    plot.savefig(fig_name)
-    plt.close('all')
-
+    with open(fig_name, 'wb') as f:
+        f.write(render(processes_or_computer, start=start_date or None))
     return fig_name
 
 
-def email_plots():
-    fig_name = make_plots()
+def email_png(png, to_email_addresses):
     email_text = 'Requested plots for {}'.format(cfg.server_name)
 
     msg = MIMEMultipart('related')
@@ -173,8 +317,7 @@ def email_plots():
     msgText = MIMEText('\n\n\nThis message is meant to contain an image.\n')
     email_alternative.attach(msgText)
 
-    with open(fig_name, 'rb') as plot:
-        img = MIMEImage(plot.read())
+    img = MIMEImage(png)
     img.add_header('Content-ID', '<image{}>'.format(1))
     img.add_header('Content-Disposition', 'attachment', filename='Requested plot from {}'.format(cfg.server_name))
     email_alternative.attach(img)
@@ -185,8 +328,60 @@ def email_plots():
     server.sendmail(msg['From'], to_email_addresses, msg.as_string())
     server.quit()
 
+    print('Email sent at {}'.format(datetime.datetime.now().isoformat()))
+
+
+def email_plots():
+    fig_name = make_plots()
+    with open(fig_name, 'rb') as plot:
+        email_png(plot.read(), to_email_addresses)
     os.remove(fig_name)
 
-    print('Email sent at {}'.format(datetime.datetime.now().isoformat()))
 
-run = email_plots()
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Plot or export the stats logged by ServerReport. Run without arguments to be asked what to plot.')
+    parser.add_argument('--processes', default='computer', help='"computer" (the default), "all", or a comma separated list of processes')
+    parser.add_argument('--metrics', default='cpu_percent,memory_percent', help='comma separated: ' + ', '.join(SYSTEM_METRICS) + ' (the last two for the computer only)')
+    parser.add_argument('--start', type=parse, help='the first date (and time) to include')
+    parser.add_argument('--days', type=int, help='start this many days before today, at midnight')
+    parser.add_argument('--end', type=parse, help='the last date (and time) to include')
+    parser.add_argument('--resolution', type=float, help='seconds between points; 0 reads every stats check (default: picked from the range)')
+    parser.add_argument('--png', help='write the plot to this file')
+    parser.add_argument('--csv', help='write the stats to this file ("-" for stdout)')
+    parser.add_argument('--email', help='email the plot to these comma separated addresses')
+    parser.add_argument('--no-cache', action='store_true', help="don't use or update the cache")
+    args = parser.parse_args(args)
+
+    processes = args.processes
+    if processes == 'all':
+        processes = list(build_process_list().values())
+    elif processes != 'computer':
+        processes = [f.strip() for f in processes.split(',') if f.strip()]
+    start = args.start
+    if args.days is not None:
+        start = datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days=args.days), datetime.time())
+    metrics = [f.strip() for f in args.metrics.split(',') if f.strip()]
+    options = dict(start=start, end=args.end, resolution=args.resolution, use_cache=not args.no_cache)
+    try:
+        _check_metrics(processes, metrics)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.csv or not (args.png or args.email):
+        stats = query(processes, metrics, **options)
+        stats.to_csv(sys.stdout if args.csv in (None, '-') else args.csv, index=False)
+    if args.png or args.email:
+        png = render(processes, metrics, **options)
+        if args.png:
+            with open(args.png, 'wb') as f:
+                f.write(png)
+        if args.email:
+            email_png(png, [f.strip() for f in args.email.split(',')])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main()
+    else:
+        to_email_addresses, processes_or_computer, start_date = ask_for_info()
+        run = email_plots()
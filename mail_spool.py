@@ -0,0 +1,241 @@
+"""
+This module sends every email ServerReport produces.
+Messages are written to an on-disk spool (cfg.mail_spool_dir), and a background thread delivers them over a single
+ SMTP connection that stays open between messages. If the mail server can't be reached, the message stays in the spool
+ and delivery is retried with exponential backoff, so a slow or broken mail server never holds up the stats checks.
+
+Alerts raised during one stats check are buffered with queue_alert and merged into a single email per recipient list
+ by flush_alerts, which run() calls at the end of each check.
+"""
+
+import datetime
+import logging
+import os
+import smtplib
+import threading
+import time
+import uuid
+from email.message import EmailMessage
+from email.parser import BytesHeaderParser
+
+import config as cfg
+from monitor_stats import stage_timer
+
+pending_alerts = []
+alerts_lock = threading.Lock()
+wake_event = threading.Event()
+stop_event = threading.Event()
+retry_state = {}
+connection = {'server': None, 'last_used': 0}
+worker = None
+
+
+def build_message(subject, text, email_recipients):
+    """
+    This function builds a plain text email from the account in the config file.
+    """
+    if not type(email_recipients) is list:
+        raise Exception("Email recipients must be in a list")
+    email = EmailMessage()
+    email.set_content(text)
+    email['Subject'] = subject
+    email['From'] = cfg.account_to_send_emails + '@gmail.com'
+    email['To'] = ", ".join(email_recipients)
+    return email
+
+
+def spool_message(msg):
+    """
+    This function writes a finished message (EmailMessage or MIMEMultipart) to the spool and wakes the delivery thread.
+    The file is written under a temporary name and renamed, so the delivery thread never sees half a message.
+    """
+    os.makedirs(cfg.mail_spool_dir, exist_ok=True)
+    name = '{0}-{1}.eml'.format(datetime.datetime.now().strftime('%Y%m%dT%H%M%S%f'), uuid.uuid4().hex[:8])
+    temp_file = os.path.join(cfg.mail_spool_dir, '.' + name + '.tmp')
+    with open(temp_file, 'wb') as f:
+        f.write(msg.as_bytes())
+    os.replace(temp_file, os.path.join(cfg.mail_spool_dir, name))
+    wake_event.set()
+    return name
+
+
+def queue_alert(subject, text, email_recipients):
+    """
+    This function buffers an alert until the end of the current stats check (see flush_alerts).
+    """
+    if not type(email_recipients) is list:
+        raise Exception("Email recipients must be in a list")
+    with alerts_lock:
+        pending_alerts.append((subject, text, list(email_recipients)))
+
+
+def flush_alerts():
+    """
+    This function spools the alerts buffered since the last call. Alerts for the same recipients are merged into one
+     email; its subject is Critical if any of the merged alerts is critical.
+    """
+    with alerts_lock:
+        alerts = pending_alerts[:]
+        del pending_alerts[:]
+    by_recipients = {}
+    for subject, text, email_recipients in alerts:
+        by_recipients.setdefault(tuple(email_recipients), []).append((subject, text))
+    for email_recipients, recipient_alerts in by_recipients.items():
+        if len(recipient_alerts) == 1:
+            subject, text = recipient_alerts[0]
+        else:
+            level = 'Warning'
+            if [f for f in recipient_alerts if 'Critical' in f[0]]:
+                level = 'Critical'
+            subject = '{0}: {1} - {2} alerts'.format(cfg.server_name, level, len(recipient_alerts))
+            text = '\n\n'.join(['== {0} ==\n{1}'.format(f[0], f[1]) for f in recipient_alerts])
+        spool_message(build_message(subject, text, list(email_recipients)))
+
+
+def get_connection():
+    """
+    This function returns the open SMTP connection, opening and logging in first if there isn't one.
+    A connection that has been idle for a while is checked with NOOP before it is reused.
+    """
+    server = connection['server']
+    if server is not None and time.time() - connection['last_used'] > 30:
+        try:
+            if server.noop()[0] != 250:
+                raise smtplib.SMTPServerDisconnected('NOOP failed')
+        except (smtplib.SMTPException, OSError):
+            close_connection()
+            server = None
+    if server is None:
+        server = smtplib.SMTP(cfg.email_server[0], cfg.email_server[1], timeout=cfg.mail_timeout_seconds)
+        if cfg.email_use_starttls:
+            server.starttls()
+        if cfg.password_to_send_emails:
+            server.login(cfg.account_to_send_emails, cfg.password_to_send_emails)
+        connection['server'] = server
+    connection['last_used'] = time.time()
+    return server
+
+
+def close_connection():
+    server = connection['server']
+    connection['server'] = None
+    if server is not None:
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+
+def _permanent(e):
+    """
+    This function returns True if the mail server's rejection is permanent (a 5xx reply, or a message the server can't
+     take at all, e.g. non-ASCII addresses without SMTPUTF8). Temporary rejections (4xx, e.g. rate limits or
+     greylisting) are retried. A message every recipient was refused for is only permanent if every refusal was.
+    """
+    if isinstance(e, smtplib.SMTPNotSupportedError):
+        return True
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, message in e.recipients.values())
+    return e.smtp_code >= 500
+
+
+def _schedule_retry(name, e):
+    close_connection()
+    attempts = retry_state.get(name, {'attempts': 0})['attempts'] + 1
+    delay = min(cfg.mail_retry_base_seconds * 2 ** (attempts - 1), cfg.mail_retry_max_seconds)
+    retry_state[name] = {'attempts': attempts, 'next_attempt': time.time() + delay}
+    logging.warning('Could not send {0} (attempt {1}), retrying in {2} seconds: {3}'.format(name, attempts, delay, e))
+
+
+def _move_to_failed(name):
+    failed_dir = os.path.join(cfg.mail_spool_dir, 'failed')
+    os.makedirs(failed_dir, exist_ok=True)
+    os.replace(os.path.join(cfg.mail_spool_dir, name), os.path.join(failed_dir, name))
+    retry_state.pop(name, None)
+
+
+def deliver_spool():
+    """
+    This function tries to send every spooled message that is due. Sent messages are deleted from the spool; recipients
+     the server refused while accepting the message for the others are logged.
+    Messages the server rejects permanently (5xx), and files without a sender or recipients, are moved to the "failed"
+     folder in the spool, so they don't hold up the messages behind them. If the connection fails or the server rejects
+     the message temporarily (4xx), the message is scheduled for a retry and delivery stops until the next attempt.
+    """
+    if not os.path.isdir(cfg.mail_spool_dir):
+        return
+    for name in sorted(f for f in os.listdir(cfg.mail_spool_dir) if f.endswith('.eml')):
+        if name in retry_state and retry_state[name]['next_attempt'] > time.time():
+            continue
+        message_file = os.path.join(cfg.mail_spool_dir, name)
+        with open(message_file, 'rb') as f:
+            message_bytes = f.read()
+        headers = BytesHeaderParser().parsebytes(message_bytes)
+        email_recipients = [f.strip() for f in (headers['To'] or '').split(',') if f.strip()]
+        if not headers['From'] or not email_recipients:
+            logging.error("Can't send {}: it has no From or To header".format(name))
+            _move_to_failed(name)
+            continue
+        try:
+            server = get_connection()
+            with stage_timer('email send'):
+                refused = server.sendmail(headers['From'], email_recipients, message_bytes)
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError,
+                smtplib.SMTPNotSupportedError) as e:
+            if not _permanent(e):
+                _schedule_retry(name, e)
+                return
+            logging.error('Mail server rejected {0}: {1}'.format(name, e))
+            _move_to_failed(name)
+            continue
+        except (smtplib.SMTPException, OSError) as e:
+            _schedule_retry(name, e)
+            return
+        if refused:
+            logging.warning('Mail server refused some recipients of {0}: {1}'.format(name, refused))
+        os.remove(message_file)
+        retry_state.pop(name, None)
+        logging.info('Sent email: {}'.format(headers['Subject']))
+
+
+def seconds_until_next_attempt():
+    if not retry_state:
+        return cfg.mail_keepalive_seconds
+    next_attempt = min(f['next_attempt'] for f in retry_state.values())
+    return max(0, min(next_attempt - time.time(), cfg.mail_keepalive_seconds))
+
+
+def _mail_loop():
+    while not stop_event.is_set():
+        wake_event.clear()
+        try:
+            deliver_spool()
+        except Exception as e:
+            logging.exception(e)
+        if connection['server'] is not None and time.time() - connection['last_used'] > cfg.mail_keepalive_seconds:
+            close_connection()
+        wake_event.wait(seconds_until_next_attempt())
+    deliver_spool()
+    close_connection()
+
+
+def start_mail_worker():
+    """
+    This function starts the delivery thread. Anything left in the spool from a previous run is sent first.
+    """
+    global worker
+    if worker and worker.is_alive():
+        return
+    stop_event.clear()
+    worker = threading.Thread(target=_mail_loop, name='mail-spool', daemon=True)
+    worker.start()
+
+
+def stop_mail_worker(timeout=None):
+    """
+    This function makes one last delivery attempt, closes the connection and stops the delivery thread.
+    """
+    stop_event.set()
+    wake_event.set()
+    if worker:
+        worker.join(timeout)
@@ -0,0 +1,190 @@
+"""
+This module serves ServerReport's latest stats over HTTP, so other tools can poll them instead of re-reading
+ stats_log.csv.
+
+If cfg.metrics_server_port is set, ServerReport.py starts a small HTTP server on cfg.metrics_server_host (localhost by
+ default) in a background thread. It serves:
+    /metrics        the latest stats in the Prometheus text format
+    /metrics.json   the same stats as JSON, with numbers as numbers (sizes in GB) and unknown values as null
+Both are built once per stats check, by update_snapshot, and kept in memory. A request only copies out the bytes that
+ were already built, so it never reads the disk or touches psutil, and polling every few seconds costs next to nothing.
+"""
+
+import datetime
+import http.server
+import json
+import logging
+import math
+import threading
+import time
+
+import config as cfg
+from stats_store import to_float
+
+snapshot = {'json': b'{}', 'prometheus': b''}
+snapshot_lock = threading.Lock()
+metrics_server = {'server': None}
+
+# The stats served as numbers in /metrics.json (the other process and mount stats, like username, are text)
+PROCESS_NUMBERS = ('cpu_percent', 'memory_percent', 'memory_info')
+MOUNT_NUMBERS = ('free_space', 'percent_used', 'inode_percent')
+
+# name: help text, for every metric served
+METRIC_HELP = {
+    'serverreport_cpu_percent': 'Average CPU use since the previous stats check',
+    'serverreport_cpu_max_percent': 'Highest CPU use in a single sample since the previous stats check',
+    'serverreport_ram_percent': 'RAM in use',
+    'serverreport_disk_used_percent': 'Disk space in use',
+    'serverreport_disk_free_gigabytes': 'Free disk space',
+    'serverreport_disk_inodes_used_percent': 'Inodes in use',
+    'serverreport_process_up': '1 if exactly one process matches, 0 if none or several do',
+    'serverreport_process_cpu_percent': 'CPU use of a monitored process',
+    'serverreport_process_memory_percent': 'Memory use of a monitored process',
+    'serverreport_process_rss_gigabytes': 'Resident memory of a monitored process',
+    'serverreport_stacks_collector_ok': '1 if the collector has a data file for the current hour',
+    'serverreport_stacks_bytes_per_minute': 'Bytes the collector wrote per minute since the previous STACKS check',
+    'serverreport_mongo_up': '1 if MongoDB answered the last ping',
+    'serverreport_mongo_latency_ms': 'Round trip time of the last MongoDB ping',
+    'serverreport_last_update_timestamp_seconds': 'When these stats were collected'
+}
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus(samples):
+    """
+    This function renders a list of (metric name, labels dictionary, value) in the Prometheus text format. Samples
+     whose value is missing or unknown are left out.
+    """
+    by_name = {}
+    for name, labels, value in samples:
+        value = to_float(value) if value is not None else math.nan
+        if not math.isnan(value):
+            by_name.setdefault(name, []).append((labels, value))
+    lines = []
+    for name, name_samples in by_name.items():
+        lines.append('# HELP {0} {1}'.format(name, METRIC_HELP[name]))
+        lines.append('# TYPE {} gauge'.format(name))
+        for labels, value in name_samples:
+            label_text = ','.join('{0}="{1}"'.format(k, _label_value(v)) for k, v in labels.items())
+            lines.append('{0}{1} {2}'.format(name, '{' + label_text + '}' if label_text else '', repr(value)))
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def _number(value):
+    """
+    This function turns a logged value like "812.34G" into a number for the JSON stats, or None if it is missing or
+     unknown.
+    """
+    value = to_float(value) if value is not None else math.nan
+    return None if math.isnan(value) else value
+
+
+def update_snapshot(cpu, ram, hard_drive, boot_drive, processes, stacks=None, stacks_rates=None, mongo_latency=None, mongo_checked=False,
+                    mounts=None):
+    """
+    This function replaces the snapshot with the latest stats. The arguments are those passed to log_stats, plus the
+     latest STACKS flags and ingest rates (structured as (project, collector): bytes per minute) and the latest Mongo
+     ping (None if Mongo didn't answer), if those are checked.
+    Each mounted filesystem is served once: a mount in mounts replaces the root_dir or boot_drive samples for the same
+     mount point.
+    """
+    now = time.time()
+    stats = {'time': datetime.datetime.fromtimestamp(now).replace(microsecond=0).isoformat(),
+             'system': {'cpu_percent': _number(cpu['average']), 'cpu_max_percent': _number(cpu['max']), 'ram_percent': _number(ram),
+                        'hard_drive_used_percent': _number(hard_drive['percent_used']),
+                        'hard_drive_free_space': _number(hard_drive['free_space']), 'boot_drive_used_percent': _number(boot_drive)},
+             'processes': {}}
+    samples = [('serverreport_last_update_timestamp_seconds', {}, now),
+               ('serverreport_cpu_percent', {}, cpu['average']),
+               ('serverreport_cpu_max_percent', {}, cpu['max']),
+               ('serverreport_ram_percent', {}, ram)]
+    disks = {cfg.boot_drive: [('serverreport_disk_used_percent', boot_drive)],
+             cfg.root_dir: [('serverreport_disk_used_percent', hard_drive['percent_used']),
+                            ('serverreport_disk_free_gigabytes', hard_drive['free_space'])]}
+    if mounts:
+        stats['mounts'] = dict((mount_point, dict(mount_info, **dict((m, _number(mount_info[m])) for m in MOUNT_NUMBERS)))
+                               for mount_point, mount_info in mounts.items())
+        for mount_point, mount_info in mounts.items():
+            disks[mount_point] = [('serverreport_disk_used_percent', mount_info['percent_used']),
+                                  ('serverreport_disk_free_gigabytes', mount_info['free_space']),
+                                  ('serverreport_disk_inodes_used_percent', mount_info['inode_percent'] or None)]
+    for mount_point, disk_samples in disks.items():
+        samples.extend((name, {'mount': mount_point}, value) for name, value in disk_samples)
+    for process, process_info in processes.items():
+        labels = {'process': process}
+        if type(process_info) is dict:
+            stats['processes'][process] = dict(process_info, status='OK',
+                                               **dict((m, _number(process_info[m])) for m in PROCESS_NUMBERS))
+            samples.extend([('serverreport_process_up', labels, 1),
+                            ('serverreport_process_cpu_percent', labels, process_info['cpu_percent']),
+                            ('serverreport_process_memory_percent', labels, process_info['memory_percent']),
+                            ('serverreport_process_rss_gigabytes', labels, process_info['memory_info'])])
+        else:
+            status = process_info[1] or process_info[0]
+            stats['processes'][process] = {'status': status}
+            samples.append(('serverreport_process_up', labels, None if status == 'unknown' else 0))
+    if stacks is not None:
+        stats['stacks'] = {}
+        for project, collectors in stacks['projects'].items():
+            for collector, flag in collectors.items():
+                rate = (stacks_rates or {}).get((project, collector))
+                stats['stacks'][project + '-' + collector] = {'ok': flag == 0, 'bytes_per_minute': rate}
+                labels = {'project': project, 'collector': collector}
+                samples.append(('serverreport_stacks_collector_ok', labels, 0 if flag else 1))
+                samples.append(('serverreport_stacks_bytes_per_minute', labels, rate))
+    if mongo_checked:
+        stats['mongo'] = {'up': mongo_latency is not None, 'latency_ms': mongo_latency}
+        samples.append(('serverreport_mongo_up', {}, 0 if mongo_latency is None else 1))
+        samples.append(('serverreport_mongo_latency_ms', {}, mongo_latency))
+
+    json_bytes = json.dumps(stats).encode()
+    prometheus_bytes = render_prometheus(samples)
+    with snapshot_lock:
+        snapshot['json'] = json_bytes
+        snapshot['prometheus'] = prometheus_bytes
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/metrics':
+            content_type, key = 'text/plain; version=0.0.4; charset=utf-8', 'prometheus'
+        elif path == '/metrics.json':
+            content_type, key = 'application/json', 'json'
+        else:
+            self.send_error(404)
+            return
+        with snapshot_lock:
+            body = snapshot[key]
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(host=None, port=None):
+    """
+    This function starts the HTTP server in a background thread.
+    """
+    host = host or cfg.metrics_server_host
+    port = port if port is not None else cfg.metrics_server_port
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    metrics_server['server'] = server
+    logging.info('Serving metrics on http://{0}:{1}/metrics'.format(host, server.server_address[1]))
+    return server
+
+
+def stop_metrics_server():
+    if metrics_server['server'] is not None:
+        metrics_server['server'].shutdown()
+        metrics_server['server'].server_close()
+        metrics_server['server'] = None
@@ -0,0 +1,62 @@
+"""
+This module checks the health of MongoDB. It is only imported when a Mongo check runs, so the collector doesn't load
+ pymongo otherwise.
+
+One client is created the first time a check runs and kept for the life of the script. Each check sends a "ping"
+ command and times the round trip. Creating a client doesn't talk to the server, so only a ping can tell whether Mongo
+ is up. The server selection timeout is kept short (cfg.mongo_timeout_ms), so a dead server is noticed quickly.
+Latencies are logged to <stats_archive_dir>/mongo_log.csv (split into day partitions, see archive.py).
+"""
+
+import datetime
+import os
+import time
+
+import pymongo
+
+import config as cfg
+
+mongo_client = {'client': None}
+
+
+def get_client():
+    if mongo_client['client'] is None:
+        mongo_client['client'] = pymongo.MongoClient(cfg.mongo_uri,
+                                                     serverSelectionTimeoutMS=cfg.mongo_timeout_ms,
+                                                     connectTimeoutMS=cfg.mongo_timeout_ms,
+                                                     socketTimeoutMS=cfg.mongo_timeout_ms)
+    return mongo_client['client']
+
+
+def ping_mongo():
+    """
+    This function pings the Mongo server and returns the round trip time in milliseconds, or None if the server
+     didn't answer (or the client couldn't be created, e.g. because cfg.mongo_uri is invalid).
+    """
+    try:
+        client = get_client()
+        start = time.perf_counter()
+        client.admin.command('ping')
+    except pymongo.errors.PyMongoError:
+        return None
+    return round((time.perf_counter() - start) * 1000, 2)
+
+
+def log_mongo_latency(latency_ms, log_dir=cfg.stats_archive_dir):
+    """
+    This function appends one Mongo check to mongo_log.csv. A server that didn't answer is logged as "down" with no
+     latency.
+    """
+    now = datetime.datetime.now().replace(microsecond=0)
+    os.makedirs(log_dir, exist_ok=True)
+    log_file = os.path.join(log_dir, 'mongo_log.csv')
+    if latency_ms is None:
+        write_info = [now.isoformat(), 'down', '']
+    else:
+        write_info = [now.isoformat(), 'up', str(latency_ms)]
+    if os.path.isfile(log_file):
+        with open(log_file, 'a') as f:
+            f.write('\n' + ','.join(write_info))
+    else:
+        with open(log_file, 'w') as f:
+            f.write('time,status,latency_ms\n' + ','.join(write_info))
@@ -0,0 +1,138 @@
+"""
+This module measures ServerReport itself: how long each stage takes (each check, log_stats, each email sent, the parts
+ of the daily report), and how much CPU time and memory the monitor uses.
+
+Stages are timed with stage_timer. The last cfg.monitor_timing_window runs of each stage are kept, and each stats check
+ logs, for every stage, the median (p50) and 95th percentile (p95) of those runs to monitor_stages.csv. The CPU time
+ the monitor used since the last stats check and its RSS are logged to monitor_log.csv. Both logs are split into day
+ partitions (see archive.py).
+
+If cfg.monitor_profile_over_budget is set, the scheduled jobs run under cProfile (see profiled), and the profile of any
+ run that takes longer than cfg.monitor_budget_seconds is written to <stats_archive_dir>/profiles/, for reading with
+ pstats. Profiling slows the checks down, so it is meant to be turned on while looking into a slow check.
+"""
+
+import collections
+import contextlib
+import cProfile
+import datetime
+import logging
+import os
+import threading
+import time
+
+import psutil as p
+
+import config as cfg
+
+stage_timings = {}
+timings_lock = threading.Lock()
+profile_lock = threading.Lock()
+usage_state = {'process': p.Process(), 'cpu_seconds': None, 'time': None}
+
+
+def record_stage(stage, seconds):
+    with timings_lock:
+        timings = stage_timings.setdefault(stage, collections.deque(maxlen=cfg.monitor_timing_window))
+        timings.append(seconds)
+
+
+@contextlib.contextmanager
+def stage_timer(stage):
+    """
+    This context manager times the code inside it and records it as a run of stage, even if it raises an exception.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def percentile(values, q):
+    """
+    This function returns the q-th percentile (0-100) of values, using the nearest-rank method.
+    """
+    ordered = sorted(values)
+    rank = max(int(-(-q * len(ordered) // 100)), 1)
+    return ordered[rank - 1]
+
+
+def stage_summary():
+    """
+    This function returns a dictionary structured as stage: (runs kept, p50 seconds, p95 seconds).
+    """
+    with timings_lock:
+        timings = dict((stage, list(values)) for stage, values in stage_timings.items())
+    return dict((stage, (len(values), percentile(values, 50), percentile(values, 95))) for stage, values in timings.items() if values)
+
+
+def monitor_usage():
+    """
+    This function returns the CPU seconds the monitor used since the last call, that as a percentage of one core, and
+     the monitor's RSS in MB. The CPU numbers are None on the first call.
+    """
+    process = usage_state['process']
+    with process.oneshot():
+        cpu_times = process.cpu_times()
+        rss = process.memory_info().rss
+    cpu_seconds = cpu_times.user + cpu_times.system
+    now = time.monotonic()
+    used, percent = None, None
+    if usage_state['cpu_seconds'] is not None and now > usage_state['time']:
+        used = cpu_seconds - usage_state['cpu_seconds']
+        percent = 100 * used / (now - usage_state['time'])
+    usage_state['cpu_seconds'] = cpu_seconds
+    usage_state['time'] = now
+    return used, percent, rss / 1024 / 1024
+
+
+def _append_row(log_file, header, write_info):
+    if os.path.isfile(log_file):
+        with open(log_file, 'a') as f:
+            f.write('\n' + ','.join(write_info))
+    else:
+        with open(log_file, 'w') as f:
+            f.write(header + '\n' + ','.join(write_info))
+
+
+def log_monitor_stats(log_dir=cfg.stats_archive_dir):
+    """
+    This function appends the monitor's own CPU use and RSS to monitor_log.csv, and the p50/p95 of each stage to
+     monitor_stages.csv.
+    """
+    now = datetime.datetime.now().replace(microsecond=0).isoformat()
+    os.makedirs(log_dir, exist_ok=True)
+    used, percent, rss_mb = monitor_usage()
+    _append_row(os.path.join(log_dir, 'monitor_log.csv'), 'time,cpu_seconds,cpu_percent,rss_mb',
+                [now, '' if used is None else str(round(used, 3)), '' if percent is None else str(round(percent, 3)), str(round(rss_mb, 1))])
+    for stage, (runs, p50, p95) in sorted(stage_summary().items()):
+        _append_row(os.path.join(log_dir, 'monitor_stages.csv'), 'time,stage,runs,p50_seconds,p95_seconds',
+                    [now, stage, str(runs), str(round(p50, 4)), str(round(p95, 4))])
+
+
+def profiled(stage, func):
+    """
+    This function wraps func so each call is timed as stage. If cfg.monitor_profile_over_budget is set, each call also
+     runs under cProfile, and the profile is saved if the call took longer than cfg.monitor_budget_seconds. Only one
+     job is profiled at a time (Python allows one active profiler); jobs that run alongside it are only timed.
+    """
+    def run_stage(*args):
+        if not cfg.monitor_profile_over_budget or not profile_lock.acquire(blocking=False):
+            with stage_timer(stage):
+                return func(*args)
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            return profile.runcall(func, *args)
+        finally:
+            elapsed = time.perf_counter() - start
+            profile_lock.release()
+            record_stage(stage, elapsed)
+            if elapsed > cfg.monitor_budget_seconds:
+                profile_dir = os.path.join(cfg.stats_archive_dir, 'profiles')
+                os.makedirs(profile_dir, exist_ok=True)
+                profile_file = os.path.join(profile_dir, '{0}-{1}.prof'.format(stage.replace(' ', '_'), datetime.datetime.now().strftime('%Y%m%dT%H%M%S')))
+                profile.dump_stats(profile_file)
+                logging.warning('{0} took {1:.2f} seconds (budget {2}), profile saved to {3}'.format(stage, elapsed, cfg.monitor_budget_seconds, profile_file))
+    return run_stage
@@ -0,0 +1,126 @@
+"""
+This module finds the filesystems to watch and measures how full they are.
+
+The mount table is read from /proc/self/mounts once, and only read again when the kernel reports that it changed (the
+ file is pollable: it signals POLLPRI when something is mounted or unmounted), so a stats check normally doesn't read
+ or parse it at all. On systems without /proc/self/mounts, psutil's list of partitions is used on every check.
+Pseudo filesystems (proc, sysfs, tmpfs, cgroup, ...), the types in cfg.ignored_filesystem_types and the mount points
+ in cfg.ignored_mount_points (and everything under them) are skipped. A device mounted in several places (e.g. bind
+ mounts) is only measured once, at its shortest mount point.
+Like the stats checks, this module only uses psutil and the standard library.
+"""
+
+import os
+import re
+import select
+import threading
+import urllib.parse
+
+import psutil as p
+
+import config as cfg
+
+MOUNTS_FILE = '/proc/self/mounts'
+PSEUDO_FILESYSTEMS = {
+    'autofs', 'binfmt_misc', 'bpf', 'cgroup', 'cgroup2', 'configfs', 'debugfs', 'devfs', 'devpts', 'devtmpfs',
+    'efivarfs', 'fuse.gvfsd-fuse', 'fuse.portal', 'fusectl', 'hugetlbfs', 'mqueue', 'nsfs', 'proc', 'pstore', 'ramfs',
+    'rpc_pipefs', 'securityfs', 'selinuxfs', 'squashfs', 'sysfs', 'tmpfs', 'tracefs'
+}
+
+mount_table = {'file': None, 'poller': None, 'mounts': None}
+mount_table_lock = threading.Lock()
+
+
+def _unescape(field):
+    """
+    This function decodes the octal escapes (e.g. \\040 for a space) used in /proc/self/mounts.
+    """
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+
+def _ignored(mount_point, fs_type):
+    if fs_type in PSEUDO_FILESYSTEMS or fs_type in cfg.ignored_filesystem_types:
+        return True
+    for ignored in cfg.ignored_mount_points:
+        ignored = ignored.rstrip('/')
+        if mount_point == (ignored or '/') or mount_point.startswith(ignored + '/'):
+            return True
+    return False
+
+
+def select_mounts(entries):
+    """
+    This function returns the filesystems to watch out of entries (structured as (device, mount point, filesystem
+     type)), as a list of (mount point, device, filesystem type), sorted by mount point.
+    """
+    by_device = {}
+    for device, mount_point, fs_type in entries:
+        if _ignored(mount_point, fs_type):
+            continue
+        # A device without a path (e.g. "none") can't be shared with another mount, so it is kept by mount point
+        key = device if device.startswith('/') else mount_point
+        known = by_device.get(key)
+        if known is None or len(mount_point) < len(known[0]):
+            by_device[key] = (mount_point, device, fs_type)
+    return sorted(by_device.values())
+
+
+def parse_mounts(text):
+    """
+    This function returns the filesystems to watch from the contents of /proc/self/mounts (see select_mounts).
+    """
+    entries = []
+    for line in text.split('\n'):
+        fields = line.split()
+        if len(fields) >= 3:
+            entries.append((_unescape(fields[0]), _unescape(fields[1]), fields[2]))
+    return select_mounts(entries)
+
+
+def _read_mount_table():
+    mounts_file = mount_table['file']
+    if mounts_file is None:
+        mounts_file = mount_table['file'] = open(MOUNTS_FILE, 'r')
+        mount_table['poller'] = select.poll()
+        mount_table['poller'].register(mounts_file, select.POLLPRI | select.POLLERR)
+    else:
+        mounts_file.seek(0)
+    mount_table['mounts'] = parse_mounts(mounts_file.read())
+
+
+def list_mounts():
+    """
+    This function returns the filesystems to watch, as a list of (mount point, device, filesystem type). The mount table
+     is only read again when it has changed since the last call.
+    """
+    if not os.path.exists(MOUNTS_FILE):
+        return select_mounts((f.device, f.mountpoint, f.fstype) for f in p.disk_partitions(all=True))
+    with mount_table_lock:
+        if mount_table['mounts'] is None or mount_table['poller'].poll(0):
+            _read_mount_table()
+        return mount_table['mounts']
+
+
+def mount_usage(mount_point):
+    """
+    This function measures one filesystem. It returns a dictionary containing the free space (in GB, rounded to two
+     decimal points), the percentage of the space used and the percentage of the inodes used, or None for the inodes
+     of a filesystem that doesn't have a fixed number of them (e.g. btrfs).
+    The percentage used is computed the same way as df and psutil.disk_usage do: space reserved for root counts as
+     neither used nor free.
+    """
+    usage = os.statvfs(mount_point)
+    free = usage.f_bavail * usage.f_frsize
+    used = (usage.f_blocks - usage.f_bfree) * usage.f_frsize
+    percent_used = 100.0 * used / (used + free) if used + free else 0.0
+    inode_percent = None
+    if usage.f_files:
+        inode_percent = round(100.0 * (usage.f_files - usage.f_ffree) / usage.f_files, 2)
+    return {'free_space': round(free / 1024 ** 3, 2), 'percent_used': round(percent_used, 2), 'inode_percent': inode_percent}
+
+
+def series_name(mount_point):
+    """
+    This function returns the name used for a mount point's log directory, e.g. "%2Fdata%2Fmongo" for /data/mongo.
+    """
+    return urllib.parse.quote(mount_point, safe='')
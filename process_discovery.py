@@ -0,0 +1,64 @@
+"""
+This module finds the processes ServerReport monitors. It walks the process table once per cycle and matches every
+ pattern in cfg.processes_to_monitor against the result, instead of running "ps -ef | grep" for each pattern.
+"""
+
+import os
+import psutil as p
+
+
+def build_process_index():
+    """
+    This function walks the process table once and returns two dictionaries:
+        an index structured as command line: [pids running that command line]
+        a lookup structured as pid: create_time
+
+    The command line is the full argument list joined by spaces, like the CMD column of "ps -ef". Processes without a
+     command line (kernel threads, zombies) are indexed as [name], the way ps shows them.
+    The monitor's own process and everything it started (the report worker, multiprocessing's resource tracker) are
+     left out, so a pattern like "python" can't match ServerReport itself.
+    """
+    own_pid = os.getpid()
+    children = {}
+    processes = []
+    for proc in p.process_iter(attrs=['pid', 'ppid', 'name', 'cmdline', 'create_time']):
+        info = proc.info
+        children.setdefault(info['ppid'], []).append(info['pid'])
+        processes.append(info)
+    own_tree = set()
+    to_visit = [own_pid]
+    while to_visit:
+        pid = to_visit.pop()
+        if pid not in own_tree:
+            own_tree.add(pid)
+            to_visit.extend(children.get(pid, []))
+    index = {}
+    create_times = {}
+    for info in processes:
+        pid = info['pid']
+        if pid in own_tree:
+            continue
+        cmdline = ' '.join(info['cmdline'] or [])
+        if not cmdline:
+            cmdline = '[{}]'.format(info['name'])
+        index.setdefault(cmdline, []).append(pid)
+        create_times[pid] = info['create_time']
+    return index, create_times
+
+
+def match_processes(process_list, index):
+    """
+    This function matches each pattern in process_list against the command lines in index (from build_process_index).
+    A pattern matches a command line if it appears anywhere in it, which is what grep did with a plain phrase.
+
+    It returns a dictionary structured as pattern: sorted list of matching pids.
+    An empty list means the process isn't running; more than one pid means the pattern is ambiguous.
+    """
+    matches = {}
+    for process in process_list:
+        pids = []
+        for cmdline in index:
+            if process in cmdline:
+                pids.extend(index[cmdline])
+        matches[process] = sorted(pids)
+    return matches
@@ -0,0 +1,54 @@
+"""
+This module collects stats for the processes ServerReport monitors.
+psutil.Process handles are kept between checks, keyed by (pid, create_time), so cpu_percent covers the whole interval
+ since the previous check and no sleep is needed. Only processes seen for the first time are primed, and all of them
+ share a single short wait.
+"""
+
+import time
+import psutil as p
+
+process_handles = {}
+
+
+def sample_processes(pids, create_times, prime_interval=.2):
+    """
+    This function returns a dictionary structured as pid: stats for each pid given.
+    create_times is the pid: create_time lookup from process_discovery.build_process_index.
+
+    A pid whose process exits before it can be read, or that ServerReport isn't allowed to read, is left out of the
+     result.
+    Handles for processes that weren't asked for this time are dropped.
+    """
+    handles = {}
+    new_handles = False
+    for pid in pids:
+        key = (pid, create_times.get(pid))
+        handle = process_handles.get(key)
+        if handle is None:
+            try:
+                handle = p.Process(pid)
+                handle.cpu_percent(interval=None)
+            except (p.NoSuchProcess, p.AccessDenied):
+                continue
+            new_handles = True
+        handles[key] = handle
+    if new_handles:
+        time.sleep(prime_interval)
+
+    samples = {}
+    for key, handle in handles.items():
+        try:
+            with handle.oneshot():
+                samples[key[0]] = {
+                    'create_time': handle.create_time(),
+                    'rss': handle.memory_info().rss,
+                    'memory_percent': handle.memory_percent(),
+                    'cpu_percent': handle.cpu_percent(interval=None),
+                    'username': handle.username()
+                }
+        except (p.NoSuchProcess, p.AccessDenied):
+            continue
+    process_handles.clear()
+    process_handles.update(handles)
+    return samples
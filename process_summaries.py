@@ -0,0 +1,122 @@
+"""
+This module keeps running per-day stats for each monitored process, so the daily summary doesn't have to re-read each
+ process's log file.
+For each process and day it keeps the number of samples, and the sum, min and max of memory use, memory percent and
+ CPU percent, plus the last status and the first create time seen. The accumulators are checkpointed to
+ <stats_archive_dir>/process_accumulators.json after each stats check, so a restart doesn't lose them.
+"""
+
+import csv
+import json
+import os
+
+from archive import open_text
+from stats_store import to_float
+
+PROCESS_METRICS = ['memory_info', 'memory_percent', 'cpu_percent']
+
+process_accumulators = {}
+
+
+def _accumulator_file(log_dir):
+    return os.path.join(log_dir, 'process_accumulators.json')
+
+
+def load_accumulators(log_dir):
+    accumulator_file = _accumulator_file(log_dir)
+    if os.path.isfile(accumulator_file):
+        with open(accumulator_file, 'r') as f:
+            process_accumulators.update(json.load(f))
+
+
+def save_accumulators(log_dir):
+    accumulator_file = _accumulator_file(log_dir)
+    temp_file = accumulator_file + '.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(process_accumulators, f)
+    os.replace(temp_file, accumulator_file)
+
+
+def _add_sample(day, status, create_time, values):
+    day['status'] = status
+    if create_time and not day['create_time']:
+        day['create_time'] = create_time
+    for m in PROCESS_METRICS:
+        value = to_float(values.get(m, ''))
+        if value != value:
+            continue
+        agg = day['metrics'].get(m)
+        if agg is None:
+            day['metrics'][m] = {'count': 1, 'sum': value, 'min': value, 'max': value}
+        else:
+            agg['count'] += 1
+            agg['sum'] += value
+            agg['min'] = min(agg['min'], value)
+            agg['max'] = max(agg['max'], value)
+
+
+def _new_day():
+    return {'status': 'nan', 'create_time': '', 'metrics': {}}
+
+
+def update_accumulators(log_dir, date, processes):
+    """
+    This function adds one stats check to the accumulators for date (a date string). processes is the dictionary
+     returned by check_process_status.
+    """
+    if not process_accumulators:
+        load_accumulators(log_dir)
+    for process, process_info in processes.items():
+        day = process_accumulators.setdefault(process, {}).setdefault(date, _new_day())
+        if type(process_info) is dict:
+            _add_sample(day, 'OK', process_info['create_time'], process_info)
+        elif str(process_info[0]).startswith('Ambiguous'):
+            _add_sample(day, 'Ambiguous', '', {})
+        else:
+            _add_sample(day, process_info[1], '', {})
+    save_accumulators(log_dir)
+
+
+def accumulate_csv_log(log_file):
+    """
+    This function builds the accumulator for one day out of that day's process log file. It is used when there is no
+     accumulator for the day, e.g. for days logged before ServerReport kept accumulators.
+    """
+    day = _new_day()
+    with open_text(log_file) as f:
+        rows = csv.DictReader(f)
+        for row in rows:
+            _add_sample(day, row['status'] or 'nan', row['create_time'], row)
+    return day
+
+
+def get_accumulator(process, date):
+    return process_accumulators.get(process, {}).get(date)
+
+
+def drop_days_before(log_dir, date):
+    """
+    This function forgets every accumulator older than date (a date string) and checkpoints the rest.
+    """
+    for process in process_accumulators:
+        for day in [f for f in process_accumulators[process] if f < date]:
+            del process_accumulators[process][day]
+    save_accumulators(log_dir)
+
+
+def summarize_day(day):
+    """
+    This function turns one day's accumulator into the stats reported in the daily email: the average and the peak of
+     each metric, with memory use in GB.
+    """
+    stats_to_report = {}
+    for m in PROCESS_METRICS:
+        agg = day['metrics'].get(m)
+        suffix = 'G' if m == 'memory_info' else ''
+        if agg is None:
+            stats_to_report[m] = 'nan'
+            continue
+        stats_to_report[m] = str(round(agg['sum'] / agg['count'], 2)) + suffix
+        if m != 'memory_percent':
+            stats_to_report['peak_' + m] = str(round(agg['max'], 2)) + suffix
+    return stats_to_report
@@ -0,0 +1,120 @@
+"""
+This module builds the daily report in a separate worker process, so the stats checks keep running while it is built,
+ and the monitor itself never loads matplotlib, pandas or NumPy.
+
+start_daily_report takes a snapshot of what the report needs from the monitor's memory (the process accumulators for
+ the previous day) and hands it to a new worker process, started with the spawn method so it doesn't inherit the
+ monitor's threads or memory. The worker builds the report (see daily_report.build_daily_report) and returns the
+ finished email, which is spooled here. The worker exits after each report, so everything the report allocated
+ (dataframes, figures) goes with it, and the monitor's memory stays the same from one day to the next.
+A background thread waits for the worker, so the scheduler isn't held up. A report that takes longer than
+ cfg.daily_report_timeout_seconds is stopped and reported as an error.
+The thread only hands the worker's result over: finish_reports, called by the scheduler after each tick, spools the
+ email and updates the warning flags and accumulators, so they are only ever changed from the scheduler's thread.
+"""
+
+import datetime
+import logging
+import multiprocessing
+import queue
+import threading
+
+import config as cfg
+from mail_spool import spool_message
+from monitor_stats import record_stage
+from process_summaries import drop_days_before, get_accumulator, load_accumulators, process_accumulators
+from server_checks import trigger_warning_email
+
+report_state = {'thread': None, 'finished': queue.Queue()}
+
+
+def report_snapshot(today=None):
+    """
+    This function returns what the worker needs from the monitor's memory to build the report for the day before today.
+    """
+    today = today or datetime.date.today()
+    yesterday = (today - datetime.timedelta(days=1)).isoformat()
+    if not process_accumulators:
+        load_accumulators(cfg.stats_archive_dir)
+    processes = list(cfg.processes_to_monitor)
+    return {'date': today.isoformat(), 'processes': processes,
+            'accumulators': dict((f, get_accumulator(f, yesterday)) for f in processes)}
+
+
+def build_report(snapshot):
+    """
+    This function runs in the worker process.
+    """
+    from daily_report import build_daily_report
+    return build_daily_report(snapshot)
+
+
+def run_report_worker(snapshot):
+    """
+    This function builds the report in a new worker process and returns its result (see daily_report.build_daily_report).
+    The worker is stopped when this function returns, including when the report timed out.
+    """
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+        return pool.apply_async(build_report, (snapshot,)).get(cfg.daily_report_timeout_seconds)
+
+
+def finish_report(result, today):
+    """
+    This function spools the finished email, records the worker's stage timings, checks the report's averages against
+     the warning thresholds and drops the accumulators the report no longer needs. It runs on the scheduler's thread
+     (see finish_reports).
+    """
+    spool_message(result['message'])
+    for stage, timings in result['timings'].items():
+        for seconds in timings:
+            record_stage(stage, seconds)
+    if result['warning_stats']:
+        trigger_warning_email(*result['warning_stats'])
+    drop_days_before(cfg.stats_archive_dir, today)
+
+
+def start_daily_report(on_error, on_success=None):
+    """
+    This function starts building the daily report in the background. Once it is built, finish_reports spools it and
+     calls on_success(), or on_error(job name, exception) if it failed or timed out. If the previous report is still
+     being built, it does nothing.
+    """
+    if report_state['thread'] is not None and report_state['thread'].is_alive():
+        logging.warning('The previous daily report is still being built, not starting another one')
+        return
+    snapshot = report_snapshot()
+
+    def build_and_send():
+        try:
+            result = run_report_worker(snapshot)
+        except Exception as e:
+            report_state['finished'].put((snapshot, None, e, on_error, on_success))
+            return
+        report_state['finished'].put((snapshot, result, None, on_error, on_success))
+
+    report_state['thread'] = threading.Thread(target=build_and_send, name='daily-report', daemon=True)
+    report_state['thread'].start()
+    return report_state['thread']
+
+
+def finish_reports():
+    """
+    This function finishes the reports built since the last call (see finish_report) and calls their on_success or
+     on_error. It is called from the scheduler's thread, so the report changes the monitor's state from the same thread
+     as the checks do.
+    """
+    while True:
+        try:
+            snapshot, result, error, on_error, on_success = report_state['finished'].get_nowait()
+        except queue.Empty:
+            return
+        if error is None:
+            try:
+                finish_report(result, snapshot['date'])
+            except Exception as e:
+                error = e
+        if error is not None:
+            on_error('daily report', error)
+        elif on_success:
+            on_success()
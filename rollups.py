@@ -0,0 +1,153 @@
+"""
+This module keeps running per-day aggregates of the system stats, so the daily email doesn't have to re-read the whole
+ stats log.
+For each day and each metric it keeps the number of samples, their sum, min, max and the last value.
+
+    <stats_archive_dir>/daily_rollups.jsonl         one line per finished day
+    <stats_archive_dir>/daily_rollup_current.json   the day in progress, rewritten after each stats check
+"""
+
+import csv
+import datetime
+import json
+import math
+import os
+
+from archive import open_text, system_partitions
+from stats_store import to_float
+
+ROLLUP_METRICS = ['% CPU use', '% RAM used', '% hard drive used', 'free hard drive space', '% boot drive used']
+
+current_rollup = {}
+
+
+def _rollup_files(log_dir):
+    return os.path.join(log_dir, 'daily_rollups.jsonl'), os.path.join(log_dir, 'daily_rollup_current.json')
+
+
+def _load_current(log_dir):
+    """
+    This function loads the day in progress, or builds the rollups from the stats log if there are none yet. It returns
+     True if the rollups were rebuilt.
+    """
+    finished_file, current_file = _rollup_files(log_dir)
+    if os.path.isfile(current_file):
+        with open(current_file, 'r') as f:
+            current_rollup.update(json.load(f))
+    elif not os.path.isfile(finished_file) and any(f['csv'] for f in system_partitions(log_dir)):
+        rebuild_rollups(log_dir)
+        return True
+    return False
+
+
+def _add_sample(day, values):
+    for m, value in values.items():
+        if math.isnan(value):
+            continue
+        agg = day['metrics'].get(m)
+        if agg is None:
+            day['metrics'][m] = {'count': 1, 'sum': value, 'min': value, 'max': value, 'last': value}
+        else:
+            agg['count'] += 1
+            agg['sum'] += value
+            agg['min'] = min(agg['min'], value)
+            agg['max'] = max(agg['max'], value)
+            agg['last'] = value
+
+
+def _save_current(current_file):
+    temp_file = current_file + '.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(current_rollup, f)
+    os.replace(temp_file, current_file)
+
+
+def update_rollups(log_dir, now, values):
+    """
+    This function adds one stats check to the rollup for its day. values is a dictionary structured as
+     metric: number, using the column names of stats_log.csv.
+    When the first sample of a new day arrives, the previous day is appended to daily_rollups.jsonl.
+    The first time it runs on a server that already has a stats log, it builds the rollups from the log instead (see
+     rebuild_rollups), which already includes this stats check.
+    """
+    finished_file, current_file = _rollup_files(log_dir)
+    if not current_rollup and _load_current(log_dir):
+        return
+    date = str(now.date())
+    if current_rollup.get('date') != date:
+        if current_rollup.get('date'):
+            with open(finished_file, 'a') as f:
+                f.write(json.dumps(current_rollup) + '\n')
+        current_rollup.clear()
+        current_rollup.update({'date': date, 'metrics': {}})
+    _add_sample(current_rollup, values)
+    _save_current(current_file)
+
+
+def rebuild_rollups(log_dir):
+    """
+    This function builds the rollup files from scratch out of the system stats partitions (see archive.py). It runs
+     once, when ServerReport starts keeping rollups on a server that already has a stats log.
+    """
+    finished_file, current_file = _rollup_files(log_dir)
+    days = []
+    for partition in system_partitions(log_dir):
+        if not partition['csv']:
+            continue
+        with open_text(partition['csv']) as f:
+            rows = csv.reader(f)
+            next(rows, None)
+            for row in rows:
+                if not row:
+                    continue
+                date = row[0].split('T')[0]
+                if not days or days[-1]['date'] != date:
+                    days.append({'date': date, 'metrics': {}})
+                _add_sample(days[-1], dict(zip(ROLLUP_METRICS, [to_float(f) for f in row[1:6]])))
+    today = str(datetime.date.today())
+    with open(finished_file, 'w') as f:
+        for day in days:
+            if day['date'] != today:
+                f.write(json.dumps(day) + '\n')
+    current_rollup.clear()
+    if days and days[-1]['date'] == today:
+        current_rollup.update(days[-1])
+        _save_current(current_file)
+
+
+def read_rollups(log_dir, start_date):
+    """
+    This function returns the rollups for every day from start_date (a date) onwards, oldest first.
+    """
+    finished_file, current_file = _rollup_files(log_dir)
+    start_date = str(start_date)
+    days = []
+    if os.path.isfile(finished_file):
+        with open(finished_file, 'r') as f:
+            for line in f:
+                day = json.loads(line)
+                if day['date'] >= start_date:
+                    days.append(day)
+    if os.path.isfile(current_file):
+        with open(current_file, 'r') as f:
+            current = json.load(f)
+        if current.get('date', '') >= start_date:
+            days.append(current)
+    return days
+
+
+def combine_rollups(days, metric):
+    """
+    This function merges the rollups of several days for one metric into a single count, sum, min, max and last value.
+    It returns None if none of the days have samples for that metric.
+    """
+    aggs = [day['metrics'][metric] for day in days if metric in day['metrics']]
+    if not aggs:
+        return None
+    return {
+        'count': sum(f['count'] for f in aggs),
+        'sum': sum(f['sum'] for f in aggs),
+        'min': min(f['min'] for f in aggs),
+        'max': max(f['max'] for f in aggs),
+        'last': aggs[-1]['last']
+    }
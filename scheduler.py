@@ -0,0 +1,171 @@
+"""
+This module runs ServerReport's checks, each on its own interval.
+Run times are aligned to the wall clock (a job that runs every 300 seconds runs at :00, :05, :10, ... local time, plus
+ an optional offset) and computed from that grid rather than from when the last run finished, so they don't drift.
+
+If a run is missed (e.g. a job took longer than its interval, or the server was suspended), the job's policy decides:
+    skip: wait for the next time on the grid
+    catch_up: run the missed times one after another until the job is back on schedule
+
+With max_workers set, jobs added with a timeout run concurrently on a thread pool, so a tick takes as long as its
+ slowest check rather than the sum of them. A job that runs past its timeout is reported to on_timeout and left to
+ finish in the background; it isn't started again until it does. Jobs added without a timeout run after the concurrent
+ ones, one at a time, so they can use their results.
+"""
+
+import concurrent.futures
+import datetime
+import logging
+import os
+import threading
+import time
+
+
+def next_aligned(now, interval, offset=0):
+    """
+    This function returns the first time after now (seconds since the epoch) that is a whole number of intervals past
+     local midnight, plus offset seconds.
+    """
+    local = now + time.localtime(now).tm_gmtoff - offset
+    return now + interval - (local % interval)
+
+
+class Scheduler(object):
+    """
+    Runs jobs at their scheduled times. Jobs that are due at the same time run in the order they were added.
+    """
+
+    def __init__(self, on_error=None, after_tick=None, on_timeout=None, max_workers=None):
+        self.jobs = []
+        self.on_error = on_error
+        self.after_tick = after_tick
+        self.on_timeout = on_timeout
+        self.pool = None
+        if max_workers:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='check')
+        self.stop_event = threading.Event()
+
+    def add_job(self, name, func, interval, offset=0, missed='skip', timeout=None):
+        """
+        This function schedules func to run every interval seconds, starting at the next aligned time.
+        If the scheduler has a thread pool and a timeout (in seconds) is given, the job runs concurrently with the other
+         jobs that have a timeout.
+        """
+        if missed not in ('skip', 'catch_up'):
+            raise Exception("Missed run policy must be 'skip' or 'catch_up'")
+        job = {'name': name, 'func': func, 'interval': interval, 'offset': offset, 'missed': missed,
+               'timeout': timeout, 'future': None, 'next_run': next_aligned(time.time(), interval, offset)}
+        self.jobs.append(job)
+        return job
+
+    def add_daily_job(self, name, func, hour, state_file, catch_up=True, asynchronous=False):
+        """
+        This function schedules func to run once a day at hour:00 local time.
+        The date of the last run is kept in state_file, so the job never runs twice on the same day, even across a
+         restart. If catch_up is set and today's run was missed (e.g. the script wasn't running at that hour), it runs
+         as soon as the scheduler starts.
+        If asynchronous is set, func only starts the work: it is called with a function to call once the work has
+         succeeded, and the run is only recorded then. Work that fails is run again on the next catch up.
+        """
+        def run_once():
+            today = datetime.date.today().isoformat()
+            if read_last_run(state_file) == today:
+                logging.info('{0} already ran today, not running it again'.format(name))
+                return
+            if asynchronous:
+                func(lambda: write_last_run(state_file, today))
+                return
+            func()
+            write_last_run(state_file, today)
+
+        job = self.add_job(name, run_once, 24 * 60 * 60, offset=hour * 60 * 60)
+        now = datetime.datetime.now()
+        if catch_up and now.hour >= hour and read_last_run(state_file) != now.date().isoformat():
+            job['next_run'] = time.time()
+        return job
+
+    def schedule_next(self, job):
+        if job['missed'] == 'catch_up':
+            job['next_run'] += job['interval']
+        else:
+            job['next_run'] = next_aligned(time.time(), job['interval'], job['offset'])
+
+    def run_pending(self):
+        """
+        This function runs every job that is due. It returns a list of (job name, result), where result is True if the
+         job ran without an error, False if it raised one, and None if it timed out.
+        """
+        now = time.time()
+        due = [f for f in self.jobs if f['next_run'] <= now]
+        results = []
+        sequential = due
+        if self.pool:
+            sequential = [f for f in due if not f['timeout']]
+            started = []
+            for job in [f for f in due if f['timeout']]:
+                if job['future'] and not job['future'].done():
+                    logging.critical('{} is still running from an earlier run'.format(job['name']))
+                    results.append((job['name'], None))
+                    if self.on_timeout:
+                        self.on_timeout(job['name'])
+                else:
+                    job['future'] = self.pool.submit(job['func'])
+                    job['deadline'] = time.time() + job['timeout']
+                    started.append(job)
+                self.schedule_next(job)
+            for job in started:
+                try:
+                    job['future'].result(timeout=max(0, job['deadline'] - time.time()))
+                    results.append((job['name'], True))
+                except concurrent.futures.TimeoutError:
+                    logging.critical('{0} timed out after {1} seconds'.format(job['name'], job['timeout']))
+                    results.append((job['name'], None))
+                    if self.on_timeout:
+                        self.on_timeout(job['name'])
+                except Exception as e:
+                    results.append((job['name'], False))
+                    self._report_error(job['name'], e)
+
+        for job in sequential:
+            try:
+                job['func']()
+                results.append((job['name'], True))
+            except Exception as e:
+                results.append((job['name'], False))
+                self._report_error(job['name'], e)
+            self.schedule_next(job)
+        return results
+
+    def _report_error(self, job_name, e):
+        if self.on_error:
+            self.on_error(job_name, e)
+        else:
+            logging.exception(e)
+
+    def run_forever(self):
+        while not self.stop_event.is_set():
+            results = self.run_pending()
+            if results and self.after_tick:
+                self.after_tick(results)
+            wait = min(f['next_run'] for f in self.jobs) - time.time()
+            if wait > 0:
+                self.stop_event.wait(wait)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.pool:
+            self.pool.shutdown(wait=False)
+
+
+def read_last_run(state_file):
+    if not os.path.isfile(state_file):
+        return None
+    with open(state_file, 'r') as f:
+        return f.read().strip()
+
+
+def write_last_run(state_file, date):
+    temp_file = state_file + '.tmp'
+    with open(temp_file, 'w') as f:
+        f.write(date)
+    os.replace(temp_file, state_file)
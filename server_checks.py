@@ -0,0 +1,383 @@
+"""
+This module is the collector core of ServerReport: the stats checks, the stats logs and the warning emails that run on
+ every cycle. It only needs psutil and the standard library. The daily report (daily_report.py) and the Mongo check
+ (mongo_check.py) are imported when they are needed, so matplotlib, pandas, NumPy and pymongo aren't loaded by the
+ collector. startup_check.py makes sure it stays that way.
+"""
+
+import psutil as p
+import datetime
+import gzip
+import os
+import logging
+
+import config as cfg
+from process_discovery import build_process_index, match_processes
+from cpu_sampler import CPUSampler, summarize_window
+from process_sampler import sample_processes
+from mail_spool import queue_alert
+from archive import rotate_archive
+from mounts import list_mounts, mount_usage, series_name
+from stats_store import append_system_record, append_process_record, to_float
+from rollups import ROLLUP_METRICS, update_rollups
+from process_summaries import update_accumulators
+from tiers import system_values, update_tiers
+from thresholds import CRITICAL, check_stats, warning_flags
+
+logging.basicConfig(filename=cfg.script_log_file,filemode='a+',level=logging.INFO)
+
+warning_flags.update({
+    'Mongo': 0,
+    'Mongo latency': 0
+})
+UNKNOWN = 'unknown'
+process_flags = {}
+for process_to_watch in cfg.processes_to_monitor:
+    process_flags[process_to_watch] = 0
+
+cpu_sampler = CPUSampler(cfg.cpu_sample_seconds, max_samples=2 * int(60 * cfg.minutes_between_stats_check / cfg.cpu_sample_seconds) + 1)
+
+
+def convert_byte_to( n , from_unit, to , block_size=1024 ):
+    """
+    This function converts filesize between different units. By default, it assumes that 1MB = 1024KB.
+    Modified from https://github.com/mlibre/byte_to_humanity/blob/master/byte_to_humanity/bth.py.
+        The mods let this transform units of any type into specified units.
+	"""
+    table = {'b': 1, 'k': 2 , 'm': 3 , 'g': 4 , 't': 5 , 'p': 6}
+    number = float(n)
+    change_factor = table[to] - table[from_unit]
+    number /= (block_size ** change_factor)
+    return number
+
+
+def check_cpu():
+    """
+    This function checks the CPU usage since the last check, using the samples collected by the background CPU sampler.
+    It returns a dictionary containing the average percentage of CPU used, the highest percentage seen in a single
+     sample, and the average percentage used by each core (all rounded to two decimal points).
+
+    If the sampler hasn't collected anything yet (e.g. right after startup), it takes one short reading instead.
+    """
+    window = cpu_sampler.take_window()
+    if not window:
+        window = [p.cpu_percent(interval=1, percpu=True)]
+    summary = summarize_window(window)
+    CPU_usage = {
+        'average': str(summary['average']),
+        'max': str(summary['max']),
+        'per_core': [str(f) for f in summary['per_core']]
+    }
+    logging.info('CPU over {0} samples: max {1}%, per core {2}'.format(summary['samples'], CPU_usage['max'], CPU_usage['per_core']))
+    return CPU_usage
+
+
+def check_ram():
+    """
+    This function checks the RAM usage, returning a percentage (rounded to two decimal points) of RAM used.
+    """
+    usage = p.virtual_memory()
+    RAM_usage = str(round(usage.percent, 2))
+    return RAM_usage
+
+
+def check_hard_drive(start_dir=cfg.root_dir):
+    """
+    This function checks the hard drive usage.
+    It returns a dictionary containing the amount of free space (in human readable form) and the percentage of the disk
+     used.
+
+    By default, the function checks the disk usage of the main partition of the drive.
+    """
+    usage = p.disk_usage(start_dir)
+    hard_drive_free_space = round(convert_byte_to(usage.free, from_unit='b', to='g'),2)
+    hard_drive_usage_percent = round(usage.percent, 2)
+    hard_drive_stats = {'free_space': str(hard_drive_free_space) + "G", 'percent_used': str(hard_drive_usage_percent)}
+    return hard_drive_stats
+
+
+def check_boot_drive(boot_drive=cfg.boot_drive):
+    """
+    This function checks the boot drive usage, returning a percentage of the boot drive space used.
+    """
+    boot_drive_usage = str(p.disk_usage(boot_drive).percent)
+    return boot_drive_usage
+
+
+def check_mounts():
+    """
+    This function checks every mounted filesystem found by list_mounts (see mounts.py).
+    It returns a dictionary structured as mount point: stats, where stats contains the device, the filesystem type, the
+     amount of free space (in human readable form), the percentage of the space used and the percentage of the inodes
+     used ('' if the filesystem doesn't have a fixed number of inodes).
+    A filesystem that can't be read (e.g. an NFS server that went away) has its stats logged as unknown.
+    """
+    mounts = {}
+    for mount_point, device, fs_type in list_mounts():
+        try:
+            usage = mount_usage(mount_point)
+            stats = {'free_space': str(usage['free_space']) + "G", 'percent_used': str(usage['percent_used']),
+                     'inode_percent': '' if usage['inode_percent'] is None else str(usage['inode_percent'])}
+        except OSError as e:
+            logging.warning('Unable to check {0}: {1}'.format(mount_point, e))
+            stats = {'free_space': UNKNOWN, 'percent_used': UNKNOWN, 'inode_percent': UNKNOWN}
+        stats.update({'device': device, 'fs_type': fs_type})
+        mounts[mount_point] = stats
+    return mounts
+
+
+def check_process_status(process_list=cfg.processes_to_monitor):
+    """
+    This function checks to see if a process (or processes) is running.
+    When running the function, you can give it a list of processes to check or a single process.
+
+    The process table is read once per call (see process_discovery.py), and each process provided is matched against
+     the command lines in it.
+    Stats for all matched processes are collected together (see process_sampler.py). CPU usage is measured over the
+     time since the previous check.
+
+    It returns a dictionary structured as process: stats for the matching pid.
+
+    If a process isn't running, it triggers a function to send a warning email.
+    """
+    if type(process_list) is str:
+        process_list = [process_list]
+    processes_info = {}
+    broken_processes = []
+    broken_processes_to_email = []
+    ambiguous_processes_to_email = []
+    process_index, create_times = build_process_index()
+    process_matches = match_processes(process_list, process_index)
+    unique_pids = [process_matches[f][0] for f in process_list if len(process_matches[f]) == 1]
+    process_samples = sample_processes(unique_pids, create_times)
+    for process in process_list:
+        time = str(datetime.datetime.now().replace(microsecond=0).isoformat().split('T')[1])
+        process_info = ''
+        process_pids = process_matches[process]
+        if len(process_pids) > 1:
+            if process_flags[process] == 0:
+                ambiguous_processes_to_email.append(process)
+                process_flags[process] = 1
+            broken_processes.append(process)
+            process_info = ['Ambiguous process name: {}'.format(process),'','','','','']
+        elif process_pids and process_pids[0] in process_samples:
+            info = {}
+            sample = process_samples[process_pids[0]]
+            info['create_time'] = datetime.datetime.utcfromtimestamp(sample['create_time']).replace(microsecond=0).isoformat()
+            info['memory_info'] = str(round(convert_byte_to(sample['rss'], from_unit='b', to='g'), 2)) + "G"
+            info['memory_percent'] = str(round(sample['memory_percent'], 2))
+            info['cpu_percent'] = str(round(sample['cpu_percent'], 2))
+            info['report_time'] = time
+            info['username'] = sample['username']
+            process_info = info
+            process_flags[process] = 0
+        else:
+            if process_flags[process] == 0:
+                broken_processes_to_email.append(process)
+                process_flags[process] = 1
+            broken_processes.append(process)
+            process_info = [time, 'Process not running','','','','','']
+        processes_info[process] = process_info
+    if broken_processes:
+        logging.critical('PROBLEM WITH PROCESS(ES): {}'.format(broken_processes))
+        if (broken_processes_to_email or ambiguous_processes_to_email):
+            trigger_process_warning(broken_processes_to_email, ambiguous_processes_to_email)
+    return processes_info, process_flags
+
+
+def trigger_process_warning(broken_processes, ambiguous_processes, email_recipients=cfg.warning_email_recipients):
+    """
+    This function queues a warning email if a process in process_list=cfg.processes_to_monitor is not running.
+    The email goes out at the end of the current stats check (see mail_spool.py).
+    """
+    if not type(email_recipients) is list:
+        raise Exception("Email recipients must be in a list")
+    email_text = ''
+    if len(broken_processes) > 0:
+        email_text += "PROCESSES NOT RUNNING \n\n" + '\n\t'.join(broken_processes) + '\n\n'
+    if len(ambiguous_processes) > 0:
+        email_text += "AMBIGUOUS PROCESSES, UNABLE TO LOG STATS \n\n" + '\n\t'.join(ambiguous_processes) + '\n\n'
+
+    queue_alert("{0}: Critical - error in process(es)".format(cfg.server_name), email_text, email_recipients)
+
+
+def write_stats_logs(log_dir, now, cpu, ram, hard_drive, boot_drive, processes, mounts=None):
+    """
+    This function appends the server stats to stats_log.csv, the stats for each process to that day's process log, and
+     the stats for each mounted filesystem (mounts, as returned by check_mounts) to that day's mount log.
+    cpu is the average CPU use. It returns the values written to stats_log.csv.
+    Stats sent late by a fleet agent can be for a day whose process logs were already compressed; they are added to
+     the compressed log.
+    """
+    date = str(now.date())
+    os.makedirs(log_dir, exist_ok=True)
+    log_file = log_dir + '/stats_log.csv'
+
+    stats_file_header = "time,% CPU use,% RAM used,% hard drive used,free hard drive space,% boot drive used"
+    if os.path.isfile(log_file):
+        f = open(log_file, 'a')
+        f.write('\n')
+    elif not os.path.isfile(log_file):
+        f = open(log_file, 'w')
+        f.write(stats_file_header)
+        f.write('\n')
+    stats_info = [now.isoformat(), cpu, ram, hard_drive['percent_used'], hard_drive['free_space'], boot_drive]
+    f.write(','.join(stats_info))
+    f.close()
+
+    for process in processes:
+        write_info = ''
+        process_log_dir = log_dir + '/processes/' + process
+        os.makedirs(process_log_dir, exist_ok=True)
+        log_file = process_log_dir + '/' + date + '.csv'
+        log_file_header = 'report_time,status,create_time,memory_info,memory_percent,username,cpu_percent'
+        process_info = processes[process]
+        if type(process_info) is dict:
+            write_info = [process_info['report_time'],"OK",process_info['create_time'], process_info['memory_info'], process_info['memory_percent'], process_info['username'], process_info['cpu_percent']]
+        elif type(process_info) is list:
+            write_info = process_info
+        write_info = ','.join(write_info)
+        if os.path.isfile(log_file + '.gz'):
+            with gzip.open(log_file + '.gz', 'at') as f:
+                f.write('\n' + write_info)
+            continue
+        if os.path.isfile(log_file):
+            f = open(log_file, 'a')
+            f.write('\n')
+        elif not os.path.isfile(log_file):
+            f = open(log_file, 'w')
+            f.write(log_file_header)
+            f.write('\n')
+        f.write(write_info)
+        f.close()
+
+    for mount_point, mount_info in (mounts or {}).items():
+        mount_log_dir = log_dir + '/mounts/' + series_name(mount_point)
+        os.makedirs(mount_log_dir, exist_ok=True)
+        log_file = mount_log_dir + '/' + date + '.csv'
+        if os.path.isfile(log_file):
+            f = open(log_file, 'a')
+            f.write('\n')
+        else:
+            f = open(log_file, 'w')
+            f.write('report_time,device,fs_type,free_space,percent_used,inode_percent\n')
+        f.write(','.join([now.time().isoformat(), mount_info['device'], mount_info['fs_type'],
+                          mount_info['free_space'], mount_info['percent_used'], mount_info['inode_percent']]))
+        f.close()
+    return stats_info
+
+
+def stats_mounts(hard_drive, boot_drive, mounts=None):
+    """
+    This function returns the disk stats structured as (mount point, metric): value, for the mount: threshold rules.
+    mounts is the dictionary returned by check_mounts, if every mounted filesystem is checked.
+    """
+    values = {}
+    for mount_point, mount_info in (mounts or {}).items():
+        for metric in ('percent_used', 'free_space', 'inode_percent'):
+            values[(mount_point, metric)] = mount_info[metric]
+    values.update({(cfg.root_dir, 'percent_used'): hard_drive['percent_used'], (cfg.root_dir, 'free_space'): hard_drive['free_space'],
+                   (cfg.boot_drive, 'percent_used'): boot_drive})
+    return values
+
+
+def log_stats(cpu, ram, hard_drive, boot_drive, processes, log_dir=cfg.stats_archive_dir, mounts=None):
+    """
+    This function writes the server stats, the stats for each process and the stats for each mounted filesystem (mounts,
+     as returned by check_mounts) to their logfiles.
+    If cfg.binary_stats_store is set, it also appends them to the binary stats files (see stats_store.py).
+    On the first check of a new day, the previous day's stats are moved into their day partition first (see archive.py).
+    The stats are then checked against the thresholds, unless this server is a fleet agent whose aggregator does that.
+    """
+    now = datetime.datetime.now().replace(microsecond=0)
+    date = str(now.date())
+    rotate_archive(log_dir, now)
+    stats_info = write_stats_logs(log_dir, now, cpu['average'], ram, hard_drive, boot_drive, processes, mounts)
+    if cfg.binary_stats_store:
+        append_system_record(log_dir, now, cpu['average'], ram, hard_drive, boot_drive)
+        for process in processes:
+            append_process_record(log_dir, process, now, processes[process])
+    update_rollups(log_dir, now, dict(zip(ROLLUP_METRICS, [to_float(f) for f in stats_info[1:]])))
+    update_tiers(log_dir, now, system_values(cpu['average'], ram, hard_drive, boot_drive), processes)
+    if processes:
+        update_accumulators(log_dir, date, processes)
+
+    if cfg.fleet_mode == 'agent' and not cfg.fleet_agent_local_warnings:
+        return                  # The aggregator checks the thresholds for every server (see fleet.py)
+    trigger_warning_email(cpu['average'], ram, hard_drive['free_space'], boot_drive, processes,
+                          stats_mounts(hard_drive, boot_drive, mounts))
+
+
+def trigger_warning_email(cpu, ram, hard_drive, boot_drive, processes=None, mounts=None):
+    """
+    This function triggers the sending of a warning email if any of the stats reach a warning threshold.
+    The thresholds are compiled from the warning_parameters, critical_parameters and entity_thresholds objects in the
+     config file (see thresholds.py). processes is the dictionary passed to log_stats, and mounts is a dictionary
+     structured as (mount point, metric): value; they are only checked if there are rules for them.
+    Mongo is checked separately, by check_mongo. Stats whose check timed out (UNKNOWN) are skipped.
+    """
+    warning_contents, stats_to_email, highest_level = check_stats(cpu, ram, hard_drive, boot_drive, processes, mounts)
+
+    if warning_contents:
+        warning_level = "Critical" if highest_level == CRITICAL else "Warning"
+        warning_contents = '{0}: \n\t\t'.format(warning_level) + '\n'.join(warning_contents)
+        if highest_level == CRITICAL:
+            logging.critical(warning_contents)
+        else:
+            logging.warning(warning_contents)
+        if stats_to_email:
+            send_warning_email((stats_to_email, warning_level))
+    else:
+        logging.info("No warning")
+
+
+def check_mongo(warn_thresholds=cfg.warning_parameters, crit_thresholds=cfg.critical_parameters):
+    """
+    This function checks to see if mongo is running and how long it takes to answer a ping (see mongo_check.py),
+     triggering a warning if it isn't running or if the round trip time reaches the "mongo_latency_ms" thresholds.
+    Like the other warnings, it only sends an email the first time a problem is seen.
+    It returns the round trip time in milliseconds, or None if mongo didn't answer.
+    """
+    from mongo_check import ping_mongo, log_mongo_latency
+    latency = ping_mongo()
+    log_mongo_latency(latency)
+    if latency is None:
+        logging.critical('Critical: \n\t\tMongoDB not running!')
+        if warning_flags['Mongo'] == 0:
+            send_warning_email((["MongoDB not running!"], "Critical"))
+            warning_flags['Mongo'] = 1
+        return latency
+    warning_flags['Mongo'] = 0
+
+    if "mongo_latency_ms" in warn_thresholds and latency >= float(warn_thresholds["mongo_latency_ms"]):
+        warning_level = "Warning"
+        if latency >= float(crit_thresholds["mongo_latency_ms"]):
+            warning_level = "Critical"
+        warning_contents = "MongoDB took {} ms to answer a ping".format(latency)
+        logging.warning('{0}: \n\t\t{1}'.format(warning_level, warning_contents))
+        if warning_flags['Mongo latency'] == 0:
+            send_warning_email(([warning_contents], warning_level))
+            warning_flags['Mongo latency'] = 1
+    else:
+        warning_flags['Mongo latency'] = 0
+    return latency
+
+
+def send_warning_email(warning_stats, email_recipients=cfg.warning_email_recipients):
+    """
+    This function queues an email with critical information. It is triggered based on trigger_warning_email.
+    """
+    if not type(email_recipients) is list:
+        raise Exception("Email recipients must be in a list")
+    email_text = '\n'.join(warning_stats[0])
+    queue_alert("{0}: {1} computer resources".format(cfg.server_name, warning_stats[1]), email_text, email_recipients)
+
+
+def script_error_email(error, email_recipients=cfg.warning_email_recipients):
+    """
+    This function queues a warning email if the server watch code raises an exception.
+    """
+    if not type(email_recipients) is list:
+        raise Exception("Email recipients must be in a list")
+    email_text = "Server watch script error: \n\n {}".format(error)
+    queue_alert("{0}: Critical - server watch error".format(cfg.server_name), email_text, email_recipients)
@@ -0,0 +1,116 @@
+"""
+This module keeps an index of STACKS data files, so check_stacks_details doesn't have to list and match every file in
+ every raw data directory on every check.
+
+For each raw data directory the index holds (collector, hour) -> latest file name, plus the directory's modification
+ time. A directory is only listed again when its modification time changes, which happens when files are added or
+ removed (not when a file grows). When it is listed, only file names that haven't been seen before are matched against
+ the collectors.
+The index is saved to <stats_archive_dir>/stacks_index.json. File names already seen are only kept in memory; after a
+ restart, the first change to a directory leads to one full pass over it.
+"""
+
+import json
+import os
+import time
+
+import config as cfg
+
+stacks_index = {'dirs': {}, 'raw_dirs': {}}
+seen_files = {}
+index_state = {'loaded': False, 'changed': False}
+
+
+def _index_file():
+    return os.path.join(cfg.stats_archive_dir, 'stacks_index.json')
+
+
+def load_index():
+    if os.path.isfile(_index_file()):
+        with open(_index_file(), 'r') as f:
+            stacks_index.update(json.load(f))
+    index_state['loaded'] = True
+
+
+def save_index():
+    """
+    This function writes the index to disk if it changed since it was last saved.
+    """
+    if not index_state['changed']:
+        return
+    os.makedirs(cfg.stats_archive_dir, exist_ok=True)
+    temp_file = _index_file() + '.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(stacks_index, f)
+    os.replace(temp_file, _index_file())
+    index_state['changed'] = False
+
+
+def _settled_mtime(path):
+    """
+    This function returns the directory's modification time, or None if it changed in the last two seconds. Files can
+     be added within the timestamp granularity of the filesystem, so a very recent mtime isn't trusted; the directory
+     is listed again on the next check.
+    """
+    mtime = os.stat(path).st_mtime
+    if time.time() - mtime < 2:
+        return None
+    return mtime
+
+
+def list_dir(path):
+    """
+    This function returns the names in a directory, only listing it if it changed since the last call.
+    """
+    if not index_state['loaded']:
+        load_index()
+    mtime = os.stat(path).st_mtime
+    entry = stacks_index['dirs'].get(path)
+    if entry and entry['mtime'] == mtime:
+        return entry['names']
+    with os.scandir(path) as it:
+        names = [f.name for f in it]
+    stacks_index['dirs'][path] = {'mtime': _settled_mtime(path), 'names': names}
+    index_state['changed'] = True
+    return names
+
+
+def collector_files(raw_dir, collectors):
+    """
+    This function returns a dictionary structured as collector: {hour: latest data file name} for a raw data directory.
+    A file belongs to a collector if the collector's name is part of the file name, and its hour is the second
+     dash-separated part of the name, as STACKS names its files.
+    """
+    if not index_state['loaded']:
+        load_index()
+    mtime = os.stat(raw_dir).st_mtime
+    entry = stacks_index['raw_dirs'].get(raw_dir)
+    if entry is None or entry['collectors'] != collectors:
+        entry = {'mtime': None, 'collectors': list(collectors), 'latest': {}}
+        stacks_index['raw_dirs'][raw_dir] = entry
+        seen_files[raw_dir] = set()
+    if entry['mtime'] == mtime:
+        return entry['latest']
+
+    seen = seen_files.setdefault(raw_dir, set())
+    with os.scandir(raw_dir) as it:
+        names = set(f.name for f in it if f.name.endswith('.json'))
+    if not seen or seen - names:
+        # Files were deleted or archived away (or the index was loaded from disk), so a latest file may be gone:
+        #  rebuild from the current listing
+        seen.clear()
+        entry['latest'] = {}
+    for name in names - seen:
+        seen.add(name)
+        name_parts = name.split('-')
+        if len(name_parts) < 2:
+            continue
+        hour = name_parts[1]
+        for collector in collectors:
+            if collector in name:
+                latest = entry['latest'].setdefault(collector, {})
+                if name > latest.get(hour, ''):
+                    latest[hour] = name
+    entry['mtime'] = _settled_mtime(raw_dir)
+    index_state['changed'] = True
+    return entry['latest']
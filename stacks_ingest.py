@@ -0,0 +1,90 @@
+"""
+This module tracks how fast each STACKS collector is writing data, so a collector that is stuck (its file is there but
+ isn't growing) or slowing down is noticed, not just one whose file is missing.
+
+Each STACKS check records the size of the collector's data file for the current hour. The bytes written since the last
+ check, divided by the minutes between them, is the collector's ingest rate. When STACKS has moved on to a new hourly
+ file since the last check, the bytes written to the end of the old file are counted too, along with the new file's
+ size if it was written to since the last check.
+Every measurement is logged to <stats_archive_dir>/stacks_log.csv (split into day partitions, see archive.py).
+
+A rate is too low if it is under stacks_params["min_bytes_per_minute"], or under
+ stacks_params["min_fraction_of_average"] times the collector's average over its last
+ stacks_params["rate_average_checks"] healthy checks. Rates that were too low aren't added to the average, so a long
+ stall doesn't drag the average down to match it.
+"""
+
+import collections
+import datetime
+import os
+
+import config as cfg
+
+ingest_state = {}
+rate_history = {}
+latest_rates = {}
+
+
+def _file_size(path):
+    try:
+        stat = os.stat(path)
+    except (FileNotFoundError, TypeError):
+        return None, None
+    return stat.st_size, stat.st_mtime
+
+
+def measure_ingest(key, data_file, now):
+    """
+    This function records the size of a collector's current data file and returns the bytes per minute written since
+     the previous call for the same key, or None if there's nothing to compare with yet.
+    It also returns the time the file was last written to (or None).
+    """
+    size, mtime = _file_size(data_file)
+    previous = ingest_state.get(key)
+    ingest_state[key] = {'file': data_file, 'size': size, 'time': now}
+    if previous is None or previous['size'] is None or size is None or now <= previous['time']:
+        return None, mtime
+    if previous['file'] == data_file:
+        written = size - previous['size']
+    else:
+        final_size, _ = _file_size(previous['file'])
+        written = max((final_size or previous['size']) - previous['size'], 0)
+        # A file that hasn't been written to since the previous call (e.g. the same hour's file from an earlier day)
+        #  isn't new data
+        if mtime > previous['time']:
+            written += size
+    return written / ((now - previous['time']) / 60), mtime
+
+
+def rate_is_low(key, rate, stacks_params=cfg.stacks_params):
+    """
+    This function returns (True, average) if the rate is under the configured floor or under the configured fraction
+     of the collector's trailing average, and (False, average) otherwise. Healthy rates are added to the average.
+    """
+    history = rate_history.setdefault(key, collections.deque(maxlen=stacks_params.get("rate_average_checks", 24)))
+    average = sum(history) / len(history) if history else None
+    low = rate < stacks_params.get("min_bytes_per_minute", 0)
+    if average and len(history) == history.maxlen:
+        low = low or rate < stacks_params.get("min_fraction_of_average", 0) * average
+    if not low:
+        history.append(rate)
+    return low, average
+
+
+def log_ingest(project_name, collector, data_file, rate, mtime, log_dir=cfg.stats_archive_dir):
+    """
+    This function appends one ingest measurement to stacks_log.csv.
+    """
+    now = datetime.datetime.now().replace(microsecond=0)
+    os.makedirs(log_dir, exist_ok=True)
+    log_file = os.path.join(log_dir, 'stacks_log.csv')
+    size, _ = _file_size(data_file)
+    last_write = datetime.datetime.fromtimestamp(mtime).replace(microsecond=0).isoformat() if mtime else ''
+    write_info = [now.isoformat(), project_name, collector, os.path.basename(data_file or ''),
+                  '' if size is None else str(size), '' if rate is None else str(round(rate, 1)), last_write]
+    if os.path.isfile(log_file):
+        with open(log_file, 'a') as f:
+            f.write('\n' + ','.join(write_info))
+    else:
+        with open(log_file, 'w') as f:
+            f.write('time,project,collector,file,size,bytes_per_minute,last_write\n' + ','.join(write_info))
@@ -0,0 +1,66 @@
+"""
+This script checks that the ServerReport collector core stays lean.
+It imports the collector core (server_checks.py, and STACKS_checks.py if STACKS checks are turned on) in a fresh Python
+ process and fails if:
+    any of the reporting, plotting or Mongo dependencies (matplotlib, pandas, numpy, pymongo) got loaded
+    the imports took longer than --max-seconds
+    the process's peak RSS went over --max-rss-mb
+
+Run it from the directory containing config.py:
+    python startup_check.py [--max-seconds 1.0] [--max-rss-mb 40]
+It prints its measurements as JSON and exits with status 1 if any check fails.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+HEAVY_MODULES = ['matplotlib', 'pandas', 'numpy', 'pymongo']
+
+MEASURE_CORE = '''
+import json, resource, sys, time
+start = time.perf_counter()
+import config as cfg
+import server_checks
+if cfg.check_stacks:
+    import STACKS_checks
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    'import_seconds': round(elapsed, 3),
+    'rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    'heavy_modules_loaded': sorted(m for m in %r if m in sys.modules)
+}))
+''' % (HEAVY_MODULES,)
+
+
+def measure_core():
+    """
+    This function imports the collector core in a fresh interpreter and returns what it measured.
+    """
+    output = subprocess.check_output([sys.executable, '-c', MEASURE_CORE])
+    return json.loads(output.decode().strip().split('\n')[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the startup time and memory use of the ServerReport collector core.')
+    parser.add_argument('--max-seconds', type=float, default=1.0)
+    parser.add_argument('--max-rss-mb', type=float, default=40)
+    args = parser.parse_args()
+
+    results = measure_core()
+    problems = []
+    if results['heavy_modules_loaded']:
+        problems.append('collector core loaded {}'.format(', '.join(results['heavy_modules_loaded'])))
+    if results['import_seconds'] > args.max_seconds:
+        problems.append('imports took {0}s (limit {1}s)'.format(results['import_seconds'], args.max_seconds))
+    if results['rss_mb'] > args.max_rss_mb:
+        problems.append('peak RSS was {0}MB (limit {1}MB)'.format(results['rss_mb'], args.max_rss_mb))
+    results['problems'] = problems
+    print(json.dumps(results, indent=2))
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
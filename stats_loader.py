@@ -0,0 +1,204 @@
+"""
+This module loads logged stats into dataframes for plotting.
+
+Stats are kept in day partitions (see archive.py), so only the partitions that overlap the requested range are read.
+Process logs are read in parallel, and concatenated once at the end.
+When the caller only needs one point every so many seconds (resolution), the stats come from the coarsest downsampled
+ tier that is fine enough instead (see tiers.py), so a year of stats is a few thousand rows rather than tens of
+ thousands per series.
+Each parsed file is cached under <stats_archive_dir>/cache/, together with the file's modification time and size, so
+ repeated requests only parse files that changed (usually just today's).
+"""
+
+import concurrent.futures
+import datetime
+import io
+import os
+import pickle
+
+import pandas as pd
+
+import config as cfg
+from archive import log_partitions, open_text, process_partitions, system_partitions
+from tiers import SYSTEM_METRICS, current_bucket_row, pick_tier, series_file, series_header
+
+SYSTEM_COLUMNS = ['time', '% CPU use', '% RAM used', '% hard drive used', 'free hard drive space', '% boot drive used']
+PROCESS_COLUMNS = ['report_time', 'status', 'create_time', 'memory_info', 'memory_percent', 'username', 'cpu_percent']
+
+
+def list_daily_files(process, start_date=None, log_dir=cfg.stats_archive_dir, end_date=None):
+    """
+    This function returns the daily log files for a process, oldest first, leaving out days before start_date and
+     after end_date.
+    """
+    return [f['csv'] for f in process_partitions(log_dir, process, start_date, end_date) if f['csv']]
+
+
+def parse_daily_file(daily_file):
+    """
+    This function reads one daily process log (compressed or not). Report times are turned into full datetimes using
+     the date in the file name. Rows without a usable report time (e.g. ambiguous process names) are dropped.
+    """
+    daily_stats = pd.read_csv(daily_file)
+    day = os.path.basename(daily_file).split('.')[0] + 'T'
+    daily_stats['report_time'] = pd.to_datetime(day + daily_stats['report_time'].astype(str), errors='coerce')
+    daily_stats = daily_stats[daily_stats['report_time'].notnull()]
+    for m in ['memory_percent', 'cpu_percent']:
+        daily_stats[m] = pd.to_numeric(daily_stats[m], errors='coerce')
+    return daily_stats
+
+
+def read_daily_file(daily_file, cache_dir):
+    """
+    This function returns the parsed contents of a daily process log, from the cache if the file hasn't changed since
+     it was cached.
+    """
+    file_stat = os.stat(daily_file)
+    file_key = (file_stat.st_mtime_ns, file_stat.st_size)
+    cache_file = os.path.join(cache_dir, os.path.basename(daily_file) + '.pkl')
+    if os.path.isfile(cache_file):
+        with open(cache_file, 'rb') as f:
+            cached_key, daily_stats = pickle.load(f)
+        if cached_key == file_key:
+            return daily_stats
+    daily_stats = parse_daily_file(daily_file)
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_file = cache_file + '.tmp'
+    with open(temp_file, 'wb') as f:
+        pickle.dump((file_key, daily_stats), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_file, cache_file)
+    return daily_stats
+
+
+def read_tier(series, width, start_date=None, log_dir=cfg.stats_archive_dir, end_date=None):
+    """
+    This function returns one series ('system' or 'processes/<process>') of the tier with buckets width seconds wide,
+     from the bucket containing start_date to end_date, including the bucket in progress. Each metric's mean is in a column
+     named after the metric, and its min, max and count in <metric>_min, <metric>_max and <metric>_count.
+    It returns None if the tier has nothing for the series.
+    """
+    tier_file = series_file(log_dir, width, series)
+    frames = []
+    if os.path.isfile(tier_file):
+        if start_date:
+            frames.append(read_stats_log_since(tier_file, start_date - datetime.timedelta(seconds=width)))
+        else:
+            frames.append(pd.read_csv(tier_file, parse_dates=['time']))
+    current_row = current_bucket_row(log_dir, width, series)
+    if current_row is not None:
+        frames.append(pd.read_csv(io.StringIO(series_header(series) + '\n' + current_row), parse_dates=['time']))
+    if not frames:
+        return None
+    stats = pd.concat(frames, ignore_index=True)
+    if end_date:
+        stats = stats[stats['time'] <= end_date]
+    return stats.rename(columns=lambda c: c[:-len('_mean')] if c.endswith('_mean') else c)
+
+
+def load_process_stats(process, start_date=None, log_dir=cfg.stats_archive_dir, resolution=None, end_date=None):
+    """
+    This function returns all logged stats for a process from start_date to end_date (datetimes, or None for no limit)
+     as a single dataframe. If resolution (in seconds) is given, the stats may come from a downsampled tier instead.
+    """
+    width = pick_tier(resolution)
+    if width:
+        stats = read_tier('processes/' + process, width, start_date, log_dir, end_date)
+        if stats is not None:
+            return stats.rename(columns={'time': 'report_time'})
+    daily_files = list_daily_files(process, start_date, log_dir, end_date)
+    cache_dir = os.path.join(log_dir, 'cache', 'processes', process)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=cfg.plot_loader_workers) as pool:
+        frames = list(pool.map(lambda f: read_daily_file(f, cache_dir), daily_files))
+    if not frames:
+        return pd.DataFrame(columns=PROCESS_COLUMNS)
+    stats = pd.concat(frames, ignore_index=True)
+    if start_date:
+        stats = stats[stats['report_time'] >= start_date]
+    if end_date:
+        stats = stats[stats['report_time'] <= end_date]
+    return stats
+
+
+def read_stats_log_since(log_file, since, block_size=65536):
+    """
+    This function reads the part of a CSV log that starts at since (a datetime) into a dataframe.
+    Rows are in time order, so it reads the file backwards in blocks and stops as soon as it reaches an older row,
+     instead of parsing the whole log.
+    """
+    since = since.isoformat()
+    with open(log_file, 'rb') as f:
+        header = f.readline()
+        data_start = f.tell()
+        position = f.seek(0, os.SEEK_END)
+        partial = b''                               # The start of a line cut off by the last block boundary
+        blocks = []                                 # The whole lines read so far, newest block first
+        while position > data_start:
+            read_size = min(block_size, position - data_start)
+            position -= read_size
+            f.seek(position)
+            block_lines = (f.read(read_size) + partial).split(b'\n')
+            partial = b''
+            if position > data_start:
+                partial = block_lines.pop(0)
+            blocks.append(block_lines)
+            if block_lines and block_lines[0] and block_lines[0].decode()[:len(since)] < since:
+                break
+    lines = [f.decode() for block_lines in reversed(blocks) for f in block_lines if f and f.decode()[:len(since)] >= since]
+    return pd.read_csv(io.StringIO(header.decode() + '\n'.join(lines)), parse_dates=[0])
+
+
+def load_system_stats(start_date=None, log_dir=cfg.stats_archive_dir, resolution=None, end_date=None):
+    """
+    This function returns the system stats from start_date to end_date (datetimes, or None for no limit) as a
+     dataframe.
+    Only the partitions from start_date on are read; within the first of them, uncompressed files are read from the end
+     (see read_stats_log_since). If resolution (in seconds) is given, the stats may come from a downsampled tier
+     instead, with the same column names.
+    Values are returned as numbers, without their unit (free space is logged like "812.34G"), and values that aren't
+     numbers (e.g. "unknown", logged for a check that timed out) as NaN.
+    """
+    width = pick_tier(resolution)
+    if width:
+        stats = read_tier('system', width, start_date, log_dir, end_date)
+        if stats is not None:
+            return stats.rename(columns=dict(zip(SYSTEM_METRICS, SYSTEM_COLUMNS[1:])))
+    stats = _read_partitions(system_partitions(log_dir, start_date, end_date), start_date, end_date)
+    if stats is None:
+        return pd.DataFrame(columns=SYSTEM_COLUMNS)
+    for m in SYSTEM_COLUMNS[1:]:
+        stats[m] = pd.to_numeric(stats[m].astype(str).str.rstrip('G'), errors='coerce')
+    return stats
+
+
+def load_log(name, start_date=None, log_dir=cfg.stats_archive_dir, end_date=None):
+    """
+    This function returns the rows of one of the day-partitioned logs (archive.DAY_LOGS, e.g. 'stacks_log') from
+     start_date to end_date (datetimes, or None for no limit) as a dataframe, or None if the log doesn't exist.
+    """
+    return _read_partitions(log_partitions(log_dir, name, start_date, end_date), start_date, end_date)
+
+
+def _read_partitions(partitions, start_date, end_date):
+    """
+    This function reads the CSV files of partitions (from system_partitions or log_partitions) into one dataframe,
+     keeping the rows from start_date to end_date. Within the first partition, uncompressed files are read from the end
+     (see read_stats_log_since). It returns None if there are no files.
+    """
+    frames = []
+    for partition in partitions:
+        if not partition['csv']:
+            continue
+        if start_date and not frames and not partition['csv'].endswith('.gz'):
+            frames.append(read_stats_log_since(partition['csv'], start_date))
+            continue
+        with open_text(partition['csv']) as f:
+            stats = pd.read_csv(f, parse_dates=['time'])
+        if start_date and not frames:
+            stats = stats[stats['time'] >= start_date]
+        frames.append(stats)
+    if not frames:
+        return None
+    stats = pd.concat(frames, ignore_index=True)
+    if end_date:
+        stats = stats[stats['time'] <= end_date]
+    return stats
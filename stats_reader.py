@@ -0,0 +1,220 @@
+"""
+This module reads the binary stats files written by stats_store.py.
+Files are memory-mapped and returned as NumPy structured arrays, so reading doesn't copy anything. Compressed day
+ partitions (see archive.py) are decompressed into memory instead.
+It also converts an existing CSV archive to binary files, and exports binary files back to CSV:
+    python stats_reader.py convert <stats_archive_dir>
+    python stats_reader.py export <file.bin> <file.csv>
+"""
+
+import csv
+import datetime
+import os
+
+import numpy as np
+
+from archive import partition_file, read_bytes, system_partitions
+from stats_store import EPOCH, HEADER_SIZE, SYSTEM_MAGIC, PROCESS_MAGIC, SYSTEM_FORMAT, PROCESS_FORMAT, PROCESS_OK, \
+    PROCESS_AMBIGUOUS, PROCESS_UNKNOWN, SYSTEM_CSV_HEADER, PROCESS_CSV_HEADER, WALL_CLOCK_MAGIC, after, \
+    to_seconds, from_seconds, to_float, process_record_values, wall_clock_to_seconds, write_header
+
+SYSTEM_DTYPE = np.dtype([('time', '<i8'), ('cpu_percent', '<f4'), ('memory_percent', '<f4'),
+                         ('hard_drive_percent', '<f4'), ('hard_drive_free_gb', '<f4'), ('boot_drive_percent', '<f4')])
+PROCESS_DTYPE = np.dtype([('time', '<i8'), ('status', 'u1'), ('create_time', '<i8'), ('memory_gb', '<f4'),
+                          ('memory_percent', '<f4'), ('cpu_percent', '<f4'), ('username', 'S32')])
+
+
+def open_records(log_file, magic, dtype):
+    """
+    This function memory-maps a binary stats file and returns its records as a NumPy structured array.
+    A record that was only partly written (e.g. the script was killed mid-write) is ignored. A file with local
+     wall-clock times (see stats_store.py) is read into memory with its times converted.
+    """
+    with open(log_file, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    if header[:len(magic)] not in (magic, WALL_CLOCK_MAGIC[magic]):
+        raise Exception("{} is not a ServerReport stats file of the expected type".format(log_file))
+    n_records = (os.path.getsize(log_file) - HEADER_SIZE) // dtype.itemsize
+    if n_records <= 0:
+        return np.zeros(0, dtype=dtype)
+    records = np.memmap(log_file, dtype=dtype, mode='r', offset=HEADER_SIZE, shape=(n_records,))
+    if header[:len(magic)] != magic:
+        return _utc_times(records)
+    return records
+
+
+def load_records(log_file, magic, dtype):
+    """
+    This function is open_records for a file that may be compressed.
+    """
+    if not log_file.endswith('.gz'):
+        return open_records(log_file, magic, dtype)
+    data = read_bytes(log_file)
+    if data[:len(magic)] not in (magic, WALL_CLOCK_MAGIC[magic]):
+        raise Exception("{} is not a ServerReport stats file of the expected type".format(log_file))
+    n_records = (len(data) - HEADER_SIZE) // dtype.itemsize
+    records = np.frombuffer(data, dtype=dtype, count=max(n_records, 0), offset=HEADER_SIZE)
+    if data[:len(magic)] != magic:
+        return _utc_times(records)
+    return records
+
+
+def _utc_times(records):
+    records = np.array(records)
+    previous = None
+    for i, seconds in enumerate(records['time']):
+        records['time'][i] = previous = wall_clock_to_seconds(seconds, previous)
+    return records
+
+
+def read_system_stats(log_dir=None, start=None, end=None, log_file=None):
+    """
+    This function returns the system stats between start and end (datetimes, both optional) as a structured array.
+    Only the day partitions that overlap start to end are opened (or only log_file, if given). Records are found by
+     binary search on the time column; if they all come from one uncompressed file, the result is a view of the
+     memory-mapped file, so nothing is copied.
+    """
+    if log_file is not None:
+        return _time_slice(open_records(log_file, SYSTEM_MAGIC, SYSTEM_DTYPE), start, end)
+    slices = [_time_slice(load_records(f['bin'], SYSTEM_MAGIC, SYSTEM_DTYPE), start, end)
+              for f in system_partitions(log_dir, start, end) if f['bin']]
+    slices = [f for f in slices if len(f)]
+    if not slices:
+        return np.zeros(0, dtype=SYSTEM_DTYPE)
+    if len(slices) == 1:
+        return slices[0]
+    return np.concatenate(slices)
+
+
+def _time_slice(records, start, end):
+    first = 0
+    last = len(records)
+    if start is not None:
+        first = np.searchsorted(records['time'], to_seconds(start), side='left')
+    if end is not None:
+        last = np.searchsorted(records['time'], to_seconds(end), side='right')
+    return records[first:last]
+
+
+def read_process_stats(log_dir, process, date):
+    """
+    This function returns one day of stats for one process as a structured array (a view of the memory-mapped file,
+     unless the day has been compressed).
+    """
+    log_file = partition_file(log_dir, process, str(date), 'bin')
+    if log_file is None:
+        raise FileNotFoundError("No binary stats for {0} on {1}".format(process, date))
+    return load_records(log_file, PROCESS_MAGIC, PROCESS_DTYPE)
+
+
+def convert_csv_archive(log_dir):
+    """
+    This function builds binary files from an existing CSV archive: stats_log.csv, every system/<date>.csv and every
+     processes/<process>/<date>.csv. Existing binary files are replaced. The CSV files, and compressed partitions, are
+     left alone.
+    """
+    stats_logs = [os.path.join(log_dir, 'stats_log.csv')]
+    system_dir = os.path.join(log_dir, 'system')
+    if os.path.isdir(system_dir):
+        stats_logs += [os.path.join(system_dir, f) for f in os.listdir(system_dir) if f.endswith('.csv')]
+    for stats_log in stats_logs:
+        if not os.path.isfile(stats_log):
+            continue
+        with open(stats_log, 'r') as f:
+            rows = [row for row in csv.reader(f) if row][1:]
+        records = []
+        for row in rows:
+            now = after(datetime.datetime.strptime(row[0], '%Y-%m-%dT%H:%M:%S'), records[-1][0] if records else None)
+            records.append((to_seconds(now),) + tuple(to_float(f) for f in row[1:6]))
+        _write_file(stats_log[:-len('.csv')] + '.bin', SYSTEM_MAGIC, SYSTEM_FORMAT, records)
+
+    processes_dir = os.path.join(log_dir, 'processes')
+    if not os.path.isdir(processes_dir):
+        return
+    for process in os.listdir(processes_dir):
+        process_dir = os.path.join(processes_dir, process)
+        if not os.path.isdir(process_dir):
+            continue
+        for log_name in os.listdir(process_dir):
+            if not (log_name.endswith('.csv') and '-' in log_name):
+                continue
+            date = log_name[:-len('.csv')]
+            with open(os.path.join(process_dir, log_name), 'r') as f:
+                rows = [row for row in csv.reader(f) if row][1:]
+            records = []
+            for row in rows:
+                records.append(process_row_values(date, row, records[-1][0] if records else None))
+            _write_file(os.path.join(process_dir, date + '.bin'), PROCESS_MAGIC, PROCESS_FORMAT, records)
+
+
+def process_row_values(date, row, previous=None):
+    """
+    This function turns one row of a process CSV log into the values of a binary process record.
+    Rows for ambiguous processes don't have a report time, so they are given midnight of the log's date.
+    previous is the timestamp of the row before, if any (see stats_store.after).
+    """
+    row = row + [''] * (7 - len(row))
+    try:
+        now = after(datetime.datetime.strptime(date + 'T' + row[0], '%Y-%m-%dT%H:%M:%S'), previous)
+    except ValueError:
+        now = datetime.datetime.strptime(date, '%Y-%m-%d')
+    if row[1] == 'OK':
+        process_info = {'create_time': row[2], 'memory_info': row[3], 'memory_percent': row[4],
+                        'username': row[5], 'cpu_percent': row[6]}
+        return process_record_values(now, process_info)
+    return process_record_values(now, row)
+
+
+def _write_file(log_file, magic, record_format, records):
+    temp_file = log_file + '.tmp'
+    with open(temp_file, 'wb') as f:
+        write_header(f, magic, record_format)
+        for values in records:
+            f.write(record_format.pack(*values))
+    os.replace(temp_file, log_file)
+
+
+def export_csv(log_file, csv_file):
+    """
+    This function writes a binary stats file (system or process) back out in the CSV log format.
+    """
+    with open(log_file, 'rb') as f:
+        magic = f.read(len(SYSTEM_MAGIC))
+    lines = []
+    if magic in (SYSTEM_MAGIC, WALL_CLOCK_MAGIC[SYSTEM_MAGIC]):
+        lines.append(SYSTEM_CSV_HEADER)
+        for r in open_records(log_file, SYSTEM_MAGIC, SYSTEM_DTYPE):
+            lines.append(','.join([from_seconds(r['time']).isoformat(), _number(r['cpu_percent']), _number(r['memory_percent']),
+                                   _number(r['hard_drive_percent']), _number(r['hard_drive_free_gb']) + 'G',
+                                   _number(r['boot_drive_percent'])]))
+    else:
+        lines.append(PROCESS_CSV_HEADER)
+        for r in open_records(log_file, PROCESS_MAGIC, PROCESS_DTYPE):
+            report_time = from_seconds(r['time']).isoformat().split('T')[1]
+            if r['status'] == PROCESS_OK:
+                lines.append(','.join([report_time, 'OK', (EPOCH + datetime.timedelta(seconds=int(r['create_time']))).isoformat(),
+                                       _number(r['memory_gb']) + 'G', _number(r['memory_percent']),
+                                       r['username'].decode('utf-8', 'replace'), _number(r['cpu_percent'])]))
+            elif r['status'] == PROCESS_UNKNOWN:
+                lines.append(','.join([report_time, 'unknown', '', '', '', '', '']))
+            elif r['status'] == PROCESS_AMBIGUOUS:
+                process = os.path.basename(os.path.dirname(os.path.abspath(log_file)))
+                lines.append('Ambiguous process name: {},,,,,'.format(process))
+            else:
+                lines.append(','.join([report_time, 'Process not running', '', '', '', '', '']))
+    with open(csv_file, 'w') as f:
+        f.write('\n'.join(lines))
+
+
+def _number(value):
+    return str(round(float(value), 2))
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) == 3 and sys.argv[1] == 'convert':
+        convert_csv_archive(sys.argv[2])
+    elif len(sys.argv) == 4 and sys.argv[1] == 'export':
+        export_csv(sys.argv[2], sys.argv[3])
+    else:
+        print("Usage:\n\tpython stats_reader.py convert <stats_archive_dir>\n\tpython stats_reader.py export <file.bin> <file.csv>")
@@ -0,0 +1,161 @@
+"""
+This module stores system and process stats as fixed-width binary records, alongside the CSV logs.
+
+    <stats_archive_dir>/stats_log.bin                      one record per stats check
+    <stats_archive_dir>/processes/<process>/<date>.bin     one record per process per stats check
+
+Each file starts with a 16 byte header (a magic string and the record size), followed by records with no separators.
+Numbers are stored as numbers (free space in GB, memory in GB), not as strings with unit suffixes, and times are stored
+ as UTC seconds since 1970-01-01, so they keep increasing when the clocks go back. They are turned back into local
+ (wall-clock) times, like the ones written to the CSV logs, only for display.
+Files written before that stored the local wall-clock time as if it were UTC. They have the older magic strings in
+ WALL_CLOCK_MAGIC; upgrade_file rewrites them in place, and stats_reader.py converts them when reading.
+Records are only ever appended. This module only writes them, with the struct module, so the stats checks don't need
+ NumPy; stats_reader.py memory-maps the files for reading.
+"""
+
+import calendar
+import datetime
+import os
+import struct
+import time
+
+HEADER_SIZE = 16
+SYSTEM_MAGIC = b'SRSYS002'
+PROCESS_MAGIC = b'SRPRC002'
+WALL_CLOCK_MAGIC = {SYSTEM_MAGIC: b'SRSYS001', PROCESS_MAGIC: b'SRPRC001'}
+EPOCH = datetime.datetime(1970, 1, 1)
+
+SYSTEM_FORMAT = struct.Struct('<q5f')
+
+PROCESS_FORMAT = struct.Struct('<qBqfff32s')
+PROCESS_OK = 0
+PROCESS_NOT_RUNNING = 1
+PROCESS_AMBIGUOUS = 2
+PROCESS_UNKNOWN = 3
+
+SYSTEM_CSV_HEADER = "time,% CPU use,% RAM used,% hard drive used,free hard drive space,% boot drive used"
+PROCESS_CSV_HEADER = 'report_time,status,create_time,memory_info,memory_percent,username,cpu_percent'
+
+
+def to_seconds(when):
+    """
+    This function converts a (naive, local) datetime into the integer UTC timestamps used in the binary files.
+    In the hour repeated when the clocks go back, when.fold says which of the two times is meant; datetime.now() sets it.
+    """
+    return int(when.timestamp())
+
+
+def from_seconds(seconds):
+    """
+    This function converts a timestamp from the binary files into a (naive, local) datetime.
+    """
+    return datetime.datetime.fromtimestamp(int(seconds))
+
+
+def after(when, previous):
+    """
+    This function returns when (a local time read back from a log), taken as the second of the two times it could be
+     if the clocks went back and the first one is earlier than the record before (previous, a timestamp). The logs
+     don't record which one was meant.
+    """
+    if previous is not None and to_seconds(when) < previous < to_seconds(when.replace(fold=1)):
+        return when.replace(fold=1)
+    return when
+
+
+def wall_clock_to_seconds(seconds, previous=None):
+    """
+    This function converts a time from a file with a WALL_CLOCK_MAGIC header into a UTC timestamp (see after).
+    """
+    return to_seconds(after(EPOCH + datetime.timedelta(seconds=int(seconds)), previous))
+
+
+def to_float(value):
+    """
+    This function turns a logged value like "812.34G" or "45.1" into a float. Empty or unknown values become NaN.
+    """
+    value = str(value).strip()
+    if value and value[-1].isalpha():
+        value = value[:-1]
+    try:
+        return float(value)
+    except ValueError:
+        return float('nan')
+
+
+def write_header(f, magic, record_format):
+    f.write(magic + struct.pack('<H', record_format.size) + b'\0' * (HEADER_SIZE - len(magic) - 2))
+
+
+def upgrade_file(log_file):
+    """
+    This function rewrites a binary stats file with a WALL_CLOCK_MAGIC header so that its times are UTC timestamps,
+     under the current magic string. Other files are left alone.
+    """
+    if not os.path.isfile(log_file):
+        return
+    with open(log_file, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+        for magic, record_format in ((SYSTEM_MAGIC, SYSTEM_FORMAT), (PROCESS_MAGIC, PROCESS_FORMAT)):
+            if header[:len(magic)] == WALL_CLOCK_MAGIC[magic]:
+                break
+        else:
+            return
+        data = header + f.read()
+    temp_file = log_file + '.tmp'
+    with open(temp_file, 'wb') as f:
+        write_header(f, magic, record_format)
+        previous = None
+        for offset in range(HEADER_SIZE, len(data) - record_format.size + 1, record_format.size):
+            values = list(record_format.unpack_from(data, offset))
+            values[0] = previous = wall_clock_to_seconds(values[0], previous)
+            f.write(record_format.pack(*values))
+    os.replace(temp_file, log_file)
+
+
+def _append(log_file, magic, record_format, values):
+    upgrade_file(log_file)
+    with open(log_file, 'ab') as f:
+        if f.tell() == 0:
+            write_header(f, magic, record_format)
+        f.write(record_format.pack(*values))
+
+
+def append_system_record(log_dir, now, cpu, ram, hard_drive, boot_drive):
+    """
+    This function appends one stats check to stats_log.bin. Arguments are the values log_stats writes to the CSV log.
+    """
+    values = (to_seconds(now), to_float(cpu), to_float(ram), to_float(hard_drive['percent_used']),
+              to_float(hard_drive['free_space']), to_float(boot_drive))
+    _append(os.path.join(log_dir, 'stats_log.bin'), SYSTEM_MAGIC, SYSTEM_FORMAT, values)
+
+
+def process_record_values(now, process_info):
+    """
+    This function turns the stats check_process_status reports for one process (a dict if the process was found, a
+     list if it wasn't running, was ambiguous or its check timed out) into the values of a binary process record.
+    The username is cut to 32 bytes without splitting a multibyte character. The create time is logged in UTC, and stays
+     UTC.
+    """
+    nan = float('nan')
+    if type(process_info) is dict:
+        create_time = calendar.timegm(time.strptime(process_info['create_time'], '%Y-%m-%dT%H:%M:%S'))
+        return (to_seconds(now), PROCESS_OK, create_time, to_float(process_info['memory_info']),
+                to_float(process_info['memory_percent']), to_float(process_info['cpu_percent']),
+                process_info['username'].encode()[:32].decode('utf-8', 'ignore').encode())
+    if str(process_info[0]).startswith('Ambiguous'):
+        status = PROCESS_AMBIGUOUS
+    elif process_info[1] == 'unknown':
+        status = PROCESS_UNKNOWN
+    else:
+        status = PROCESS_NOT_RUNNING
+    return (to_seconds(now), status, 0, nan, nan, nan, b'')
+
+
+def append_process_record(log_dir, process, now, process_info):
+    """
+    This function appends one stats check for one process to processes/<process>/<date>.bin.
+    """
+    log_file = os.path.join(log_dir, 'processes', process, str(now.date()) + '.bin')
+    _append(log_file, PROCESS_MAGIC, PROCESS_FORMAT, process_record_values(now, process_info))
@@ -0,0 +1,34 @@
+"""
+The tests run against a config built from config_template.py, with every path inside a temporary directory, so your
+ config.py and logs are never touched. It is installed as "config" before any ServerReport module is imported.
+
+Run the tests from the repository root:
+    python -m pytest tests
+"""
+
+import os
+import sys
+import tempfile
+import types
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+
+def install_config(work_dir):
+    template = os.path.join(REPO_DIR, 'config_template.py')
+    cfg = types.ModuleType('config')
+    cfg.__file__ = template
+    with open(template, 'r') as f:
+        exec(compile(f.read(), template, 'exec'), cfg.__dict__)
+    cfg.stats_archive_dir = os.path.join(work_dir, 'log') + '/'
+    cfg.script_log_file = os.path.join(work_dir, 'script.log')
+    cfg.mail_spool_dir = os.path.join(work_dir, 'mail_spool') + '/'
+    cfg.fleet_store_dir = os.path.join(work_dir, 'fleet') + '/'
+    cfg.check_stacks = False
+    cfg.entity_thresholds = {}
+    sys.modules['config'] = cfg
+    return cfg
+
+
+install_config(tempfile.mkdtemp(prefix='serverreport-tests-'))
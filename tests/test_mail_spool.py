@@ -0,0 +1,134 @@
+import os
+import socketserver
+import threading
+
+import pytest
+
+import mail_spool
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks just enough SMTP for smtplib. Recipients in server.rcpt_replies get that reply instead of 250.
+    """
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.reply('220 localhost stand-in')
+        mail_from, rcpt_to = None, []
+        while True:
+            line = self.rfile.readline().decode().rstrip('\r\n')
+            command = line[:4].upper()
+            if not line or command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            if command in ('EHLO', 'HELO'):
+                self.reply('250 localhost')
+            elif command == 'MAIL':
+                mail_from, rcpt_to = line[10:].strip('<>'), []
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                address = line[8:].strip('<>')
+                reply = self.server.rcpt_replies.get(address, '250 OK')
+                if reply.startswith('250'):
+                    rcpt_to.append(address)
+                self.reply(reply)
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = b''
+                while True:
+                    data_line = self.rfile.readline()
+                    if data_line in (b'.\r\n', b''):
+                        break
+                    data += data_line
+                self.server.received.append((mail_from, rcpt_to, data))
+                self.reply('250 OK')
+            elif command in ('NOOP', 'RSET'):
+                self.reply('250 OK')
+            else:
+                self.reply('502 Not implemented')
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), SMTPHandler)
+        self.received = []
+        self.rcpt_replies = {}
+
+
+@pytest.fixture
+def smtp_server(monkeypatch, tmp_path):
+    server = SMTPStandIn()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(mail_spool.cfg, 'email_server', server.server_address)
+    monkeypatch.setattr(mail_spool.cfg, 'email_use_starttls', False)
+    monkeypatch.setattr(mail_spool.cfg, 'password_to_send_emails', '')
+    monkeypatch.setattr(mail_spool.cfg, 'mail_timeout_seconds', 5)
+    monkeypatch.setattr(mail_spool.cfg, 'mail_spool_dir', str(tmp_path / 'spool') + '/')
+    mail_spool.retry_state.clear()
+    yield server
+    mail_spool.close_connection()
+    server.shutdown()
+    server.server_close()
+
+
+def spooled():
+    return sorted(f for f in os.listdir(mail_spool.cfg.mail_spool_dir) if f.endswith('.eml'))
+
+
+def test_delivery_over_one_connection(smtp_server):
+    mail_spool.spool_message(mail_spool.build_message('First', 'one', ['a@example.com', 'b@example.com']))
+    mail_spool.spool_message(mail_spool.build_message('Second', 'two', ['a@example.com']))
+    mail_spool.deliver_spool()
+    assert spooled() == []
+    assert [f[1] for f in smtp_server.received] == [['a@example.com', 'b@example.com'], ['a@example.com']]
+    assert b'Subject: First' in smtp_server.received[0][2]
+
+
+def test_transient_failure_is_retried(smtp_server):
+    smtp_server.rcpt_replies['a@example.com'] = '451 Try again later'
+    name = mail_spool.spool_message(mail_spool.build_message('Greylisted', 'text', ['a@example.com']))
+    mail_spool.deliver_spool()
+    assert spooled() == [name]
+    assert mail_spool.retry_state[name]['attempts'] == 1
+    assert not os.path.isdir(os.path.join(mail_spool.cfg.mail_spool_dir, 'failed'))
+
+    del smtp_server.rcpt_replies['a@example.com']
+    mail_spool.retry_state[name]['next_attempt'] = 0
+    mail_spool.deliver_spool()
+    assert spooled() == []
+    assert name not in mail_spool.retry_state
+    assert len(smtp_server.received) == 1
+
+
+def test_permanent_failure_goes_to_failed(smtp_server):
+    smtp_server.rcpt_replies['a@example.com'] = '550 No such user'
+    name = mail_spool.spool_message(mail_spool.build_message('Bounced', 'text', ['a@example.com']))
+    mail_spool.deliver_spool()
+    assert spooled() == []
+    assert os.listdir(os.path.join(mail_spool.cfg.mail_spool_dir, 'failed')) == [name]
+
+
+def test_poison_file_doesnt_block_the_spool(smtp_server):
+    os.makedirs(mail_spool.cfg.mail_spool_dir)
+    with open(os.path.join(mail_spool.cfg.mail_spool_dir, '00000000T000000000000-poison.eml'), 'wb') as f:
+        f.write(b'Subject: no recipients\r\n\r\nbody\r\n')
+    mail_spool.spool_message(mail_spool.build_message('After the poison', 'text', ['a@example.com']))
+    mail_spool.deliver_spool()
+    assert spooled() == []
+    assert os.listdir(os.path.join(mail_spool.cfg.mail_spool_dir, 'failed')) == ['00000000T000000000000-poison.eml']
+    assert len(smtp_server.received) == 1
+
+
+def test_partly_refused_recipients_are_logged(smtp_server, caplog):
+    smtp_server.rcpt_replies['b@example.com'] = '550 No such user'
+    mail_spool.spool_message(mail_spool.build_message('Partly refused', 'text', ['a@example.com', 'b@example.com']))
+    mail_spool.deliver_spool()
+    assert spooled() == []
+    assert smtp_server.received[0][1] == ['a@example.com']
+    assert 'b@example.com' in caplog.text
@@ -0,0 +1,63 @@
+import pymongo
+import pytest
+
+import mongo_check
+
+
+class FakeClient(object):
+    """
+    Stands in for pymongo.MongoClient. The server answers pings unless FakeClient.up is False.
+    """
+    up = True
+    created = 0
+
+    def __init__(self, *args, **kwargs):
+        FakeClient.created += 1
+        self.admin = self
+
+    def command(self, name):
+        assert name == 'ping'
+        if not FakeClient.up:
+            raise pymongo.errors.ServerSelectionTimeoutError('No servers found')
+        return {'ok': 1.0}
+
+
+@pytest.fixture(autouse=True)
+def fake_client(monkeypatch):
+    FakeClient.up = True
+    FakeClient.created = 0
+    monkeypatch.setattr(mongo_check.pymongo, 'MongoClient', FakeClient)
+    monkeypatch.setitem(mongo_check.mongo_client, 'client', None)
+
+
+def test_ping_when_up_returns_latency_and_keeps_the_client():
+    first = mongo_check.ping_mongo()
+    second = mongo_check.ping_mongo()
+    assert first is not None and first >= 0
+    assert second is not None and second >= 0
+    assert FakeClient.created == 1
+
+
+def test_ping_when_down_returns_none():
+    FakeClient.up = False
+    assert mongo_check.ping_mongo() is None
+    FakeClient.up = True
+    assert mongo_check.ping_mongo() is not None
+    assert FakeClient.created == 1
+
+
+def test_ping_when_the_client_cant_be_created_returns_none(monkeypatch):
+    def broken_client(*args, **kwargs):
+        raise pymongo.errors.ConfigurationError('Invalid URI')
+    monkeypatch.setattr(mongo_check.pymongo, 'MongoClient', broken_client)
+    assert mongo_check.ping_mongo() is None
+    assert mongo_check.mongo_client['client'] is None
+
+
+def test_log_mongo_latency(tmp_path):
+    mongo_check.log_mongo_latency(12.5, str(tmp_path))
+    mongo_check.log_mongo_latency(None, str(tmp_path))
+    lines = (tmp_path / 'mongo_log.csv').read_text().split('\n')
+    assert lines[0] == 'time,status,latency_ms'
+    assert lines[1].endswith(',up,12.5')
+    assert lines[2].endswith(',down,')
@@ -0,0 +1,59 @@
+import datetime
+import os
+import time
+
+import pytest
+
+import stats_store
+from stats_reader import SYSTEM_DTYPE, read_system_stats
+from stats_store import SYSTEM_FORMAT, SYSTEM_MAGIC, WALL_CLOCK_MAGIC, append_system_record, write_header
+
+FALL_BACK = datetime.datetime(2026, 11, 1, 6, 0)      # 02:00 EDT becomes 01:00 EST
+
+
+@pytest.fixture(autouse=True)
+def new_york(monkeypatch):
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def utc_seconds(when):
+    return int((when - stats_store.EPOCH).total_seconds())
+
+
+def test_times_keep_increasing_when_the_clocks_go_back(tmp_path):
+    start = utc_seconds(FALL_BACK) - 2 * 3600
+    for minutes in range(0, 4 * 60, 10):
+        now = datetime.datetime.fromtimestamp(start + 60 * minutes)
+        append_system_record(str(tmp_path), now, '1', '2', {'percent_used': '3', 'free_space': '4G'}, '5')
+    log_file = os.path.join(str(tmp_path), 'stats_log.bin')
+    records = read_system_stats(log_file=log_file)
+    assert len(records) == 24
+    assert (records['time'][1:] > records['time'][:-1]).all()
+
+    # 01:30 happens twice; fold picks the second one, after the clocks went back
+    second_half_past_one = datetime.datetime(2026, 11, 1, 1, 30, fold=1)
+    later = read_system_stats(log_file=log_file, start=second_half_past_one)
+    assert later['time'][0] == utc_seconds(FALL_BACK) + 1800
+    assert len(later) == 9
+
+
+def test_wall_clock_files_are_upgraded_on_append(tmp_path):
+    log_file = os.path.join(str(tmp_path), 'stats_log.bin')
+    with open(log_file, 'wb') as f:
+        write_header(f, WALL_CLOCK_MAGIC[SYSTEM_MAGIC], SYSTEM_FORMAT)
+        for wall_clock in ('2026-11-01T01:30:00', '2026-11-01T01:50:00', '2026-11-01T01:10:00'):
+            when = datetime.datetime.strptime(wall_clock, '%Y-%m-%dT%H:%M:%S')
+            f.write(SYSTEM_FORMAT.pack(utc_seconds(when), 1, 2, 3, 4, 5))
+    assert list(read_system_stats(log_file=log_file)['time'] - utc_seconds(FALL_BACK)) == [-1800, -600, 600]
+
+    append_system_record(str(tmp_path), datetime.datetime(2026, 11, 1, 1, 20, fold=1), '1', '2',
+                         {'percent_used': '3', 'free_space': '4G'}, '5')
+    with open(log_file, 'rb') as f:
+        assert f.read(len(SYSTEM_MAGIC)) == SYSTEM_MAGIC
+    records = read_system_stats(log_file=log_file)
+    assert records.dtype == SYSTEM_DTYPE
+    assert list(records['time'] - utc_seconds(FALL_BACK)) == [-1800, -600, 600, 1200]
@@ -0,0 +1,222 @@
+"""
+This module decides which stats have crossed their warning or critical thresholds.
+
+The thresholds are compiled once, when the module is imported, from:
+    cfg.warning_parameters and cfg.critical_parameters: CPU, RAM, hard drive space and boot partition
+    cfg.entity_thresholds: rules for one process, mount or STACKS collector, named "<kind>:<name>" (e.g.
+     "process:PROCESS1", "mount:/data", "collector:Project1-Collector1")
+    cfg.mount_thresholds: rules for every mounted filesystem that is checked, for the metrics it has no "mount:" rule
+     for and that the hard drive and boot partition rules don't already cover. These are added the first time each
+     mount point is seen (see add_mount_rules).
+Each kind of rule gets its own rule set, holding the parsed thresholds in lists. Metrics where low values are bad (free
+ space, ingest rate) are stored negated, so every rule is checked the same way, with one pass over the lists per check.
+The rules are checked in plain Python rather than with NumPy, because this module is part of the collector core, which
+ doesn't load NumPy (see startup_check.py). A few hundred rules take well under a millisecond either way.
+
+A rule stays active from when its value reaches the warning threshold until it is back past the warning threshold by
+ at least its hysteresis (cfg.threshold_hysteresis, or "hysteresis" in an entity rule). This keeps a value that hovers
+ around a threshold from sending an email each time it crosses it. As before, an email is only sent when a rule
+ becomes active; the rule's entry in warning_flags is 1 while it is active.
+"""
+
+import math
+
+import config as cfg
+from stats_store import to_float
+
+# warning_parameters name: (warning_flags name, direction, message). Messages are formatted with the entity and value.
+SYSTEM_RULES = {
+    "CPU": ('CPU', 'above', "CPU usage is at {1}%"),
+    "RAM": ('RAM', 'above', "RAM usage is at {1}%"),
+    "hard_drive_space": ('Hard drive space', 'below', "Hard drive free space is down to {1}"),
+    "boot_partition": ('Boot drive space', 'above', "Boot drive usage is at {1}%")
+}
+# kind: {metric: (direction, message)} for the rules in cfg.entity_thresholds
+ENTITY_METRICS = {
+    'process': {'cpu_percent': ('above', "{0} CPU usage is at {1}%"),
+                'memory_percent': ('above', "{0} memory usage is at {1}%")},
+    'mount': {'percent_used': ('above', "{0} usage is at {1}%"),
+              'free_space': ('below', "{0} free space is down to {1}"),
+              'inode_percent': ('above', "{0} inode usage is at {1}%")},
+    'collector': {'bytes_per_minute': ('below', "{0} is writing {1} bytes per minute")}
+}
+OK, WARNING, CRITICAL = 0, 1, 2
+
+
+def parse_threshold(value):
+    """
+    This function turns a threshold from the config file, like "180GB" or "90", into a float.
+    """
+    value = str(value).strip()
+    if value.endswith('B'):
+        value = value[:-1]
+    number = to_float(value)
+    if math.isnan(number):
+        raise Exception("Can't read threshold {}".format(value))
+    return number
+
+
+class RuleSet(object):
+    """
+    The compiled rules of one kind. Rules are added once; check() is then called with each new set of values.
+    """
+
+    def __init__(self, kind, flags):
+        self.kind = kind
+        self.flags_by_name = flags
+        self.positions = {}
+        self.flags = []
+        self.messages = []
+        self.names = []
+        self.signs = []
+        self.warning = []
+        self.critical = []
+        self.clear = []
+        self.levels = []
+
+    def add_rule(self, entity, metric, flag, direction, message, warning, critical, hysteresis=0):
+        sign = 1.0 if direction == 'above' else -1.0
+        self.positions[(entity, metric)] = len(self.flags)
+        self.flags.append(flag)
+        self.messages.append(message)
+        self.names.append(entity)
+        self.signs.append(sign)
+        self.warning.append(sign * parse_threshold(warning))
+        self.critical.append(sign * parse_threshold(critical if critical is not None else warning))
+        self.clear.append(sign * parse_threshold(warning) - abs(float(hysteresis)))
+        self.levels.append(OK)
+        self.flags_by_name.setdefault(flag, 0)
+
+    def check(self, values):
+        """
+        This function checks a dictionary structured as (entity, metric): value against the rules. Values can be
+         numbers or logged strings like "812.34G"; missing or unknown values are skipped.
+        It returns (messages for every rule that is over its warning threshold, messages for the rules that just became
+         active, the highest level seen).
+        """
+        current = [math.nan] * len(self.flags)
+        shown = [None] * len(self.flags)
+        for key, value in values.items():
+            i = self.positions.get(key)
+            if i is not None:
+                current[i] = to_float(value)
+                shown[i] = value
+        warnings = []
+        new_warnings = []
+        highest = OK
+        for i in range(len(current)):
+            value = current[i] * self.signs[i]
+            if math.isnan(value):
+                continue
+            if value >= self.warning[i]:
+                level = CRITICAL if value >= self.critical[i] else WARNING
+                message = self.messages[i].format(self.names[i], shown[i])
+                warnings.append(message)
+                highest = max(highest, level)
+                if self.flags_by_name[self.flags[i]] == 0:
+                    new_warnings.append(message)
+                    self.flags_by_name[self.flags[i]] = 1
+                self.levels[i] = level
+            elif value < self.clear[i]:
+                self.flags_by_name[self.flags[i]] = 0
+                self.levels[i] = OK
+        return warnings, new_warnings, highest
+
+
+def compile_rules(flags, warn_thresholds=cfg.warning_parameters, crit_thresholds=cfg.critical_parameters,
+                  entity_thresholds=cfg.entity_thresholds, hysteresis=cfg.threshold_hysteresis):
+    """
+    This function builds a RuleSet for the system stats and one for each kind of entity rule. Whether each rule is
+     active is kept in flags (a dictionary structured as flag name: 0 or 1).
+    """
+    rule_sets = {'system': RuleSet('system', flags)}
+    for name, (flag, direction, message) in SYSTEM_RULES.items():
+        if name in warn_thresholds:
+            rule_sets['system'].add_rule('system', name, flag, direction, message, warn_thresholds[name],
+                                         crit_thresholds.get(name), hysteresis.get(name, 0))
+    for rule_name, metrics in entity_thresholds.items():
+        kind, _, entity = rule_name.partition(':')
+        if kind not in ENTITY_METRICS:
+            raise Exception("Unknown kind of threshold rule: {}".format(rule_name))
+        rule_set = rule_sets.setdefault(kind, RuleSet(kind, flags))
+        for metric, rule in metrics.items():
+            if metric not in ENTITY_METRICS[kind]:
+                raise Exception("Can't set a threshold for {0} of {1}".format(metric, rule_name))
+            direction, message = ENTITY_METRICS[kind][metric]
+            rule_set.add_rule(entity, metric, rule_name + ' ' + metric, direction, message,
+                              rule['warning'], rule.get('critical'), rule.get('hysteresis', 0))
+    return rule_sets
+
+
+def add_mount_rules(compiled_rules, mount_points, mount_thresholds=cfg.mount_thresholds, root_dir=cfg.root_dir,
+                    boot_drive=cfg.boot_drive):
+    """
+    This function gives each mount point the rules in mount_thresholds, for the metrics that don't already have a rule
+     for that mount point. The rules are named like entity rules ("mount:<mount point>").
+    The space used on root_dir and boot_drive is left out while the hard_drive_space and boot_partition rules check it,
+     so that filling either one doesn't send two emails.
+    """
+    system_rules = compiled_rules['system'].positions
+    covered = set()
+    if ('system', 'hard_drive_space') in system_rules:
+        covered.update([(root_dir, 'percent_used'), (root_dir, 'free_space')])
+    if ('system', 'boot_partition') in system_rules:
+        covered.add((boot_drive, 'percent_used'))
+    flags = compiled_rules['system'].flags_by_name
+    rule_set = compiled_rules.setdefault('mount', RuleSet('mount', flags))
+    for mount_point in mount_points:
+        for metric, rule in mount_thresholds.items():
+            if metric not in ENTITY_METRICS['mount']:
+                raise Exception("Can't set a threshold for {} of mounts".format(metric))
+            if (mount_point, metric) in rule_set.positions or (mount_point, metric) in covered:
+                continue
+            direction, message = ENTITY_METRICS['mount'][metric]
+            rule_set.add_rule(mount_point, metric, 'mount:{0} {1}'.format(mount_point, metric), direction, message,
+                              rule['warning'], rule.get('critical'), rule.get('hysteresis', 0))
+
+
+def check_thresholds(kind, values, compiled_rules=None):
+    """
+    This function checks values against the compiled rules of one kind (see RuleSet.check). It uses this server's
+     rules unless compiled_rules (from compile_rules) is given.
+    If there are no rules of that kind, nothing is over a threshold.
+    """
+    rule_set = (compiled_rules or rule_sets).get(kind)
+    if rule_set is None:
+        return [], [], OK
+    return rule_set.check(values)
+
+
+def check_stats(cpu, ram, hard_drive, boot_drive, processes=None, mounts=None, compiled_rules=None):
+    """
+    This function checks one set of stats, as logged by log_stats, against every kind of rule.
+    processes is structured as process: stats dictionary (or a list for a process that isn't running), and mounts as
+     (mount point, metric): value.
+    It returns (messages for every stat over its warning threshold, messages for the stats that just crossed it, the
+     highest level seen).
+    """
+    checks = [('system', {('system', 'CPU'): cpu, ('system', 'RAM'): ram,
+                          ('system', 'hard_drive_space'): hard_drive, ('system', 'boot_partition'): boot_drive})]
+    if processes:
+        process_values = {}
+        for process, process_info in processes.items():
+            if type(process_info) is dict:
+                process_values[(process, 'cpu_percent')] = process_info['cpu_percent']
+                process_values[(process, 'memory_percent')] = process_info['memory_percent']
+        checks.append(('process', process_values))
+    if mounts:
+        add_mount_rules(compiled_rules or rule_sets, set(f[0] for f in mounts))
+        checks.append(('mount', mounts))
+    warning_contents = []
+    stats_to_email = []
+    highest_level = OK
+    for kind, values in checks:
+        warnings, new_warnings, level = check_thresholds(kind, values, compiled_rules)
+        warning_contents.extend(warnings)
+        stats_to_email.extend(new_warnings)
+        highest_level = max(highest_level, level)
+    return warning_contents, stats_to_email, highest_level
+
+
+warning_flags = {}
+rule_sets = compile_rules(warning_flags)
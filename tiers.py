@@ -0,0 +1,251 @@
+"""
+This module keeps downsampled copies of the stats (tiers), so plots covering months or years don't have to read every
+ stats check.
+
+For each tier width in cfg.rollup_tier_seconds (e.g. an hour and a day), every stats check is added to the bucket of
+ that width it falls in, for the system stats and for each process. Each bucket holds, for each metric, the mean, min,
+ max and number of samples. Finished buckets are appended to
+
+    <stats_archive_dir>/tiers/<width>s/system.csv
+    <stats_archive_dir>/tiers/<width>s/processes/<process>.csv
+
+and the buckets in progress are kept in tiers/current.json, rewritten after each stats check.
+Readers use pick_tier to find the coarsest tier that still has at least the resolution they need, and read_tier to
+ load it (see stats_loader.py). Tiers are not affected by archive_retention_days, so they can cover more history than
+ the day partitions.
+"""
+
+import calendar
+import csv
+import datetime
+import json
+import logging
+import math
+import os
+import shutil
+
+import config as cfg
+from archive import open_text, process_partitions, system_partitions
+from stats_store import EPOCH, to_float
+
+SYSTEM_METRICS = ['cpu_percent', 'memory_percent', 'hard_drive_percent', 'hard_drive_free_gb', 'boot_drive_percent']
+PROCESS_METRICS = ['cpu_percent', 'memory_percent', 'memory_gb']
+
+tier_buckets = {}
+tier_state = {'loaded': False}
+
+
+def to_seconds(when):
+    """
+    This function converts a (naive, local) datetime into the wall-clock seconds buckets are counted in, so day buckets
+     start at local midnight. Unlike the times in the binary stats files, these repeat when the clocks go back.
+    """
+    return calendar.timegm(when.timetuple())
+
+
+def from_seconds(seconds):
+    return EPOCH + datetime.timedelta(seconds=int(seconds))
+
+
+def _tier_dir(log_dir, width):
+    return os.path.join(log_dir, 'tiers', '{}s'.format(width))
+
+
+def series_file(log_dir, width, series):
+    return os.path.join(_tier_dir(log_dir, width), series + '.csv')
+
+
+def _current_file(log_dir):
+    return os.path.join(log_dir, 'tiers', 'current.json')
+
+
+def _metrics(series):
+    return SYSTEM_METRICS if series == 'system' else PROCESS_METRICS
+
+
+def series_header(series):
+    return 'time,' + ','.join('{0}_mean,{0}_min,{0}_max,{0}_count'.format(m) for m in _metrics(series))
+
+
+def _row(bucket, metrics):
+    fields = [bucket['start']]
+    for m in metrics:
+        total, low, high, count = bucket['metrics'].get(m, (0, 0, 0, 0))
+        if count:
+            fields += [str(round(total / count, 3)), str(round(low, 3)), str(round(high, 3)), str(count)]
+        else:
+            fields += ['', '', '', '0']
+    return ','.join(fields)
+
+
+def _add(width, series, seconds, values, finished):
+    """
+    This function adds one sample (values is structured as metric: number) at seconds to the bucket of the given
+     width. If the sample starts a new bucket, the one it replaces is added to finished, structured as
+     (width, series): [rows].
+    """
+    buckets = tier_buckets.setdefault(str(width), {})
+    start = seconds - seconds % width
+    bucket = buckets.get(series)
+    if bucket is None or bucket['seconds'] != start:
+        if bucket is not None:
+            finished.setdefault((width, series), []).append(bucket)
+        bucket = buckets[series] = {'start': from_seconds(start).isoformat(), 'seconds': start, 'metrics': {}}
+    for m, value in values.items():
+        if math.isnan(value):
+            continue
+        agg = bucket['metrics'].get(m)
+        if agg is None:
+            bucket['metrics'][m] = [value, value, value, 1]
+        else:
+            bucket['metrics'][m] = [agg[0] + value, min(agg[1], value), max(agg[2], value), agg[3] + 1]
+
+
+def _write_finished(log_dir, finished):
+    for (width, series), buckets in finished.items():
+        tier_file = series_file(log_dir, width, series)
+        rows = [_row(f, _metrics(series)) for f in buckets]
+        if os.path.isfile(tier_file):
+            with open(tier_file, 'a') as f:
+                f.write(''.join('\n' + row for row in rows))
+        else:
+            os.makedirs(os.path.dirname(tier_file), exist_ok=True)
+            with open(tier_file, 'w') as f:
+                f.write(series_header(series) + ''.join('\n' + row for row in rows))
+
+
+def _save_current(log_dir):
+    current_file = _current_file(log_dir)
+    os.makedirs(os.path.dirname(current_file), exist_ok=True)
+    temp_file = current_file + '.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(tier_buckets, f)
+    os.replace(temp_file, current_file)
+
+
+def system_values(cpu, ram, hard_drive, boot_drive):
+    return dict(zip(SYSTEM_METRICS, [to_float(cpu), to_float(ram), to_float(hard_drive['percent_used']),
+                                     to_float(hard_drive['free_space']), to_float(boot_drive)]))
+
+
+def process_values(process_info):
+    """
+    This function returns the metrics of one process, from the stats check_process_status reports for it, or None if
+     the process wasn't found.
+    """
+    if type(process_info) is not dict:
+        return None
+    return dict(zip(PROCESS_METRICS, [to_float(process_info['cpu_percent']), to_float(process_info['memory_percent']),
+                                      to_float(process_info['memory_info'])]))
+
+
+def update_tiers(log_dir, now, system, processes):
+    """
+    This function adds one stats check to every tier. system is the dictionary returned by system_values, processes
+     the dictionary returned by check_process_status.
+    The first time it runs on a server that already has a stats archive, it builds the tiers from the archive instead
+     (see rebuild_tiers), which already includes this stats check.
+    """
+    if not tier_state['loaded']:
+        tier_state['loaded'] = True
+        if os.path.isfile(_current_file(log_dir)):
+            with open(_current_file(log_dir), 'r') as f:
+                tier_buckets.update(json.load(f))
+        elif system_partitions(log_dir):
+            rebuild_tiers(log_dir)
+            return
+    seconds = to_seconds(now)
+    finished = {}
+    for width in cfg.rollup_tier_seconds:
+        _add(width, 'system', seconds, system, finished)
+        for process, process_info in processes.items():
+            values = process_values(process_info)
+            if values is not None:
+                _add(width, 'processes/' + process, seconds, values, finished)
+    _write_finished(log_dir, finished)
+    _save_current(log_dir)
+
+
+def rebuild_tiers(log_dir):
+    """
+    This function builds every tier from scratch out of the stats archive (see archive.py). It runs once, when
+     ServerReport starts keeping tiers on a server that already has stats.
+    """
+    logging.info('Building the stats tiers from the stats archive')
+    tier_buckets.clear()
+    finished = {}
+    for partition in system_partitions(log_dir):
+        if not partition['csv']:
+            continue
+        with open_text(partition['csv']) as f:
+            rows = csv.reader(f)
+            next(rows, None)
+            for row in rows:
+                if len(row) < 6:
+                    continue
+                seconds = to_seconds(_parse_time(row[0]))
+                values = dict(zip(SYSTEM_METRICS, [to_float(f) for f in row[1:6]]))
+                for width in cfg.rollup_tier_seconds:
+                    _add(width, 'system', seconds, values, finished)
+    processes_dir = os.path.join(log_dir, 'processes')
+    processes = os.listdir(processes_dir) if os.path.isdir(processes_dir) else []
+    for process in [f for f in processes if os.path.isdir(os.path.join(processes_dir, f))]:
+        for partition in process_partitions(log_dir, process):
+            if not partition['csv']:
+                continue
+            with open_text(partition['csv']) as f:
+                rows = csv.reader(f)
+                next(rows, None)
+                day_start = to_seconds(_parse_time(partition['date'] + 'T00:00:00'))
+                for row in rows:
+                    if len(row) < 7 or row[1] != 'OK':
+                        continue
+                    hours, minutes, secs = row[0].split(':')
+                    seconds = day_start + 3600 * int(hours) + 60 * int(minutes) + int(secs)
+                    values = process_values({'cpu_percent': row[6], 'memory_percent': row[4], 'memory_info': row[3]})
+                    for width in cfg.rollup_tier_seconds:
+                        _add(width, 'processes/' + process, seconds, values, finished)
+    for width in cfg.rollup_tier_seconds:
+        shutil.rmtree(_tier_dir(log_dir, width), ignore_errors=True)
+    _write_finished(log_dir, finished)
+    _save_current(log_dir)
+
+
+def _parse_time(text):
+    return datetime.datetime.strptime(text[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+def pick_tier(resolution):
+    """
+    This function returns the width of the coarsest tier whose buckets are no wider than resolution (in seconds), or
+     None if the raw stats are needed.
+    """
+    widths = [f for f in cfg.rollup_tier_seconds if resolution is not None and f <= resolution]
+    return max(widths) if widths else None
+
+
+def current_bucket_row(log_dir, width, series):
+    """
+    This function returns the bucket in progress for a series as a CSV row, or None.
+    """
+    if not os.path.isfile(_current_file(log_dir)):
+        return None
+    with open(_current_file(log_dir), 'r') as f:
+        bucket = json.load(f).get(str(width), {}).get(series)
+    if bucket is None:
+        return None
+    return _row(bucket, _metrics(series))
+
+
+def first_tier_time(log_dir, series):
+    """
+    This function returns the start of the oldest bucket kept for a series (an ISO time string), or None.
+    """
+    if not cfg.rollup_tier_seconds:
+        return None
+    tier_file = series_file(log_dir, max(cfg.rollup_tier_seconds), series)
+    if not os.path.isfile(tier_file):
+        return None
+    with open(tier_file, 'r') as f:
+        f.readline()
+        return f.readline()[:19] or None